@@ -3,7 +3,7 @@ from django.contrib.auth.admin import UserAdmin
 from django.contrib.auth.models import User
 from django.utils.html import format_html
 from django.urls import re_path
-from .models import Item, Category, Order, Cart, LineItem, Place, InterPlaceDistance, DroneLoad, ClinicManager
+from .models import Item, Category, Order, Cart, LineItem, Place, InterPlaceDistance, DroneLoad, ClinicManager, QueuedEmail, OrderEvent, OrderStats
 from airsupply.tokens import send_activation_link
 from django.shortcuts import redirect
 # Define an inline admin descriptor for Employee model
@@ -46,6 +46,21 @@ admin.site.register(Order)
 admin.site.register(Cart)
 admin.site.register(DroneLoad)
 admin.site.register(ClinicManager)
+admin.site.register(QueuedEmail)
+
+
+@admin.register(OrderEvent)
+class OrderEventAdmin(admin.ModelAdmin):
+    list_display = ('timestamp', 'order', 'clinic', 'status', 'sincePrevious', 'sinceOrdered')
+    list_filter = ('status', 'clinic')
+    date_hierarchy = 'timestamp'
+
+
+@admin.register(OrderStats)
+class OrderStatsAdmin(admin.ModelAdmin):
+    list_display = ('hour', 'clinic', 'statusCode', 'count', 'sinceOrderedTotal', 'sinceOrderedMax')
+    list_filter = ('statusCode', 'clinic')
+    date_hierarchy = 'hour'
 
 
 # Re-register UserAdmin
@@ -0,0 +1,270 @@
+import hashlib
+from functools import wraps
+
+from django.db.models import Count, Max, Min, Prefetch, Sum
+from django.http import JsonResponse
+from django.views.decorators.http import condition, require_GET
+
+from . import catalogue, flightplans, planner, roles, weights
+from .distances import distance_matrix
+from .models import Item, Order, Cart, DroneLoad, LineItem
+from .pagination import KeysetPaginator, rank_after
+
+
+# Versioned JSON API.
+#
+# Read-only endpoints under /api/v1/ for the handheld scanners and the drone
+# port tablets, so they no longer scrape the HTML pages. Every response is
+# built from one set of rows, and its ETag comes from their count and the
+# newest `modified` time of those rows and of the related rows whose fields
+# they embed. A client that repeats a request with If-None-Match gets an empty
+# 304 for the price of one aggregate query. Single objects also answer
+# If-Modified-Since; lists do not, as a row leaving a list changes its count
+# but not its newest `modified` time. Rows changed by a bulk UPDATE must set
+# `modified` themselves, as auto_now only runs in save(). Itineraries also depend on the places and the distance
+# table, which have no timestamps, so they only get an ETag, keyed on the
+# distance matrix version and the stored itinerary key as well.
+#
+# ?fields=id,status keeps only the listed fields of each object. Lists are
+# keyset paginated like the HTML pages, with ?limit and ?cursor, and return
+# {"results": [...], "next": <cursor or null>}.
+
+VERSION = 1
+
+
+def _error(status, message):
+    return JsonResponse({'error': message}, status=status, json_dumps_params={'separators': (',', ':')})
+
+
+def _fields(request):
+    fields = request.GET.get('fields')
+    return set(filter(None, fields.split(','))) if fields else None
+
+
+def _select(data, fields):
+    if fields is None:
+        return data
+    return {key: value for key, value in data.items() if key in fields}
+
+
+def _response(data):
+    return JsonResponse(data, safe=False, json_dumps_params={'separators': (',', ':')})
+
+
+def _version(request, rows, related, kwargs):
+    # (count, newest modification) of the rows behind the response and of
+    # the related rows they embed, once per request
+    if not hasattr(request, '_api_version'):
+        latest = {'latest': Max('modified')}
+        latest.update(('latest_%s' % i, Max(path + '__modified')) for i, path in enumerate(related))
+        totals = rows(request, **kwargs).aggregate(count=Count('pk', distinct=True), **latest)
+        times = [totals[name] for name in latest if totals[name] is not None]
+        request._api_version = (totals['count'], max(times) if times else None)
+    return request._api_version
+
+
+def endpoint(role, rows, related=(), extra=None, many=False):
+    # GET only, for users with one of the given roles, answering conditional
+    # requests from the version of rows(request, **kwargs), the `modified`
+    # of each related lookup and, when given, the string extra(request,
+    # **kwargs); many marks a list
+    def etag(request, **kwargs):
+        count, latest = _version(request, rows, related, kwargs)
+        key = '%s|%s|%s|%s|%s' % (VERSION, request.user.pk, request.get_full_path(), count,
+                                  latest.isoformat() if latest else '')
+        if extra is not None:
+            key += '|' + extra(request, **kwargs)
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def last_modified(request, **kwargs):
+        return _version(request, rows, related, kwargs)[1]
+
+    def decorator(view):
+        if extra is None and not many:
+            conditional = condition(etag_func=etag, last_modified_func=last_modified)(view)
+        else:
+            # extra has no timestamp and a list can lose rows without a newer
+            # one, so If-Modified-Since cannot be trusted
+            conditional = condition(etag_func=etag)(view)
+
+        @require_GET
+        @wraps(view)
+        def wrapper(request, **kwargs):
+            if not any(roles.has_role(request.user, name) for name in role):
+                return _error(403, 'Forbidden')
+            return conditional(request, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _limit(request):
+    try:
+        return min(max(int(request.GET.get('limit', 50)), 1), 200)
+    except ValueError:
+        return 50
+
+
+def _page(request, queryset, keyset, serialize):
+    page = KeysetPaginator(queryset, keyset, _limit(request)).page(request.GET.get('cursor'))
+    fields = _fields(request)
+    return _response({
+        'results': [_select(serialize(obj), fields) for obj in page.object_list],
+        'next': page.next_cursor,
+    })
+
+
+def _detail(request, queryset, serialize):
+    obj = queryset.first()
+    if obj is None:
+        return _error(404, 'Not found')
+    return _response(_select(serialize(obj), _fields(request)))
+
+
+ANYONE = (roles.CLINIC_MANAGER, roles.WAREHOUSE_PERSONNEL, roles.DISPATCHER)
+CLINIC_MANAGER = (roles.CLINIC_MANAGER,)
+STAFF = (roles.WAREHOUSE_PERSONNEL, roles.DISPATCHER)
+WAREHOUSE = (roles.WAREHOUSE_PERSONNEL,)
+DISPATCHER = (roles.DISPATCHER,)
+
+# orders embed their lines' item descriptions and weights
+ORDER_ITEMS = ('items__item',)
+
+
+# Serialisers.
+
+def item_data(item):
+    return {'id': item.id, 'description': item.description, 'category': item.category_id,
+            'weight': item.weight, 'imageUrl': item.imageUrl, 'modified': item.modified}
+
+
+def line_data(line):
+    return {'id': line.id, 'item': line.item_id, 'description': line.item.description,
+            'weight': line.item.weight, 'quantity': line.quantity}
+
+
+def order_data(order):
+    return {'id': order.id, 'clinic': order.clinicManager.clinic_id, 'priority': order.priority,
+            'status': order.status, 'totalWeight': order.totalWeight, 'timeOrdered': order.timeOrdered,
+            'timeDispatched': order.timeDispatched, 'timeDelivered': order.timeDelivered,
+            'items': [line_data(line) for line in order.items.all()], 'modified': order.modified}
+
+
+def load_data(load):
+    return {'id': load.id, 'orders': [order.id for order in load.orders.all()],
+            'totalWeight': weights.kilograms(weights.grams(load.total_weight or 0)),
+            'distance': load.itineraryDistance, 'modified': load.modified}
+
+
+def waypoint_data(point):
+    return {'seq': point.seq, 'place': point.place.name, 'latitude': point.place.latitude,
+            'longitude': point.place.longitude, 'altitude': point.place.altitude,
+            'leg': point.leg, 'distance': point.distance, 'eta': point.eta}
+
+
+def _orders(queryset):
+    lines = LineItem.objects.select_related('item').order_by('id')
+    return queryset.select_related('clinicManager').prefetch_related(Prefetch('items', queryset=lines))
+
+
+def _loads(queryset):
+    orders = Order.objects.order_by('priorityRank', 'timeOrdered', 'id')
+    return queryset.annotate(priority_rank=Min('orders__priorityRank'), total_weight=Sum('orders__totalWeight')) \
+        .prefetch_related(Prefetch('orders', queryset=orders))
+
+
+# Row sources.
+
+def item_rows(request, pk=None):
+    if pk is not None:
+        return Item.objects.filter(pk=pk)
+    if request.GET.get('q'):
+        return catalogue.search(request.GET['q'], rank_after(request.GET.get('cursor')), _limit(request) + 1)
+    if request.GET.get('category'):
+        return catalogue.items(category_id=request.GET['category'])
+    return Item.objects.all()
+
+
+def cart_rows(request):
+    return Cart.objects.filter(clinicManager__user=request.user, statusCode=Order.code(Order.CART))
+
+
+def order_rows(request, pk=None):
+    orders = Order.objects.exclude(statusCode=Order.code(Order.CART))
+    if not any(roles.has_role(request.user, name) for name in STAFF):
+        orders = orders.filter(clinicManager__user=request.user)
+    if pk is not None:
+        return orders.filter(pk=pk)
+    if request.GET.get('status') in Order.statusCodes:
+        orders = orders.filter(statusCode=Order.code(request.GET['status']))
+    return orders
+
+
+def queue_rows(request):
+    return Order.objects.filter(statusCode__in=[Order.code(Order.QP), Order.code(Order.PW)])
+
+
+def load_rows(request, pk=None):
+    if pk is not None:
+        return DroneLoad.objects.filter(pk=pk)
+    return planner.pending_loads()
+
+
+def itinerary_inputs(request, pk):
+    # the route is worked out again when the places, the distances or the
+    # clinics in the load change, none of which touch the load's row
+    key = DroneLoad.objects.filter(pk=pk).values_list('itineraryKey', flat=True).first()
+    return '%s|%s' % (distance_matrix.version, key)
+
+
+# Endpoints.
+
+@endpoint(ANYONE, item_rows, many=True)
+def items(request):
+    rows = item_rows(request).select_related('category')
+    keyset = ('search_rank',) if request.GET.get('q') else ('id',)
+    return _page(request, rows, keyset, item_data)
+
+
+@endpoint(ANYONE, item_rows)
+def item(request, pk):
+    return _detail(request, item_rows(request, pk), item_data)
+
+
+@endpoint(CLINIC_MANAGER, cart_rows, ORDER_ITEMS)
+def cart(request):
+    return _detail(request, _orders(cart_rows(request)), order_data)
+
+
+@endpoint(ANYONE, order_rows, ORDER_ITEMS, many=True)
+def orders(request):
+    return _page(request, _orders(order_rows(request)), ('-id',), order_data)
+
+
+@endpoint(ANYONE, order_rows, ORDER_ITEMS)
+def order(request, pk):
+    return _detail(request, _orders(order_rows(request, pk)), order_data)
+
+
+@endpoint(WAREHOUSE, queue_rows, ORDER_ITEMS, many=True)
+def queue(request):
+    return _page(request, _orders(queue_rows(request)), ('priorityRank', 'timeOrdered', 'id'), order_data)
+
+
+@endpoint(DISPATCHER, load_rows, many=True)
+def loads(request):
+    return _page(request, _loads(load_rows(request)), ('priority_rank', 'id'), load_data)
+
+
+@endpoint(DISPATCHER, load_rows)
+def load(request, pk):
+    return _detail(request, _loads(load_rows(request, pk)), load_data)
+
+
+@endpoint(DISPATCHER, load_rows, extra=itinerary_inputs)
+def itinerary(request, pk):
+    load = load_rows(request, pk).first()
+    if load is None:
+        return _error(404, 'Not found')
+    (_, points), = flightplans.flight_plans([load])
+    fields = _fields(request)
+    return _response({'load': load.pk, 'waypoints': [_select(waypoint_data(p), fields) for p in points]})
@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class AirsupplyConfig(AppConfig):
     name = 'airsupply'
+
+    def ready(self):
+        from . import distances, push, roles, search  # noqa: F401 (signal receivers)
@@ -0,0 +1,20 @@
+from django.db import connection
+
+
+# Bulk inserts whose rows are needed by id afterwards.
+#
+# bulk_create only sets the primary keys on backends that return them from a
+# bulk insert, such as PostgreSQL. On SQLite and MySQL the rows are inserted
+# one at a time instead, so that every object has its id when it is linked to
+# other rows.
+
+
+def create_with_ids(objects):
+    objects = list(objects)
+    if not objects:
+        return objects
+    if connection.features.can_return_ids_from_bulk_insert:
+        return type(objects[0]).objects.bulk_create(objects)
+    for obj in objects:
+        obj.save(force_insert=True)
+    return objects
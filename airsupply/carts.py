@@ -0,0 +1,124 @@
+import csv
+import io
+
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from . import weights
+from .bulk import create_with_ids
+from .models import Item, Order, Cart, LineItem
+
+
+# Cart operations.
+#
+# Adding an item is one conditional UPDATE that raises the cart's totalWeight
+# only while it stays within weights.ORDER_LIMIT, followed by an UPDATE of
+# the cart's line for that item (or an INSERT when there is none). The first
+# UPDATE holds the cart row until the transaction commits, so concurrent adds
+# to the same cart queue up behind it and can neither overshoot the limit nor
+# create two lines for one item.
+#
+# add_items does the same for a whole list, such as a restock list uploaded
+# as CSV or JSON or the lines of an earlier order. Every item and the new
+# total weight are checked before anything is written. Then one UPDATE
+# raises the weight, and the lines are written with bulk_update and
+# bulk.create_with_ids in the same transaction.
+
+
+def get_cart(clinic_manager):
+    return Cart.objects.get(clinicManager=clinic_manager, statusCode=Order.code(Order.CART))
+
+
+def add_item(cart, item, quantity):
+    # False when the cart would go over the weight limit
+    quantity = int(quantity)
+    if quantity <= 0:
+        raise ValueError("Quantity must be positive")
+    added_grams = weights.grams(item.weight) * quantity
+    weight = weights.kilograms(added_grams)
+    with transaction.atomic():
+        added = Order.objects.filter(pk=cart.pk, statusCode=Order.code(Order.CART),
+                                     totalWeight__lte=weights.kilograms(weights.ORDER_LIMIT - added_grams)) \
+            .update(totalWeight=F('totalWeight') + weight, modified=timezone.now())
+        if not added:
+            return False
+        if not LineItem.objects.filter(order=cart, item=item).update(quantity=F('quantity') + quantity):
+            cart.items.add(LineItem.objects.create(item=item, quantity=quantity))
+    cart.refresh_from_db(fields=['totalWeight'])
+    return True
+
+
+def remove_item(cart, line_id):
+    with transaction.atomic():
+        line = cart.items.select_for_update().select_related('item').filter(pk=line_id).first()
+        if line is None:
+            return False
+        Order.objects.filter(pk=cart.pk).update(
+            totalWeight=F('totalWeight') - weights.kilograms(weights.line_grams(line)), modified=timezone.now())
+        line.delete()
+    cart.refresh_from_db(fields=['totalWeight'])
+    return True
+
+
+def _merge(quantities):
+    # {item id: quantity} from (item id, quantity) pairs
+    merged = {}
+    for item_id, quantity in quantities:
+        try:
+            item_id, quantity = int(item_id), int(quantity)
+        except (TypeError, ValueError):
+            raise ValueError("Bad item or quantity: %s, %s" % (item_id, quantity))
+        if quantity <= 0:
+            raise ValueError("Quantity must be positive")
+        merged[item_id] = merged.get(item_id, 0) + quantity
+    if not merged:
+        raise ValueError("No items to add")
+    return merged
+
+
+def add_items(cart, quantities):
+    # adds (item id, quantity) pairs all at once; False when the cart would
+    # go over the weight limit, ValueError for unknown items or quantities
+    merged = _merge(quantities)
+    items = Item.objects.in_bulk(list(merged))
+    missing = sorted(set(merged) - set(items))
+    if missing:
+        raise ValueError("Items do not exist: %s" % ', '.join(map(str, missing)))
+    added_grams = sum(weights.grams(items[pk].weight) * quantity for pk, quantity in merged.items())
+    with transaction.atomic():
+        added = Order.objects.filter(pk=cart.pk, statusCode=Order.code(Order.CART),
+                                     totalWeight__lte=weights.kilograms(weights.ORDER_LIMIT - added_grams)) \
+            .update(totalWeight=F('totalWeight') + weights.kilograms(added_grams), modified=timezone.now())
+        if not added:
+            return False
+        existing = list(LineItem.objects.filter(order=cart, item__in=list(merged)))
+        for line in existing:
+            line.quantity += merged.pop(line.item_id)
+        LineItem.objects.bulk_update(existing, ['quantity'])
+        created = create_with_ids(LineItem(item_id=pk, quantity=quantity) for pk, quantity in sorted(merged.items()))
+        Through = Order.items.through
+        Through.objects.bulk_create([Through(order_id=cart.pk, lineitem_id=line.pk) for line in created])
+    cart.refresh_from_db(fields=['totalWeight'])
+    return True
+
+
+def copy_order(cart, order):
+    return add_items(cart, order.items.values_list('item_id', 'quantity'))
+
+
+def read_csv(text):
+    # (item id, quantity) rows; a header row is skipped
+    rows = [row for row in csv.reader(io.StringIO(text)) if any(field.strip() for field in row)]
+    if rows and not rows[0][0].strip().isdigit():
+        rows = rows[1:]
+    return [(row[0].strip(), row[1].strip() if len(row) > 1 else None) for row in rows]
+
+
+def read_json(data):
+    # [{"item": id, "qty": n}, ...], optionally wrapped in {"items": [...]}
+    if isinstance(data, dict):
+        data = data.get('items')
+    if not isinstance(data, list) or not all(isinstance(row, dict) for row in data):
+        raise ValueError("Expected a list of {\"item\": id, \"qty\": n}")
+    return [(row.get('item'), row.get('qty', row.get('quantity'))) for row in data]
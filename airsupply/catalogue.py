@@ -0,0 +1,39 @@
+from django.db.models import Count, Case, When, IntegerField
+
+from .models import Item, Category
+from .search import search_index
+
+
+# Read side of the item catalogue. Items always come with their category
+# joined in, and category sizes are counted by the database in one query.
+# Search results are not capped: a page only queries the window of matches
+# it shows, starting after the rank in its keyset cursor.
+
+
+def items(category_id=None):
+    qs = Item.objects.select_related('category').order_by('id')
+    if category_id is not None:
+        qs = qs.filter(category_id=category_id)
+    return qs
+
+
+def search(query, after=None, limit=None):
+    # matching items, best match first, annotated with their 0-based
+    # search_rank; after and limit select the ranks of one page
+    start = 0 if after is None else after + 1
+    ids = search_index.search(query)[start:]
+    if limit is not None:
+        ids = ids[:limit]
+    if not ids:
+        return Item.objects.none()
+    rank = Case(*[When(pk=pk, then=start + i) for i, pk in enumerate(ids)], output_field=IntegerField())
+    return Item.objects.select_related('category').filter(pk__in=ids) \
+        .annotate(search_rank=rank).order_by('search_rank')
+
+
+def suggest(query, limit=10):
+    return search_index.suggest(query, limit)
+
+
+def categories():
+    return Category.objects.annotate(size=Count('item')).order_by('id')
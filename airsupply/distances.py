@@ -0,0 +1,140 @@
+from array import array
+from decimal import Decimal
+import hashlib
+import math
+import threading
+import time
+
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .models import Place, InterPlaceDistance
+
+
+# Process-wide matrix of InterPlaceDistance values.
+#
+# All rows are read once into a flat array of hundredths (the model stores two
+# decimal places), indexed by the position of each Place.id. A distance that
+# is only stored in one direction is filled in for the other as well. The
+# matrix is dropped whenever a Place or InterPlaceDistance changes and is
+# reloaded on the next lookup. Saves in other processes send no signal here,
+# so the matrix is also reloaded once it is AIRSUPPLY_DISTANCE_MATRIX_TTL
+# seconds old, and the listeners are told if the table turned out to differ.
+# estimate() stands in the great-circle distance for a pair the table lacks,
+# so a route can still be planned and flown.
+
+MISSING = -1
+
+EARTH_RADIUS = 6371
+
+
+def great_circle(a, b):
+    # kilometres between two (latitude, longitude) points in degrees
+    lat1, lon1, lat2, lon2 = map(math.radians, map(float, a + b))
+    h = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(h))
+
+
+class DistanceMatrix:
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._state = None
+        self._loaded = None
+        self._listeners = []
+
+    def _fresh(self, state):
+        return state is not None and (not self.ttl or time.monotonic() - self._loaded < self.ttl)
+
+    def _load(self):
+        state = self._state
+        if self._fresh(state):
+            return state
+        with self._lock:
+            previous = self._state
+            if self._fresh(previous):
+                return previous
+            state = self._read()
+        if previous is not None and previous[3] != state[3]:
+            for listener in self._listeners:
+                listener()
+        return state
+
+    def _read(self):
+        # called with the lock held
+        digest = hashlib.sha1()
+        places = Place.objects.order_by('id').values_list('id', 'latitude', 'longitude', 'altitude')
+        index = {}
+        points = []
+        for pk, latitude, longitude, altitude in places:
+            digest.update(('%s:%s:%s:%s;' % (pk, latitude, longitude, altitude)).encode())
+            index[pk] = len(index)
+            points.append((latitude, longitude))
+        size = len(index)
+        values = array('q', [MISSING]) * (size * size)
+        for i in range(size):
+            values[i * size + i] = 0
+        rows = InterPlaceDistance.objects.order_by('id').values_list('fromLocation', 'toLocation', 'distance')
+        for fromLocation, toLocation, distance in rows:
+            digest.update(('%s:%s:%s;' % (fromLocation, toLocation, distance)).encode())
+            a, b = index[fromLocation], index[toLocation]
+            value = int(Decimal(distance) * 100)
+            values[a * size + b] = value
+            if values[b * size + a] == MISSING:
+                values[b * size + a] = value
+        self._state = (index, size, values, digest.hexdigest(), points)
+        self._loaded = time.monotonic()
+        return self._state
+
+    def invalidate(self):
+        with self._lock:
+            self._state = None
+        for listener in self._listeners:
+            listener()
+
+    def on_invalidate(self, listener):
+        self._listeners.append(listener)
+
+    @property
+    def version(self):
+        # changes whenever the places or the distance table do; a change made
+        # in another process shows up within the TTL
+        return self._load()[3]
+
+    def raw(self, fromPk, toPk):
+        # distance in hundredths, as an int, for fast and exact route sums
+        index, size, values, _, _ = self._load()
+        try:
+            value = values[index[fromPk] * size + index[toPk]]
+        except KeyError:
+            value = MISSING
+        if value == MISSING:
+            raise InterPlaceDistance.DoesNotExist(
+                "No distance between places %s and %s" % (fromPk, toPk))
+        return value
+
+    def get(self, fromPk, toPk):
+        return Decimal(self.raw(fromPk, toPk)) / 100
+
+    def estimate(self, fromPk, toPk):
+        # as raw(), but the great-circle distance when the pair is missing
+        try:
+            return self.raw(fromPk, toPk)
+        except InterPlaceDistance.DoesNotExist:
+            index, _, _, _, points = self._load()
+            if fromPk not in index or toPk not in index:
+                raise
+            return int(round(great_circle(points[index[fromPk]], points[index[toPk]]) * 100))
+
+
+distance_matrix = DistanceMatrix(ttl=getattr(settings, 'AIRSUPPLY_DISTANCE_MATRIX_TTL', 60))
+
+
+@receiver(post_save, sender=Place)
+@receiver(post_delete, sender=Place)
+@receiver(post_save, sender=InterPlaceDistance)
+@receiver(post_delete, sender=InterPlaceDistance)
+def invalidate_distance_matrix(sender, **kwargs):
+    distance_matrix.invalidate()
@@ -0,0 +1,159 @@
+from bisect import bisect_left
+
+from django.db import IntegrityError, transaction
+from django.db.models import F, Max, Sum, Value
+from django.db.models.functions import Greatest
+
+from .models import Order, OrderEvent, OrderStats, OrderLatencyBucket
+
+
+# Order history.
+#
+# Every status an order enters is appended to OrderEvent, together with the
+# time since the order's previous event and since it was ordered. The same
+# write adds the events to OrderStats and OrderLatencyBucket, which roll
+# them up per clinic, status and hour. Throughput and latency questions,
+# such as the 95th percentile from order to dispatch per clinic, are then
+# answered from those small tables instead of the orders.
+
+# upper bounds, in seconds, of the latency histogram buckets
+BUCKETS = [
+    60, 5 * 60, 15 * 60, 30 * 60,
+    3600, 2 * 3600, 4 * 3600, 8 * 3600, 12 * 3600,
+    86400, 2 * 86400, 4 * 86400, 7 * 86400,
+    float('inf'),
+]
+
+
+def bucket(seconds):
+    return bisect_left(BUCKETS, seconds)
+
+
+def hour(timestamp):
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+
+def _seconds(later, earlier):
+    if later is None or earlier is None:
+        return None
+    return max((later - earlier).total_seconds(), 0.0)
+
+
+def record(pks, status, now):
+    # called by the lifecycle once the orders have moved to status
+    rows = Order.objects.filter(pk__in=pks).values_list('pk', 'clinicManager__clinic_id', 'timeOrdered')
+    previous = dict(OrderEvent.objects.filter(order__in=pks)
+                    .values('order').annotate(last=Max('timestamp')).values_list('order', 'last'))
+    events = [
+        OrderEvent(order_id=pk, clinic_id=clinic, status=status, statusCode=Order.code(status), timestamp=now,
+                   sincePrevious=_seconds(now, previous.get(pk)), sinceOrdered=_seconds(now, ordered))
+        for pk, clinic, ordered in rows
+    ]
+    OrderEvent.objects.bulk_create(events)
+    aggregate(events)
+    return events
+
+
+def _bump(model, keys, increments, maxima=()):
+    changes = {field: F(field) + value for field, value in increments.items()}
+    changes.update({field: Greatest(F(field), Value(value)) for field, value in maxima})
+    if model.objects.filter(**keys).update(**changes):
+        return
+    try:
+        with transaction.atomic():
+            model.objects.create(**keys, **increments, **dict(maxima))
+    except IntegrityError:
+        # created by someone else in the meantime
+        model.objects.filter(**keys).update(**changes)
+
+
+def aggregate(events):
+    stats = {}
+    buckets = {}
+    for event in events:
+        key = (hour(event.timestamp), event.clinic_id, event.statusCode)
+        count, previous, ordered, longest = stats.get(key, (0, 0.0, 0.0, 0.0))
+        stats[key] = (count + 1, previous + (event.sincePrevious or 0.0), ordered + (event.sinceOrdered or 0.0),
+                      max(longest, event.sinceOrdered or 0.0))
+        if event.sinceOrdered is not None:
+            b = key + (bucket(event.sinceOrdered),)
+            buckets[b] = buckets.get(b, 0) + 1
+    for (when, clinic, code), (count, previous, ordered, longest) in stats.items():
+        _bump(OrderStats, {'hour': when, 'clinic_id': clinic, 'statusCode': code},
+              {'count': count, 'sincePreviousTotal': previous, 'sinceOrderedTotal': ordered},
+              [('sinceOrderedMax', longest)])
+    for (when, clinic, code, b), count in buckets.items():
+        _bump(OrderLatencyBucket, {'hour': when, 'clinic_id': clinic, 'statusCode': code, 'bucket': b},
+              {'count': count})
+
+
+def _window(queryset, status, since=None, clinic=None):
+    queryset = queryset.filter(statusCode=Order.code(status))
+    if since is not None:
+        queryset = queryset.filter(hour__gte=hour(since))
+    if clinic is not None:
+        queryset = queryset.filter(clinic=clinic)
+    return queryset
+
+
+def throughput(status, since=None, clinic=None):
+    # [(hour, orders that entered status)], oldest first
+    return list(_window(OrderStats.objects, status, since, clinic)
+                .values('hour').annotate(orders=Sum('count')).order_by('hour').values_list('hour', 'orders'))
+
+
+def mean_latency(status, since=None, clinic=None):
+    # average seconds from being ordered to entering status
+    totals = _window(OrderStats.objects, status, since, clinic) \
+        .aggregate(orders=Sum('count'), seconds=Sum('sinceOrderedTotal'))
+    return totals['seconds'] / totals['orders'] if totals['orders'] else None
+
+
+def percentile(status, fraction, since=None, clinic=None):
+    # upper bound, in seconds, of the bucket holding the given fraction of
+    # orders ranked by time from being ordered to entering status
+    counts = dict(_window(OrderLatencyBucket.objects, status, since, clinic)
+                  .values('bucket').annotate(orders=Sum('count')).values_list('bucket', 'orders'))
+    total = sum(counts.values())
+    if not total:
+        return None
+    seen = 0
+    for b in sorted(counts):
+        seen += counts[b]
+        if seen >= fraction * total:
+            return BUCKETS[b]
+    return BUCKETS[-1]
+
+
+def rebuild(backfill=False):
+    # recompute the roll-ups from OrderEvent; with backfill, first add events
+    # for orders from before the event log, from their timestamps
+    with transaction.atomic():
+        if backfill:
+            _backfill()
+        OrderStats.objects.all().delete()
+        OrderLatencyBucket.objects.all().delete()
+        batch = []
+        for event in OrderEvent.objects.order_by('id').iterator():
+            batch.append(event)
+            if len(batch) == 1000:
+                aggregate(batch)
+                batch = []
+        aggregate(batch)
+
+
+def _backfill():
+    statuses = [Order.QP, Order.DIS, Order.DEL]
+    events = []
+    orders = Order.objects.filter(events__isnull=True, timeOrdered__isnull=False) \
+        .values_list('pk', 'clinicManager__clinic_id', 'timeOrdered', 'timeDispatched', 'timeDelivered')
+    for pk, clinic, *times in orders.iterator():
+        previous = None
+        for status, timestamp in zip(statuses, times):
+            if timestamp is None:
+                continue
+            events.append(OrderEvent(
+                order_id=pk, clinic_id=clinic, status=status, statusCode=Order.code(status), timestamp=timestamp,
+                sincePrevious=_seconds(timestamp, previous), sinceOrdered=_seconds(timestamp, times[0])))
+            previous = timestamp
+    OrderEvent.objects.bulk_create(events, batch_size=1000)
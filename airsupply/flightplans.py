@@ -0,0 +1,196 @@
+import csv
+import json
+import struct
+from decimal import Decimal
+from xml.sax.saxutils import escape, quoteattr
+
+from django.conf import settings
+from django.http import StreamingHttpResponse
+
+from .distances import distance_matrix
+from .itineraries import load_route
+from .models import Place, InterPlaceDistance
+
+
+# Itinerary exports.
+#
+# A flight plan is the list of waypoints a drone flies for one DroneLoad:
+# from the drone port to each clinic in route order and back. Every waypoint
+# carries the length of the leg that ends there and the estimated time of
+# arrival, in minutes after take-off at AIRSUPPLY_DRONE_SPEED km/h. A leg
+# missing from the distance table is reported as unknown; the route is
+# planned, and the running distance and the ETAs counted, with the
+# great-circle distance between its ends instead. Plans are written one load at a time into a StreamingHttpResponse,
+# so exporting every pending load is a single download whose memory use does
+# not grow with it.
+#
+# Formats:
+#
+#   legacy   the original per-load download and the default there: latitude,
+#            longitude and altitude of each clinic in route order and then
+#            the drone port, without a header
+#   csv      one row per waypoint, with a header
+#   geojson  a FeatureCollection with a LineString per load and a Point per
+#            waypoint
+#   gpx      a GPX 1.1 document with one <rte> per load
+#   bin      the drone firmware's waypoint format, little endian: for each
+#            load a record header '<4sBIH' (b'ASWP', version 1, load id,
+#            waypoint count) followed by one '<iihII' per waypoint (latitude
+#            and longitude in millionths of a degree, altitude in metres,
+#            leg distance in metres, ETA in seconds). Unknown leg distances
+#            are 0xFFFFFFFF.
+
+DRONE_SPEED = getattr(settings, 'AIRSUPPLY_DRONE_SPEED', 60)
+
+BIN_MAGIC = b'ASWP'
+BIN_VERSION = 1
+BIN_HEADER = struct.Struct('<4sBIH')
+BIN_WAYPOINT = struct.Struct('<iihII')
+BIN_UNKNOWN = 0xFFFFFFFF
+
+CONTENT_TYPES = {
+    'legacy': 'text/csv',
+    'csv': 'text/csv',
+    'geojson': 'application/geo+json',
+    'gpx': 'application/gpx+xml',
+    'bin': 'application/octet-stream',
+}
+
+
+class Waypoint:
+
+    def __init__(self, seq, place, leg, distance, eta):
+        self.seq = seq
+        self.place = place
+        # kilometres, None when the leg is missing from the distance table
+        self.leg = leg
+        self.distance = distance
+        # minutes after take-off
+        self.eta = eta
+
+
+def waypoints(load, depot, places):
+    route = [depot.pk] + load_route(load, depot.pk) + [depot.pk]
+    points = [Waypoint(0, depot, Decimal(0), Decimal(0), Decimal(0))]
+    total = Decimal(0)
+    for seq, (a, b) in enumerate(zip(route, route[1:]), 1):
+        try:
+            leg = Decimal(distance_matrix.raw(a, b)) / 100
+        except InterPlaceDistance.DoesNotExist:
+            leg = None
+        total += Decimal(distance_matrix.estimate(a, b)) / 100
+        eta = (total * 60 / DRONE_SPEED).quantize(Decimal('0.1'))
+        points.append(Waypoint(seq, places[b], leg, total, eta))
+    return points
+
+
+def flight_plans(loads):
+    # yields (load, waypoints) for each load
+    places = Place.objects.in_bulk()
+    depot = next(place for place in places.values() if place.name == Place.DRONE_PORT)
+    for load in loads:
+        yield load, waypoints(load, depot, places)
+
+
+class _Echo:
+    # csv.writer target that hands each row straight back
+
+    def write(self, value):
+        return value
+
+
+def _legacy(plans):
+    writer = csv.writer(_Echo())
+    for load, points in plans:
+        for point in points[1:]:
+            place = point.place
+            yield writer.writerow([place.latitude, place.longitude, place.altitude])
+
+
+def _csv(plans):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(['load', 'waypoint', 'place', 'latitude', 'longitude', 'altitude',
+                           'leg_km', 'distance_km', 'eta_min'])
+    for load, points in plans:
+        for point in points:
+            place = point.place
+            yield writer.writerow([load.pk, point.seq, place.name, place.latitude, place.longitude,
+                                   place.altitude, point.leg, point.distance, point.eta])
+
+
+def _number(value):
+    return None if value is None else float(value)
+
+
+def _geojson(plans):
+    yield '{"type": "FeatureCollection", "features": ['
+    first = True
+    for load, points in plans:
+        features = [{
+            'type': 'Feature',
+            'geometry': {
+                'type': 'LineString',
+                'coordinates': [[float(p.place.longitude), float(p.place.latitude), p.place.altitude]
+                                for p in points],
+            },
+            'properties': {'load': load.pk, 'distance_km': _number(points[-1].distance),
+                           'duration_min': _number(points[-1].eta)},
+        }]
+        for p in points:
+            features.append({
+                'type': 'Feature',
+                'geometry': {
+                    'type': 'Point',
+                    'coordinates': [float(p.place.longitude), float(p.place.latitude), p.place.altitude],
+                },
+                'properties': {'load': load.pk, 'waypoint': p.seq, 'place': p.place.name,
+                               'leg_km': _number(p.leg), 'distance_km': _number(p.distance),
+                               'eta_min': _number(p.eta)},
+            })
+        for feature in features:
+            yield ('' if first else ', ') + json.dumps(feature)
+            first = False
+    yield ']}\n'
+
+
+def _gpx(plans):
+    yield ('<?xml version="1.0" encoding="UTF-8"?>\n'
+           '<gpx version="1.1" creator="AirSupply" xmlns="http://www.topografix.com/GPX/1/1">\n')
+    for load, points in plans:
+        parts = ['<rte><name>Drone load %s</name>\n' % load.pk]
+        for p in points:
+            desc = 'leg %s km, ETA %s min' % (p.leg, p.eta)
+            parts.append('<rtept lat=%s lon=%s><ele>%s</ele><name>%s</name><desc>%s</desc></rtept>\n' % (
+                quoteattr(str(p.place.latitude)), quoteattr(str(p.place.longitude)), p.place.altitude,
+                escape(p.place.name), escape(desc)))
+        parts.append('</rte>\n')
+        yield ''.join(parts)
+    yield '</gpx>\n'
+
+
+def _bin(plans):
+    for load, points in plans:
+        data = [BIN_HEADER.pack(BIN_MAGIC, BIN_VERSION, load.pk, len(points))]
+        for p in points:
+            data.append(BIN_WAYPOINT.pack(
+                int(p.place.latitude * 1000000), int(p.place.longitude * 1000000), p.place.altitude,
+                BIN_UNKNOWN if p.leg is None else int(p.leg * 1000),
+                BIN_UNKNOWN if p.eta is None else int(p.eta * 60)))
+        yield b''.join(data)
+
+
+WRITERS = {
+    'legacy': _legacy,
+    'csv': _csv,
+    'geojson': _geojson,
+    'gpx': _gpx,
+    'bin': _bin,
+}
+
+
+def export_response(loads, fmt, name, default='csv'):
+    if fmt not in WRITERS:
+        fmt = default
+    response = StreamingHttpResponse(WRITERS[fmt](flight_plans(loads)), content_type=CONTENT_TYPES[fmt])
+    response['Content-Disposition'] = 'attachment; filename="%s.%s"' % (name, 'csv' if fmt == 'legacy' else fmt)
+    return response
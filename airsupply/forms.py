@@ -22,7 +22,7 @@ class UserForm(forms.ModelForm):
 
 
 class ClinicManagerForm(UserForm):
-    clinicName = forms.ModelChoiceField(queryset=Place.objects.exclude(name='Queen Mary Hospital Drone Port'))
+    clinicName = forms.ModelChoiceField(queryset=Place.objects.exclude(name=Place.DRONE_PORT))
 
     class Meta:
         model = User
@@ -0,0 +1,159 @@
+from collections import OrderedDict
+import hashlib
+import threading
+
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.utils import timezone
+
+from . import jobs, routing
+from .distances import distance_matrix
+
+
+# Memoised drone routes.
+#
+# A route only depends on the clinics visited, their priorities and the
+# distance table, so it is cached under a hash of exactly those. Lookups go
+# to a bounded in-process LRU first and then, when AIRSUPPLY_ITINERARY_CACHE
+# names one, to a Django cache backend shared with other processes. The
+# distance table version is part of the key, and the LRU is also cleared
+# whenever the distance matrix is invalidated. A pair missing from the table
+# is planned at its great-circle distance, so every load gets a route.
+
+
+class ItineraryCache:
+
+    def __init__(self, size=256, backend=None, timeout=None):
+        self.size = size
+        self.backend = backend
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, depot_id, weights, version):
+        parts = ['%s' % depot_id, version]
+        parts.extend('%s:%s' % (pk, weights[pk]) for pk in sorted(weights))
+        return 'airsupply:itinerary:' + hashlib.sha1('|'.join(parts).encode()).hexdigest()
+
+    def _backend(self):
+        if self.backend is None:
+            return None
+        return caches[self.backend]
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+        backend = self._backend()
+        value = backend.get(key) if backend is not None else None
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._remember(key, value)
+        return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._remember(key, value)
+        backend = self._backend()
+        if backend is not None:
+            backend.set(key, value, self.timeout)
+
+    def _remember(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+
+itinerary_cache = ItineraryCache(
+    size=getattr(settings, 'AIRSUPPLY_ITINERARY_CACHE_SIZE', 256),
+    backend=getattr(settings, 'AIRSUPPLY_ITINERARY_CACHE', None),
+)
+distance_matrix.on_invalidate(itinerary_cache.clear)
+
+
+def clinic_weights(orders):
+    # each clinic is weighted by the priority of its first order in the load
+    weights = {}
+    for order in orders:
+        clinic = order.clinicManager.clinic_id
+        if clinic not in weights:
+            weights[clinic] = routing.PRIORITY_WEIGHTS.get(order.priority, 0)
+    return weights
+
+
+def plan_route(depot_id, weights):
+    # weights maps each clinic's Place id to its priority weight; returns the
+    # Place ids in visiting order, without the depot
+    key = itinerary_cache.key(depot_id, weights, distance_matrix.version)
+    route = itinerary_cache.get(key)
+    if route is None:
+        route = routing.solve_route(depot_id, sorted(weights), distance_matrix.estimate, weights.get)
+        itinerary_cache.set(key, route)
+    return list(route)
+
+
+# Precomputed itineraries.
+#
+# Whenever the orders in a pending DroneLoad change, a background job works
+# out its route and stores it on the load together with the cache key it was
+# computed for. A download then only has to check that key is still current.
+
+def _job_key(load_id):
+    return 'itinerary:%s' % load_id
+
+
+def _depot_id():
+    from .models import Place
+    return Place.objects.only('id').get(name=Place.DRONE_PORT).pk
+
+
+def store_itinerary(load_id):
+    from .models import DroneLoad
+    load = DroneLoad.objects.filter(pk=load_id).first()
+    if load is None:
+        return None
+    depot_id = _depot_id()
+    weights = clinic_weights(load.orders.select_related('clinicManager'))
+    key = itinerary_cache.key(depot_id, weights, distance_matrix.version)
+    route = plan_route(depot_id, weights)
+    length = routing.route_length(depot_id, route, distance_matrix.estimate)
+    DroneLoad.objects.filter(pk=load_id).update(
+        itinerary=','.join(map(str, route)),
+        itineraryDistance=Decimal(length) / 100,
+        itineraryKey=key,
+        modified=timezone.now())
+    return route
+
+
+def schedule_itinerary(load_id):
+    transaction.on_commit(lambda: jobs.submit(_job_key(load_id), store_itinerary, load_id))
+
+
+def load_route(load, depot_id):
+    weights = clinic_weights(load.orders.select_related('clinicManager'))
+    key = itinerary_cache.key(depot_id, weights, distance_matrix.version)
+    if load.itineraryKey != key and jobs.pending(_job_key(load.pk)) is not None:
+        jobs.wait(_job_key(load.pk), getattr(settings, 'AIRSUPPLY_ITINERARY_WAIT', 5))
+        load.refresh_from_db(fields=['itinerary', 'itineraryDistance', 'itineraryKey'])
+    if load.itineraryKey == key:
+        return [int(pk) for pk in load.itinerary.split(',') if pk]
+    return plan_route(depot_id, weights)
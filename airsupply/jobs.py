@@ -0,0 +1,100 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+import logging
+import threading
+
+from django.conf import settings
+from django.db import close_old_connections, connection
+
+
+# A small in-process job runner for work that should not hold up a request.
+#
+# Jobs run on a thread pool that is started on first use and lives as long as
+# the app process. Each job has a key; submitting a key that is still queued
+# returns the existing future. A key whose job is already running gets a new
+# job, which waits for the running one to finish, so it sees the latest data.
+# wait() lets a request block on a job for a bounded time. With
+# AIRSUPPLY_JOBS_INLINE set, jobs run straight away in the caller.
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_executor = None
+_futures = {}
+# key: [lock, jobs holding or waiting for it]
+_running = {}
+
+
+def _get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, 'AIRSUPPLY_JOB_WORKERS', 2),
+                thread_name_prefix='airsupply-job')
+        return _executor
+
+
+def _run(key, fn, args, kwargs):
+    # jobs with the same key never run at the same time
+    with _lock:
+        running = _running.setdefault(key, [threading.Lock(), 0])
+        running[1] += 1
+    try:
+        with running[0]:
+            close_old_connections()
+            try:
+                return fn(*args, **kwargs)
+            except Exception:
+                logger.exception("Background job %s failed", key)
+                raise
+            finally:
+                connection.close()
+    finally:
+        with _lock:
+            running[1] -= 1
+            if not running[1]:
+                del _running[key]
+
+
+def _forget(key, future):
+    with _lock:
+        if _futures.get(key) is future:
+            del _futures[key]
+
+
+def submit(key, fn, *args, **kwargs):
+    if getattr(settings, 'AIRSUPPLY_JOBS_INLINE', False):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            logger.exception("Job %s failed", key)
+            future.set_exception(e)
+        return future
+
+    executor = _get_executor()
+    with _lock:
+        future = _futures.get(key)
+        if future is not None and not future.running() and not future.done():
+            return future
+        future = executor.submit(_run, key, fn, args, kwargs)
+        _futures[key] = future
+    future.add_done_callback(lambda f: _forget(key, f))
+    return future
+
+
+def pending(key):
+    with _lock:
+        return _futures.get(key)
+
+
+def wait(key, timeout):
+    # True once the job has finished (or was never queued), False on timeout
+    future = pending(key)
+    if future is None:
+        return True
+    try:
+        future.result(timeout=timeout)
+    except Exception:
+        return future.done()
+    return True
@@ -0,0 +1,194 @@
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import threading
+import zipfile
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Prefetch
+from django.http import FileResponse, StreamingHttpResponse
+
+try:
+    from pypdf import PdfWriter
+except ImportError:  # older xhtml2pdf releases come with PyPDF2 instead
+    from PyPDF2 import PdfFileMerger as PdfWriter
+
+from . import jobs
+from .pdf import init_worker, render_label
+from .models import LineItem, ShippingLabel
+
+
+# Shipping label PDFs.
+#
+# Rendering a label through xhtml2pdf is the most expensive thing the app
+# does, so each label is rendered once and kept in the ShippingLabel table
+# together with a hash of what went into it. It is only rendered again when
+# that hash changes, i.e. when the order's line items, priority or clinic do.
+
+
+def label_context(order, lines=None):
+    # plain data only, so it can be handed to another process for rendering
+    if lines is None:
+        lines = order.items.select_related('item').order_by('id')
+    return {
+        "id": order.pk,
+        "name": order.clinicManager.clinic.name,
+        "priority": order.priority,
+        "all_items": [
+            {"item": {"id": lt.item_id, "description": lt.item.description}, "quantity": lt.quantity}
+            for lt in lines
+        ],
+    }
+
+
+def content_hash(context):
+    return hashlib.sha1(json.dumps(context, sort_keys=True).encode()).hexdigest()
+
+
+def get_label(order):
+    context = label_context(order)
+    digest = content_hash(context)
+    label = ShippingLabel.objects.filter(order=order, contentHash=digest).first()
+    if label is not None:
+        return bytes(label.pdf)
+    pdf = render_label(context)
+    if pdf is not None:
+        ShippingLabel.objects.update_or_create(order=order, defaults={'contentHash': digest, 'pdf': pdf})
+    return pdf
+
+
+def label_response(order):
+    pdf = get_label(order)
+    if pdf is None:
+        return None
+    return FileResponse(io.BytesIO(pdf), content_type='application/pdf',
+                        filename='shipping_label_%s.pdf' % order.pk)
+
+
+def _store_label(order_id):
+    from .models import Order
+    order = Order.objects.filter(pk=order_id).select_related('clinicManager__clinic').first()
+    if order is not None:
+        get_label(order)
+
+
+def schedule_label(order):
+    transaction.on_commit(lambda: jobs.submit('label:%s' % order.pk, _store_label, order.pk))
+
+
+# Bulk export.
+#
+# Labels for many orders are produced chunk by chunk: stored labels are used
+# as they are, the rest are rendered in parallel on a process pool and
+# stored. ZIP output is streamed entry by entry, so memory does not grow with
+# the number of orders. A merged PDF has to be assembled before it can be
+# written, so it is built in memory and is best kept to a DroneLoad.
+
+CHUNK = 16
+
+_pool_lock = threading.Lock()
+_pool = None
+
+
+def _get_pool():
+    global _pool
+    workers = getattr(settings, 'AIRSUPPLY_LABEL_WORKERS', os.cpu_count() or 1)
+    if workers < 2 or getattr(settings, 'AIRSUPPLY_JOBS_INLINE', False):
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                initializer=init_worker, initargs=(os.environ['DJANGO_SETTINGS_MODULE'],))
+        return _pool
+
+
+def iter_labels(orders):
+    # yields (order, pdf bytes or None) in the order of the queryset
+    pks = list(orders.values_list('pk', flat=True))
+    lines = Prefetch('items', queryset=LineItem.objects.select_related('item').order_by('id'))
+    for start in range(0, len(pks), CHUNK):
+        chunk = pks[start:start + CHUNK]
+        batch = orders.model.objects.filter(pk__in=chunk) \
+            .select_related('clinicManager__clinic').prefetch_related(lines).in_bulk()
+        stored = {label.order_id: label for label in ShippingLabel.objects.filter(order__in=chunk)}
+
+        contexts = {}
+        pdfs = {}
+        for pk in chunk:
+            context = label_context(batch[pk], batch[pk].items.all())
+            digest = content_hash(context)
+            if pk in stored and stored[pk].contentHash == digest:
+                pdfs[pk] = bytes(stored[pk].pdf)
+            else:
+                contexts[pk] = (context, digest)
+
+        pool = _get_pool()
+        missing = list(contexts)
+        rendered = (pool.map if pool is not None else map)(render_label, [contexts[pk][0] for pk in missing])
+        for pk, pdf in zip(missing, rendered):
+            pdfs[pk] = pdf
+            if pdf is not None:
+                ShippingLabel.objects.update_or_create(order_id=pk, defaults={'contentHash': contexts[pk][1], 'pdf': pdf})
+
+        for pk in chunk:
+            yield batch[pk], pdfs[pk]
+
+
+class _Sink:
+    # write-only file object that hands back whatever was written since the
+    # last call to take(); zipfile streams into it without seeking
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def stream_zip(labels):
+    sink = _Sink()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for order, pdf in labels:
+            if pdf is not None:
+                archive.writestr('shipping_label_%s.pdf' % order.pk, pdf)
+                yield sink.take()
+    yield sink.take()
+
+
+def merged_pdf(labels):
+    writer = PdfWriter()
+    for order, pdf in labels:
+        if pdf is not None:
+            writer.append(io.BytesIO(pdf))
+    result = io.BytesIO()
+    writer.write(result)
+    yield result.getvalue()
+
+
+def bulk_response(orders, fmt, name):
+    if fmt == 'pdf':
+        response = StreamingHttpResponse(merged_pdf(iter_labels(orders)), content_type='application/pdf')
+        response['Content-Disposition'] = 'attachment; filename="%s.pdf"' % name
+    else:
+        response = StreamingHttpResponse(stream_zip(iter_labels(orders)), content_type='application/zip')
+        response['Content-Disposition'] = 'attachment; filename="%s.zip"' % name
+    return response
@@ -0,0 +1,121 @@
+from django.db import transaction
+from django.dispatch import Signal
+from django.utils import timezone
+
+from . import events
+from .models import Order, DroneLoad
+
+
+# Order lifecycle.
+#
+# An order only ever moves one step forward:
+#
+#   Cart -> Queued for Processing -> Processing by Warehouse
+#        -> Queued for Dispatch -> Dispatched -> Delivered
+#
+# A transition is a single UPDATE that only matches orders still in the
+# status the step starts from, so a stale page or two people clicking at
+# once cannot move an order twice or skip a step. Many orders move in the
+# same statement. Every move is written to the order event log, and
+# entering and leaving Queued for Dispatch keeps the planner's drone loads
+# and the stored shipping labels up to date.
+
+TRANSITIONS = {
+    Order.CART: Order.QP,
+    Order.QP: Order.PW,
+    Order.PW: Order.QD,
+    Order.QD: Order.DIS,
+    Order.DIS: Order.DEL,
+}
+
+PREVIOUS = {target: source for source, target in TRANSITIONS.items()}
+
+TIMESTAMPS = {
+    Order.QP: 'timeOrdered',
+    Order.DIS: 'timeDispatched',
+    Order.DEL: 'timeDelivered',
+}
+
+
+# sent inside the transaction, after the orders have moved
+status_changed = Signal(providing_args=['pks', 'source', 'target'])
+load_dispatched = Signal(providing_args=['load', 'orders'])
+
+
+class InvalidTransition(Exception):
+    pass
+
+
+def _changes(target, now):
+    changes = {'status': target, 'statusCode': Order.code(target), 'modified': now}
+    if target in TIMESTAMPS:
+        changes[TIMESTAMPS[target]] = now
+    return changes
+
+
+def _entered(target, pks, now):
+    from . import planner
+    from .labels import schedule_label
+    events.record(pks, target, now)
+    status_changed.send(sender=Order, pks=pks, source=PREVIOUS[target], target=target)
+    if target == Order.QD:
+        for order in Order.objects.filter(pk__in=pks).select_related('clinicManager').order_by('id'):
+            schedule_label(order)
+            planner.add_order(order)
+    elif PREVIOUS[target] == Order.QD:
+        planner.remove_orders(pks)
+
+
+def advance(pks, target, now=None):
+    # moves every listed order that is one step before target; returns the
+    # ids of the orders that moved
+    if target not in PREVIOUS:
+        raise InvalidTransition("Nothing moves into %s" % target)
+    source = PREVIOUS[target]
+    now = now or timezone.now()
+    with transaction.atomic():
+        moving = list(Order.objects.select_for_update()
+                      .filter(pk__in=pks, statusCode=Order.code(source)).values_list('pk', flat=True))
+        if moving:
+            Order.objects.filter(pk__in=moving, statusCode=Order.code(source)).update(**_changes(target, now))
+            _entered(target, moving, now)
+    return moving
+
+
+def transition(order, target, now=None):
+    # moves one order, raising InvalidTransition if it is not (any longer) in
+    # the status before target
+    if TRANSITIONS.get(order.status) != target:
+        raise InvalidTransition("Order %s cannot go from %s to %s" % (order.pk, order.status, target))
+    now = now or timezone.now()
+    changes = _changes(target, now)
+    with transaction.atomic():
+        if not Order.objects.filter(pk=order.pk, statusCode=Order.code(order.status)).update(**changes):
+            raise InvalidTransition("Order %s is no longer %s" % (order.pk, order.status))
+        for field, value in changes.items():
+            setattr(order, field, value)
+        _entered(target, [order.pk], now)
+
+
+def dispatch_load(load, now=None):
+    # marks the load dispatched and moves its orders to Dispatched; raises
+    # InvalidTransition if the load was dispatched already
+    now = now or timezone.now()
+    with transaction.atomic():
+        if not DroneLoad.objects.filter(pk=load.pk, dispatched=DroneLoad.FALSE) \
+                .update(dispatched=DroneLoad.TRUE, modified=now):
+            raise InvalidTransition("Drone load %s has already been dispatched" % load.pk)
+        load.dispatched = DroneLoad.TRUE
+        orders = list(load.orders.filter(statusCode=Order.code(Order.QD))
+                      .select_related('clinicManager__user', 'clinicManager__clinic'))
+        Order.objects.filter(pk__in=[order.pk for order in orders], statusCode=Order.code(Order.QD)) \
+            .update(**_changes(Order.DIS, now))
+        pks = [order.pk for order in orders]
+        events.record(pks, Order.DIS, now)
+        for order in orders:
+            order.status = Order.DIS
+            order.statusCode = Order.code(Order.DIS)
+            order.timeDispatched = now
+        status_changed.send(sender=Order, pks=pks, source=Order.QD, target=Order.DIS)
+        load_dispatched.send(sender=DroneLoad, load=load, orders=orders)
+    return orders
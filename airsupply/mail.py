@@ -0,0 +1,129 @@
+from datetime import timedelta
+import logging
+import threading
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.utils import timezone
+
+from . import jobs
+from .labels import get_label
+from .models import QueuedEmail
+
+
+# Outbound mail queue.
+#
+# Emails are stored as QueuedEmail rows inside the request and sent later by
+# send_queued, which runs as a background job (or from the send_queued_mail
+# command). One SMTP connection is opened per batch. A message that fails is
+# retried with exponential backoff, up to MAX_ATTEMPTS times; the process
+# keeps a single timer for the next retry.
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 5
+RETRY_DELAY = 60
+BATCH_SIZE = 50
+# how long a worker may hold a message before another worker may retry it
+LEASE = timedelta(minutes=5)
+
+_retry_lock = threading.Lock()
+# (time the retry is due, timer) of the pending retry
+_retry_timer = None
+
+
+def pending(now=None):
+    now = now or timezone.now()
+    return QueuedEmail.objects.filter(
+        timeSent__isnull=True, attempts__lt=MAX_ATTEMPTS, nextAttempt__lte=now)
+
+
+def build_message(queued, connection=None):
+    email = EmailMessage(queued.subject, queued.body, to=[queued.to], connection=connection)
+    if queued.order_id is not None:
+        pdf = get_label(queued.order)
+        if pdf is not None:
+            email.attach('shipping label', pdf, 'application/pdf')
+    return email
+
+
+def _claim(queued, now):
+    # take the message for this worker; fails if another worker got it first
+    return QueuedEmail.objects.filter(pk=queued.pk, nextAttempt=queued.nextAttempt, timeSent__isnull=True) \
+        .update(nextAttempt=now + LEASE) == 1
+
+
+def _failed(queued, error):
+    attempts = queued.attempts + 1
+    QueuedEmail.objects.filter(pk=queued.pk).update(
+        attempts=attempts, lastError=str(error),
+        nextAttempt=timezone.now() + timedelta(seconds=RETRY_DELAY * 2 ** (attempts - 1)))
+
+
+def send_queued(limit=BATCH_SIZE):
+    now = timezone.now()
+    batch = list(pending(now).select_related('order__clinicManager__clinic').order_by('id')[:limit])
+    batch = [queued for queued in batch if _claim(queued, now)]
+    if not batch:
+        return 0
+
+    sent = 0
+    connection = get_connection()
+    try:
+        connection.open()
+    except Exception as e:
+        # nothing can go out; the whole batch waits for the next attempt
+        logger.warning("Opening the mail connection failed: %s", e)
+        for queued in batch:
+            _failed(queued, e)
+    else:
+        try:
+            for queued in batch:
+                try:
+                    if not connection.send_messages([build_message(queued, connection)]):
+                        raise RuntimeError("Message was not accepted")
+                except Exception as e:
+                    logger.warning("Sending email %s failed: %s", queued.pk, e)
+                    _failed(queued, e)
+                else:
+                    QueuedEmail.objects.filter(pk=queued.pk).update(
+                        attempts=queued.attempts + 1, timeSent=timezone.now(), lastError='')
+                    sent += 1
+        finally:
+            connection.close()
+
+    if sent < len(batch) or len(batch) == limit:
+        _schedule_retry()
+    return sent
+
+
+def _schedule_retry():
+    if getattr(settings, 'AIRSUPPLY_JOBS_INLINE', False):
+        return
+    retry = QueuedEmail.objects.filter(timeSent__isnull=True, attempts__lt=MAX_ATTEMPTS) \
+        .order_by('nextAttempt').values_list('nextAttempt', flat=True).first()
+    if retry is None:
+        return
+    delay = max((retry - timezone.now()).total_seconds(), 0)
+    global _retry_timer
+    with _retry_lock:
+        if _retry_timer is not None:
+            if _retry_timer[0] <= retry and _retry_timer[1].is_alive():
+                return
+            _retry_timer[1].cancel()
+        timer = threading.Timer(delay, _retry)
+        timer.daemon = True
+        _retry_timer = (retry, timer)
+        timer.start()
+
+
+def _retry():
+    global _retry_timer
+    with _retry_lock:
+        _retry_timer = None
+    jobs.submit('mail', send_queued)
+
+
+def schedule_send():
+    transaction.on_commit(lambda: jobs.submit('mail', send_queued))
@@ -0,0 +1,37 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from airsupply import events
+from airsupply.models import Order, Place
+
+
+class Command(BaseCommand):
+    help = 'Report order throughput and order-to-dispatch latency per clinic from the order event log'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=7, help='how far back to report (default 7)')
+        parser.add_argument('--status', default=Order.DIS, choices=[code for code, _ in Order.statusList],
+                            help='status to measure latency to (default Dispatched)')
+        parser.add_argument('--rebuild', action='store_true', help='recompute the hourly roll-ups first')
+        parser.add_argument('--backfill', action='store_true',
+                            help='with --rebuild, add events for older orders from their timestamps')
+
+    def handle(self, *args, **options):
+        if options['rebuild']:
+            events.rebuild(backfill=options['backfill'])
+        since = timezone.now() - timedelta(days=options['days'])
+        status = options['status']
+        self.stdout.write('%-40s %7s %10s %10s' % ('clinic', 'orders', 'mean h', 'p95 h'))
+        for clinic in Place.objects.exclude(name=Place.DRONE_PORT).order_by('name'):
+            orders = sum(count for _, count in events.throughput(status, since, clinic))
+            if not orders:
+                continue
+            self.stdout.write('%-40s %7d %10.1f %10s' % (
+                clinic.name, orders, events.mean_latency(status, since, clinic) / 3600,
+                _hours(events.percentile(status, 0.95, since, clinic))))
+
+
+def _hours(seconds):
+    return '> 7 d' if seconds == float('inf') else '%.1f' % (seconds / 3600)
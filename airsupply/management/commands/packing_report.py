@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+
+from airsupply import packing
+from airsupply.models import Order
+
+
+class Command(BaseCommand):
+    help = 'Compare drone load packing strategies on the current or a past order backlog'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help='replay every checked-out order instead of only those Queued for Dispatch')
+        parser.add_argument('--loads', action='store_true', help='list the utilisation of every load')
+
+    def handle(self, *args, **options):
+        if options['all']:
+            orders = Order.objects.exclude(statusCode=Order.code(Order.CART))
+        else:
+            orders = Order.objects.filter(statusCode=Order.code(Order.QD))
+        orders = list(orders.select_related('clinicManager'))
+        self.stdout.write('%d orders' % len(orders))
+
+        baseline = None
+        for name in packing.STRATEGIES:
+            summary = packing.report(packing.pack(orders, name))
+            if baseline is None:
+                baseline = summary['flights']
+            self.stdout.write('%-12s %4d flights  %5.1f%% utilisation  %+d flights vs first-fit  distance %s' % (
+                name, summary['flights'], summary['utilisation'] * 100,
+                summary['flights'] - baseline, summary['distance']))
+            if options['loads']:
+                for load in summary['loads']:
+                    self.stdout.write('    %5.1f%%  %s kg  distance %s  orders %s' % (
+                        load['utilisation'] * 100, load['weight'], load['distance'],
+                        ', '.join(map(str, load['orders']))))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from airsupply import packing, planner
+
+
+class Command(BaseCommand):
+    help = 'Repack all orders Queued for Dispatch into fresh drone loads'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--strategy', choices=sorted(packing.STRATEGIES), default=None)
+
+    def handle(self, *args, **options):
+        loads, summary = planner.rebuild(options['strategy'])
+        self.stdout.write('Built %d drone load%s, %.0f%% mean utilisation, total distance %s' % (
+            summary['flights'], '' if summary['flights'] == 1 else 's', summary['utilisation'] * 100,
+            summary['distance']))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from airsupply import mail
+
+
+class Command(BaseCommand):
+    help = 'Send emails waiting in the outbound mail queue'
+
+    def handle(self, *args, **options):
+        total = 0
+        while True:
+            sent = mail.send_queued()
+            total += sent
+            if sent < mail.BATCH_SIZE:
+                break
+        self.stdout.write('Sent %d email%s' % (total, '' if total == 1 else 's'))
@@ -0,0 +1,28 @@
+# Generated by Django 2.2.28 on 2026-10-18 17:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('airsupply', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='droneload',
+            name='itinerary',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='droneload',
+            name='itineraryDistance',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=100, null=True),
+        ),
+        migrations.AddField(
+            model_name='droneload',
+            name='itineraryKey',
+            field=models.CharField(blank=True, default='', max_length=100),
+        ),
+    ]
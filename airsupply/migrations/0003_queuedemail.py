@@ -0,0 +1,29 @@
+# Generated by Django 2.2.28 on 2026-10-18 17:09
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('airsupply', '0002_droneload_itinerary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueuedEmail',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('subject', models.CharField(max_length=250)),
+                ('body', models.TextField()),
+                ('to', models.CharField(max_length=250)),
+                ('attempts', models.IntegerField(default=0)),
+                ('nextAttempt', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('timeSent', models.DateTimeField(blank=True, db_index=True, null=True)),
+                ('lastError', models.TextField(blank=True, default='')),
+                ('order', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='airsupply.Order')),
+            ],
+        ),
+    ]
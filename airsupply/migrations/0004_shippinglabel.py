@@ -0,0 +1,24 @@
+# Generated by Django 2.2.28 on 2026-10-18 17:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('airsupply', '0003_queuedemail'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShippingLabel',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('contentHash', models.CharField(max_length=40)),
+                ('pdf', models.BinaryField()),
+                ('created', models.DateTimeField(auto_now=True)),
+                ('order', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='shipping_label', to='airsupply.Order')),
+            ],
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 2.2.28 on 2026-10-18 17:16
+
+from django.db import migrations, models
+
+
+def set_priority_rank(apps, schema_editor):
+    Order = apps.get_model('airsupply', 'Order')
+    for rank, priority in enumerate(['High', 'Medium', 'Low']):
+        Order.objects.filter(priority=priority).update(priorityRank=rank)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('airsupply', '0004_shippinglabel'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='priorityRank',
+            field=models.PositiveSmallIntegerField(default=3, editable=False),
+        ),
+        migrations.RunPython(set_priority_rank, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['status', 'priorityRank', 'timeOrdered'], name='order_queue_idx'),
+        ),
+    ]
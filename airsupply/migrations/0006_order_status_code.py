@@ -0,0 +1,47 @@
+# Generated by Django 2.2.28 on 2026-10-18 17:17
+
+from django.db import migrations, models
+
+
+STATUS_CODES = {
+    'Cart': 0,
+    'Queued for Processing': 1,
+    'Processing by Warehouse': 2,
+    'Queued for Dispatch': 3,
+    'Dispatched': 4,
+    'Delivered': 5,
+}
+
+
+def set_status_code(apps, schema_editor):
+    Order = apps.get_model('airsupply', 'Order')
+    for status, code in STATUS_CODES.items():
+        Order.objects.filter(status=status).update(statusCode=code)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('airsupply', '0005_order_priority_rank'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='order',
+            name='order_queue_idx',
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='statusCode',
+            field=models.SmallIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(set_status_code, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['statusCode', 'priorityRank', 'timeOrdered'], name='order_queue_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['clinicManager', 'statusCode'], name='order_clinic_status_idx'),
+        ),
+    ]
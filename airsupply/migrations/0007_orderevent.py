@@ -0,0 +1,66 @@
+# Generated by Django 2.2.28 on 2026-10-18 17:23
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('airsupply', '0006_order_status_code'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrderEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('Queued for Processing', 'Queued for Processing'), ('Processing by Warehouse', 'Processing by Warehouse'), ('Queued for Dispatch', 'Queued for Dispatch'), ('Dispatched', 'Dispatched'), ('Delivered', 'Delivered'), ('Cart', 'Cart')], max_length=100)),
+                ('statusCode', models.SmallIntegerField()),
+                ('timestamp', models.DateTimeField()),
+                ('sincePrevious', models.FloatField(blank=True, null=True)),
+                ('sinceOrdered', models.FloatField(blank=True, null=True)),
+                ('clinic', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='airsupply.Place')),
+                ('order', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='events', to='airsupply.Order')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='OrderStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hour', models.DateTimeField()),
+                ('statusCode', models.SmallIntegerField()),
+                ('count', models.IntegerField(default=0)),
+                ('sincePreviousTotal', models.FloatField(default=0)),
+                ('sinceOrderedTotal', models.FloatField(default=0)),
+                ('sinceOrderedMax', models.FloatField(default=0)),
+                ('clinic', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='airsupply.Place')),
+            ],
+            options={
+                'verbose_name_plural': 'order stats',
+                'unique_together': {('hour', 'clinic', 'statusCode')},
+            },
+        ),
+        migrations.CreateModel(
+            name='OrderLatencyBucket',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hour', models.DateTimeField()),
+                ('statusCode', models.SmallIntegerField()),
+                ('bucket', models.SmallIntegerField()),
+                ('count', models.IntegerField(default=0)),
+                ('clinic', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='airsupply.Place')),
+            ],
+            options={
+                'unique_together': {('hour', 'clinic', 'statusCode', 'bucket')},
+            },
+        ),
+        migrations.AddIndex(
+            model_name='orderevent',
+            index=models.Index(fields=['order', 'timestamp'], name='orderevent_order_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='orderevent',
+            index=models.Index(fields=['statusCode', 'clinic', 'timestamp'], name='orderevent_status_idx'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 2.2.28 on 2026-10-18 19:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('airsupply', '0008_modified'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PushEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('channel', models.CharField(max_length=20)),
+                ('data', models.TextField()),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='pushevent',
+            index=models.Index(fields=['channel', 'id'], name='pushevent_channel_idx'),
+        ),
+    ]
@@ -1,18 +1,14 @@
-from django.db import models
-from datetime import datetime
+from django.db import models, transaction
 from django.contrib.auth.models import User
 from django.db.models.signals import post_save
 from django.dispatch import receiver
-import io
 from django.http import FileResponse
 from reportlab.pdfgen import canvas
-from django.http import HttpResponse
-from django.template.loader import get_template
-from xhtml2pdf import pisa
 from django.template.loader import render_to_string
 from django.contrib.sites.shortcuts import get_current_site
-from django.core.mail import EmailMessage
-from itertools import permutations
+from django.utils import timezone
+
+from . import weights
 
 
 #debugging:
@@ -21,6 +17,8 @@ logger = logging.getLogger(__name__)
 
 
 class Place(models.Model):
+    DRONE_PORT = "Queen Mary Hospital Drone Port"
+
     name = models.CharField(max_length=100)
     latitude = models.DecimalField(max_digits=100, decimal_places=6)
     longitude = models.DecimalField(max_digits=100, decimal_places=6)
@@ -65,6 +63,7 @@ class Item(models.Model):
     category = models.ForeignKey(Category, on_delete=models.CASCADE)
     weight = models.DecimalField(max_digits=100, decimal_places=2)
     imageUrl = models.CharField(max_length=250)
+    modified = models.DateTimeField(auto_now=True, db_index=True)
 
     def __str__(self):
         return str(self.id) + ": "+self.description
@@ -79,16 +78,14 @@ class LineItem(models.Model):
 
 
 class OrderManager(models.Manager):
-    def preferred_order(self, *args, **kwargs):
-        qs = self.get_queryset().filter(*args, **kwargs)
-        qs = qs.annotate(
-            custom_order=models.Case(
-                models.When(status='High', then=models.Value(0)),
-                models.When(status='Medium', then=models.Value(1)),
-                models.When(status='Low', then=models.Value(2)),
-                default=models.Value(3),
-                output_field=models.IntegerField(), )
-        ).order_by('custom_order', '-timeOrdered')
+    def preferred_order(self, *args, limit=None, **kwargs):
+        # highest priority first, then oldest; served by the status/priority index
+        qs = self.get_queryset().filter(*args, **kwargs) \
+            .select_related('clinicManager__clinic') \
+            .prefetch_related(models.Prefetch('items', queryset=LineItem.objects.select_related('item').order_by('id'))) \
+            .order_by('priorityRank', 'timeOrdered', 'id')
+        if limit is not None:
+            qs = qs[:limit]
         return qs
 
 
@@ -98,6 +95,8 @@ class Order(models.Model):
     LOW = "Low"
     NONE = "None"
     prioList = ((HIGH, HIGH), (MEDIUM, MEDIUM), (LOW, LOW), (NONE, NONE))
+    prioRanks = {HIGH: 0, MEDIUM: 1, LOW: 2}
+    NO_RANK = 3
 
     QP = "Queued for Processing"
     PW = "Processing by Warehouse"
@@ -106,51 +105,62 @@ class Order(models.Model):
     DEL = "Delivered"
     CART = "Cart"
     statusList = ((QP, QP), (PW, PW), (QD, QD), (DIS, DIS), (DEL, DEL), (CART, CART))
+    statusCodes = {CART: 0, QP: 1, PW: 2, QD: 3, DIS: 4, DEL: 5}
 
     objects = OrderManager()
 
     items = models.ManyToManyField(LineItem, blank=True, null=True)
     clinicManager = models.ForeignKey(ClinicManager, default=3, on_delete=models.CASCADE)
     priority = models.CharField(max_length=100, choices=prioList)
+    priorityRank = models.PositiveSmallIntegerField(default=NO_RANK, editable=False)
     status = models.CharField(max_length=100, choices=statusList)
+    statusCode = models.SmallIntegerField(default=0, editable=False)
     totalWeight = models.DecimalField(max_digits=100, decimal_places=2)
     timeOrdered = models.DateTimeField(blank=True, null=True)
     timeDelivered = models.DateTimeField(blank=True, null=True)
     timeDispatched = models.DateTimeField(blank=True, null=True)
+    # set by save(); bulk updates must set it themselves
+    modified = models.DateTimeField(auto_now=True, db_index=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['statusCode', 'priorityRank', 'timeOrdered'], name='order_queue_idx'),
+            models.Index(fields=['clinicManager', 'statusCode'], name='order_clinic_status_idx'),
+        ]
 
     def __str__(self):
         return str(self.id) + ": "+self.priority + " - " + self.clinicManager.clinic.name
 
+    @staticmethod
+    def code(status):
+        return Order.statusCodes[status]
+
+    def save(self, *args, **kwargs):
+        # the integer columns are what queries filter and sort on
+        self.priorityRank = Order.prioRanks.get(self.priority, Order.NO_RANK)
+        self.statusCode = Order.code(self.status)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            extra = [name for field, name in (('priority', 'priorityRank'), ('status', 'statusCode'))
+                     if field in update_fields]
+            kwargs['update_fields'] = list(update_fields) + extra
+        super().save(*args, **kwargs)
+
     def delete_order(self):
+        if self.status == Order.QD:
+            from . import planner
+            planner.remove_order(self)
         for lt in self.items.all():
             lt.delete()
         self.delete()
 
     def update_status(self, status):
-        if status == "Dispatched":
-            self.timeDispatched = datetime.now()
-        elif status == "Queued for Processing":
-            self.timeOrdered = datetime.now()
-        elif status == "Delivered":
-            self.timeDelivered = datetime.now()
-        self.status = status
-        self.save()
+        from .lifecycle import transition
+        transition(self, status)
 
     def download_shipping(self):
-        context_dict = {
-            "id": self.pk,
-            "name": self.clinicManager.clinic.name,
-            "priority": self.priority,
-            "all_items": self.items
-        }
-        template_src = "warehouse-personnel/pdf.html"
-        template = get_template(template_src)
-        html = template.render(context_dict)
-        result = io.BytesIO()
-        pdf = pisa.pisaDocument(io.BytesIO(html.encode("ISO-8859-1")), result)
-        if not pdf.err:
-            return HttpResponse(result.getvalue(), content_type='application/pdf')
-        return None
+        from .labels import label_response
+        return label_response(self)
 
 
 class CartManager(models.Manager):
@@ -158,7 +168,7 @@ class CartManager(models.Manager):
     # correct location. right now its linking to Mui Wo
     def create_cart(self, cm):
         cart = None
-        if Cart.objects.filter(clinicManager=cm, status=Order.CART).count() == 0:
+        if not Cart.objects.filter(clinicManager=cm, statusCode=Order.code(Order.CART)).exists():
             cart = self.create(priority=Order.NONE, status=Order.CART, totalWeight=0.0, clinicManager=cm)
             cart.save()
         return cart
@@ -171,22 +181,11 @@ class Cart(Order):
         return str(self.id) + ": "+str(self.items.count()) + " - " + str(self.totalWeight)
 
     def checkTotalWeight(self, lineitem):
-        if float(self.totalWeight) + int(lineitem.quantity) * float(lineitem.item.weight) > 23.8:
-            return False
-        else:
-            return True
+        return weights.fits_order(weights.grams(self.totalWeight) + weights.line_grams(lineitem))
 
     def addLineItem(self, lineitem):
-        lineItems = self.items.all()
-        for lt in lineItems:
-            if lt.item == lineitem.item:
-                lt.quantity += int(lineitem.quantity)
-                lt.save(update_fields=['quantity'])
-                break
-        else:
-            self.items.add(lineitem)
-        self.totalWeight = float(self.totalWeight) + (int(lineitem.quantity) * float(lineitem.item.weight))
-        self.save()
+        from .carts import add_item
+        return add_item(self, lineitem.item, lineitem.quantity)
 
     def checkout(self, priority):
         try:
@@ -201,144 +200,132 @@ class Cart(Order):
 
 
 class DroneLoad(models.Model):
-    DRONE_WEIGHT = 1.2
-    DRONE_LIMIT = 25 - DRONE_WEIGHT
     TRUE = "TRUE"
     FALSE = "FALSE"
     statusList = ((TRUE, 'True'), (FALSE, 'False'))
 
     orders = models.ManyToManyField(Order, blank=True, null=True)
     dispatched = models.CharField(max_length=5, choices=statusList, default=FALSE)
+    # precomputed route, filled in by a background job (see itineraries.py)
+    itinerary = models.TextField(blank=True, default='')
+    itineraryDistance = models.DecimalField(max_digits=100, decimal_places=2, blank=True, null=True)
+    itineraryKey = models.CharField(max_length=100, blank=True, default='')
+    # set by save(); bulk updates must set it themselves
+    modified = models.DateTimeField(auto_now=True, db_index=True)
 
     def __str__(self):
         return str(self.id) #+ ": "+str(self.orders.count())+" orders"
 
     def dispatch(self, request):
-        all_orders = self.orders.all()
-        for order in all_orders:
-            self.emailCM(request, order)
-            order.update_status(Order.DIS)
-        self.dispatched = self.TRUE
-        self.save()
-
-    def get_itinerary(self):
-
-        def convert2string(places,placeDict):
-            string = ""
-            for i,place in enumerate(places):
-                letter = chr(ord("a")+i)
-                placeDict[letter] = place
-                string = string + letter
-            print("This is the converted string ",string)
-            return string
-
-        def string2Names(string,placeDict):
-            places = []
-            for letter in string:
-                places.append(placeDict[letter].name)
-            return places
-
-        def toString(List):
-            return ''.join(List)
-
-        def permute(a, l, r, perms = []):
-            if l==r:
-                perms.append(toString(a))
-            else:
-                for i in range(l, r+1):
-                    list1 = list(a)
-                    list1[l], list1[i] = list1[i], list1[l]
-                    a = toString(list1)
-                    permute(a, l+1, r, perms)
-                    list1 = list(a)
-                    list1[l], list1[i] = list1[i], list1[l] # backtrack
-
-        def calcDistance(l1, l2):
-            #print("places", l1, l2)
-            if l1 == l2:
-                return 0
-            distance = InterPlaceDistance.objects.filter(fromLocation=l1,toLocation=l2)
-            if not distance:
-                distance =  InterPlaceDistance.objects.filter(fromLocation=l2,toLocation=l1)
-            #print("distance",distance)
-
-            return distance[0].distance
-
-        def minDistance(perms,p,placeDict,orderDict):
-            minimum = float("inf")
-            path = ""
-            for perm in perms:
-                totalDistance = 0
-                for i in range(0,len(perm)):
-                    if i == 0:
-                        totalDistance += calcDistance(p,placeDict[perm[i]])
-                    elif i == (len(perm)-1):
-                        totalDistance += calcDistance(placeDict[perm[i]],p)
-                    else:
-                        totalDistance += calcDistance(placeDict[perm[i]],placeDict[perm[i+1]])
-                if totalDistance < minimum :
-                    minimum = totalDistance
-                    path = perm
-                    #print("minimum ",minimum," path ",string2Names(path,placeDict))
-                elif totalDistance == minimum :
-                    score = {}
-                    score[perm] = scoreCalculate(perm,placeDict,orderDict)
-                    score[path] = scoreCalculate(path,placeDict,orderDict)
-                    if score[perm] > score[path]:
-                        minimum = totalDistance
-                        path = perm                  
-            return path
-
-        def scoreCalculate(perm,placeDict,orderDict):
-            score = 0
-            for i in range(len(perm)):
-                if orderDict[placeDict[perm[i]]].priority == "High":
-                    score += pow(10,len(perm)-1-i)*3
-                if orderDict[placeDict[perm[i]]].priority == "Medium":
-                    score += pow(10,len(perm)-1-i)*2
-                if orderDict[placeDict[perm[i]]].priority == "Low":
-                    score += pow(10,len(perm)-1-i)*1
-            return score            
-
-        placeDict = {}
-        orderDict = {}
-        orders = self.orders.all()
-        places = []
-        newPlaces = []
-
-        p = Place.objects.get(name="Queen Mary Hospital Drone Port")
-        for order in orders:
-            newClinic = order.clinicManager.clinic
-            if newClinic not in places:
-                places.append(order.clinicManager.clinic)
-                orderDict[order.clinicManager.clinic] = order
-        string = convert2string(places, placeDict)
-        perms = [''.join(p) for p in permutations(string)]
-        path = minDistance(perms, p, placeDict, orderDict)
-        names = string2Names(path, placeDict)
-        for name in names:
-            for place in places:
-                if place.name == name:
-                    newPlaces.append(place)
-        newPlaces.append(p)
-        return newPlaces
+        from . import mail
+        from .lifecycle import dispatch_load
+        with transaction.atomic():
+            orders = dispatch_load(self)
+            QueuedEmail.objects.bulk_create([self.dispatch_email(request, order) for order in orders])
+            mail.schedule_send()
 
     def add_order(self, order):
         self.orders.add(order)
         self.save()
 
-    def emailCM(self, request, order):
+    def dispatch_email(self, request, order):
         current_site = get_current_site(request)
         user = order.clinicManager.user
-        pdf = order.download_shipping()
         message = render_to_string('email-templates/order-dispatched.html', {
             'user': user, 'domain': current_site.domain,
             'order': order,
         })
         mail_subject = 'Your Order has been dispatched!'
-        to_email = user.email
-        email = EmailMessage(mail_subject, message, to=[to_email])
-        email.attach('shipping label', pdf.content, 'application/pdf')
-        email.send()
+        return QueuedEmail(subject=mail_subject, body=message, to=user.email, order=order)
+
+
+class ShippingLabel(models.Model):
+    order = models.OneToOneField(Order, on_delete=models.CASCADE, related_name='shipping_label')
+    contentHash = models.CharField(max_length=40)
+    pdf = models.BinaryField()
+    created = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return str(self.id) + ": label for order " + str(self.order_id)
+
+
+class QueuedEmail(models.Model):
+    subject = models.CharField(max_length=250)
+    body = models.TextField()
+    to = models.CharField(max_length=250)
+    order = models.ForeignKey(Order, blank=True, null=True, on_delete=models.SET_NULL)
+    attempts = models.IntegerField(default=0)
+    nextAttempt = models.DateTimeField(default=timezone.now, db_index=True)
+    timeSent = models.DateTimeField(blank=True, null=True, db_index=True)
+    lastError = models.TextField(blank=True, default='')
+
+    def __str__(self):
+        return str(self.id) + ": " + self.subject + " -> " + self.to
 
 
+class OrderEvent(models.Model):
+    # append-only: one row per status an order enters
+    order = models.ForeignKey(Order, null=True, on_delete=models.SET_NULL, related_name='events')
+    clinic = models.ForeignKey(Place, null=True, on_delete=models.SET_NULL)
+    status = models.CharField(max_length=100, choices=Order.statusList)
+    statusCode = models.SmallIntegerField()
+    timestamp = models.DateTimeField()
+    # seconds since the order's previous event and since it was ordered
+    sincePrevious = models.FloatField(null=True, blank=True)
+    sinceOrdered = models.FloatField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['order', 'timestamp'], name='orderevent_order_idx'),
+            models.Index(fields=['statusCode', 'clinic', 'timestamp'], name='orderevent_status_idx'),
+        ]
+
+    def __str__(self):
+        return str(self.id) + ": order " + str(self.order_id) + " -> " + self.status
+
+
+class OrderStats(models.Model):
+    # orders entering a status, per clinic and hour, kept up to date as
+    # OrderEvents are written
+    hour = models.DateTimeField()
+    clinic = models.ForeignKey(Place, null=True, on_delete=models.CASCADE)
+    statusCode = models.SmallIntegerField()
+    count = models.IntegerField(default=0)
+    sincePreviousTotal = models.FloatField(default=0)
+    sinceOrderedTotal = models.FloatField(default=0)
+    sinceOrderedMax = models.FloatField(default=0)
+
+    class Meta:
+        unique_together = ('hour', 'clinic', 'statusCode')
+        verbose_name_plural = "order stats"
+
+    def __str__(self):
+        return str(self.hour) + ": " + str(self.count) + " x " + str(self.statusCode)
+
+
+class OrderLatencyBucket(models.Model):
+    # histogram of OrderEvent.sinceOrdered per clinic, hour and status, for
+    # percentiles; bucket i counts latencies up to events.BUCKETS[i] seconds
+    hour = models.DateTimeField()
+    clinic = models.ForeignKey(Place, null=True, on_delete=models.CASCADE)
+    statusCode = models.SmallIntegerField()
+    bucket = models.SmallIntegerField()
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('hour', 'clinic', 'statusCode', 'bucket')
+
+
+class PushEvent(models.Model):
+    # the newest live updates for the work queues, shared by every process
+    # (see push.py)
+    channel = models.CharField(max_length=20)
+    data = models.TextField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['channel', 'id'], name='pushevent_channel_idx'),
+        ]
+
+    def __str__(self):
+        return str(self.id) + ": " + self.channel
@@ -0,0 +1,281 @@
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import transaction
+
+from . import routing, weights
+from .bulk import create_with_ids
+from .distances import distance_matrix
+from .itineraries import plan_route, clinic_weights
+from .models import DroneLoad, Place, InterPlaceDistance
+
+
+# Packing of orders into drone loads.
+#
+# Every order weighs its totalWeight plus weights.PACKAGING_WEIGHT and a
+# load may weigh up to weights.LOAD_LIMIT, all in grams. Strategies take a list of orders
+# and return a list of bins, each a list of orders, highest priority first:
+#
+#   first-fit  the original greedy pass in priority / time order
+#   ffd        first-fit-decreasing inside each priority band
+#   best-fit   as ffd, but each order goes to the fullest load it fits in
+#   exact      fewest possible loads, for up to EXACT_LIMIT orders
+#   route-aware  groups nearby clinics so the whole fleet flies less
+
+EXACT_LIMIT = 12
+
+
+def depot():
+    return Place.objects.only('id').get(name=Place.DRONE_PORT).pk
+
+
+def clinic(order):
+    return order.clinicManager.clinic_id
+
+
+def order_weight(order):
+    return weights.order_grams(order)
+
+
+def fits(weight):
+    return weights.fits(weight)
+
+
+def priority_rank(order):
+    return order.priorityRank
+
+
+def _queue_key(order):
+    return (priority_rank(order), order.timeOrdered is None, order.timeOrdered, order.pk)
+
+
+def _band_key(order):
+    return (priority_rank(order), -order_weight(order)) + _queue_key(order)[1:]
+
+
+def _bin_key(orders):
+    return min(_queue_key(order) for order in orders)
+
+
+def first_fit(orders):
+    return first_fit_sorted(sorted(orders, key=_queue_key))
+
+
+def first_fit_decreasing(orders):
+    return first_fit_sorted(sorted(orders, key=_band_key))
+
+
+def first_fit_sorted(orders):
+    bins = []
+    weights = []
+    for order in orders:
+        weight = order_weight(order)
+        for i in range(len(bins)):
+            if fits(weights[i] + weight):
+                bins[i].append(order)
+                weights[i] += weight
+                break
+        else:
+            bins.append([order])
+            weights.append(weight)
+    return bins
+
+
+def best_fit(orders):
+    bins = []
+    weights = []
+    for order in sorted(orders, key=_band_key):
+        weight = order_weight(order)
+        best = None
+        for i in range(len(bins)):
+            if fits(weights[i] + weight) and (best is None or weights[i] > weights[best]):
+                best = i
+        if best is None:
+            bins.append([order])
+            weights.append(weight)
+        else:
+            bins[best].append(order)
+            weights[best] += weight
+    return bins
+
+
+def exact(orders):
+    if len(orders) > EXACT_LIMIT:
+        return first_fit_decreasing(orders)
+
+    items = sorted(orders, key=lambda order: -order_weight(order))
+    weights = [order_weight(order) for order in items]
+    best = [first_fit_decreasing(orders)]
+    assignment = []
+    loads = []
+
+    def search(i):
+        if len(loads) >= len(best[0]):
+            return
+        if i == len(items):
+            bins = [[] for _ in loads]
+            for order, b in zip(items, assignment):
+                bins[b].append(order)
+            best[0] = bins
+            return
+        tried = set()
+        for b in range(len(loads)):
+            if loads[b] in tried or not fits(loads[b] + weights[i]):
+                continue
+            tried.add(loads[b])
+            loads[b] += weights[i]
+            assignment.append(b)
+            search(i + 1)
+            assignment.pop()
+            loads[b] -= weights[i]
+        loads.append(weights[i])
+        assignment.append(len(loads) - 1)
+        search(i + 1)
+        assignment.pop()
+        loads.pop()
+
+    search(0)
+    return [sorted(b, key=_queue_key) for b in best[0]]
+
+
+def flight_distance(orders, depot_id=None):
+    # length of the best route for a load, in hundredths of InterPlaceDistance
+    if depot_id is None:
+        depot_id = depot()
+    route = plan_route(depot_id, clinic_weights(orders))
+    return routing.route_length(depot_id, route, distance_matrix.raw)
+
+
+class _Route:
+
+    def __init__(self, orders, band, seq, stops=None):
+        self.orders = list(orders)
+        self.band = band
+        self.seq = seq
+        self.weight = sum(order_weight(order) for order in self.orders)
+        if stops is None:
+            stops = []
+            for order in self.orders:
+                if clinic(order) not in stops:
+                    stops.append(clinic(order))
+        self.stops = stops
+
+
+def _joined(depot_id, a, b):
+    # cheapest way of flying b's stops straight after a's, in either direction
+    best = None
+    for first in (a.stops, a.stops[::-1]):
+        for second in (b.stops, b.stops[::-1]):
+            stops = first + [stop for stop in second if stop not in first]
+            length = routing.route_length(depot_id, stops, distance_matrix.raw)
+            if best is None or length < best[0]:
+                best = (length, stops)
+    return best
+
+
+def _savings(orders, depot_id):
+    # Clarke-Wright savings, one priority band at a time. Loads formed for a
+    # higher band may take on orders from lower bands, but two loads from
+    # earlier bands are never merged, so urgent orders keep their flights.
+    def length(route):
+        return routing.route_length(depot_id, route.stops, distance_matrix.raw)
+
+    bands = {}
+    for order in sorted(orders, key=_queue_key):
+        bands.setdefault(priority_rank(order), []).append(order)
+
+    routes = []
+    for band in sorted(bands):
+        for order in bands[band]:
+            routes.append(_Route([order], band, len(routes)))
+        savings = {}
+
+        def consider(a, b):
+            if a.seq > b.seq:
+                a, b = b, a
+            if band not in (a.band, b.band) or not fits(a.weight + b.weight):
+                return
+            joined, stops = _joined(depot_id, a, b)
+            savings[(a.seq, b.seq)] = (length(a) + length(b) - joined, a, b, stops)
+
+        for i, a in enumerate(routes):
+            for b in routes[i + 1:]:
+                consider(a, b)
+
+        while savings:
+            key = max(savings, key=lambda k: (savings[k][0], -k[0], -k[1]))
+            saving, a, b, stops = savings[key]
+            if saving < 0:
+                break
+            merged = _Route(a.orders + b.orders, min(a.band, b.band), a.seq, stops)
+            routes = [merged if route is a else route for route in routes if route is not b]
+            savings = {k: v for k, v in savings.items() if a.seq not in k and b.seq not in k}
+            for other in routes:
+                if other is not merged:
+                    consider(other, merged)
+
+    return [sorted(route.orders, key=_queue_key) for route in routes]
+
+
+def route_aware(orders):
+    if not orders:
+        return []
+    try:
+        return _savings(orders, depot())
+    except InterPlaceDistance.DoesNotExist:
+        # incomplete distance table, fall back to packing by weight alone
+        return first_fit_decreasing(orders)
+
+
+STRATEGIES = {
+    'first-fit': first_fit,
+    'ffd': first_fit_decreasing,
+    'best-fit': best_fit,
+    'exact': exact,
+    'route-aware': route_aware,
+}
+
+
+def default_strategy():
+    return getattr(settings, 'AIRSUPPLY_PACKING_STRATEGY', 'route-aware')
+
+
+def pack(orders, strategy=None):
+    bins = STRATEGIES[strategy or default_strategy()](list(orders))
+    return sorted(bins, key=_bin_key)
+
+
+def report(bins):
+    loads = []
+    depot_id = depot() if bins else None
+    for orders in bins:
+        weight = sum(order_weight(order) for order in orders)
+        try:
+            distance = Decimal(flight_distance(orders, depot_id)) / 100
+        except InterPlaceDistance.DoesNotExist:
+            distance = None
+        loads.append({
+            'orders': [order.pk for order in orders],
+            'weight': weights.kilograms(weight),
+            'utilisation': weight / weights.LOAD_LIMIT,
+            'distance': distance,
+        })
+    distances = [load['distance'] for load in loads]
+    return {
+        'flights': len(loads),
+        'utilisation': sum(load['utilisation'] for load in loads) / len(loads) if loads else 0.0,
+        'distance': None if None in distances else sum(distances, Decimal(0)),
+        'loads': loads,
+    }
+
+
+def build_loads(orders, strategy=None):
+    bins = pack(orders, strategy)
+    Through = DroneLoad.orders.through
+    with transaction.atomic():
+        loads = create_with_ids(DroneLoad() for _ in bins)
+        Through.objects.bulk_create([
+            Through(droneload_id=load.pk, order_id=order.pk)
+            for load, orders in zip(loads, bins) for order in orders
+        ])
+    return loads, report(bins)
@@ -0,0 +1,156 @@
+import base64
+import json
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import F, Q
+from django.http import JsonResponse
+
+
+# Keyset (cursor) pagination.
+#
+# A page is fetched with a WHERE clause that starts just after the last row
+# of the previous page instead of an OFFSET, so every page costs the same.
+# The ordering must be unique, so it should end with the primary key. Fields
+# may be model fields or annotations; prefix a field with '-' to sort it
+# descending. NULLs in nullable fields and annotations sort before every
+# value whichever the direction, so they page the same way on every database.
+# Fields that cannot be NULL are ordered plainly, so an index on them can
+# still serve the ORDER BY. The cursor is the last row's key, base64 encoded.
+
+
+def _plain(value):
+    if value is None or isinstance(value, (int, float)):
+        return value
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return str(value)
+
+
+def encode_cursor(values):
+    data = json.dumps([_plain(value) for value in values])
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()).decode())
+    except (ValueError, TypeError):
+        return None
+    return values if isinstance(values, list) else None
+
+
+def nullable(queryset, name):
+    if name in queryset.query.annotations:
+        return True
+    try:
+        field = queryset.model._meta.get_field(name)
+    except FieldDoesNotExist:
+        # pk, or a lookup through a relation
+        return name != 'pk'
+    return field.null
+
+
+def rank_after(cursor):
+    # the last rank in a cursor of a ('search_rank',) keyset, or None
+    values = decode_cursor(cursor) if cursor else None
+    if values and len(values) == 1 and isinstance(values[0], int):
+        return values[0]
+    return None
+
+
+def order_by(queryset, ordering):
+    expressions = []
+    for field in ordering:
+        name = field.lstrip('-')
+        nulls = {'nulls_first': True} if nullable(queryset, name) else {}
+        expressions.append(F(name).desc(**nulls) if field.startswith('-') else F(name).asc(**nulls))
+    return expressions
+
+
+def after(ordering, values):
+    # rows that sort after the given key: (a > x) | (a = x & b > y) | ...
+    condition = Q()
+    equal = Q()
+    for field, value in zip(ordering, values):
+        name = field.lstrip('-')
+        if value is None:
+            condition |= equal & Q(**{name + '__isnull': False})
+            equal &= Q(**{name + '__isnull': True})
+        else:
+            lookup = '__lt' if field.startswith('-') else '__gt'
+            condition |= equal & Q(**{name + lookup: value})
+            equal &= Q(**{name: value})
+    return condition
+
+
+class Page:
+
+    def __init__(self, object_list, next_cursor):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+
+
+class KeysetPaginator:
+
+    def __init__(self, queryset, ordering, per_page):
+        self.queryset = queryset
+        self.ordering = list(ordering)
+        self.per_page = per_page
+
+    def page(self, cursor=None):
+        queryset = self.queryset.order_by(*order_by(self.queryset, self.ordering))
+        values = decode_cursor(cursor) if cursor else None
+        if values is not None and len(values) == len(self.ordering):
+            queryset = queryset.filter(after(self.ordering, values))
+        rows = list(queryset[:self.per_page + 1])
+        next_cursor = None
+        if len(rows) > self.per_page:
+            rows = rows[:self.per_page]
+            last = rows[-1]
+            next_cursor = encode_cursor([getattr(last, field.lstrip('-')) for field in self.ordering])
+        return Page(rows, next_cursor)
+
+
+class KeysetPaginationMixin:
+    # for ListViews: pages object_list by self.keyset and answers
+    # ?format=json with the serialised rows and the next cursor
+    keyset = ('id',)
+    page_size = 50
+    max_page_size = 200
+
+    def get_keyset(self):
+        return self.keyset
+
+    def get_page_size(self):
+        # ?limit=N asks for a shorter or longer page, up to max_page_size
+        try:
+            limit = int(self.request.GET.get('limit', self.page_size))
+        except ValueError:
+            return self.page_size
+        return min(max(limit, 1), self.max_page_size)
+
+    def serialize(self, obj):
+        return {'id': obj.pk}
+
+    def get_context_data(self, **kwargs):
+        paginator = KeysetPaginator(self.object_list, self.get_keyset(), self.get_page_size())
+        self.page = paginator.page(self.request.GET.get('cursor'))
+        kwargs['object_list'] = self.page.object_list
+        context = super().get_context_data(**kwargs)
+        context['next_cursor'] = self.page.next_cursor
+        context['next_url'] = None
+        if self.page.next_cursor:
+            params = self.request.GET.copy()
+            params['cursor'] = self.page.next_cursor
+            params.pop('format', None)
+            context['next_url'] = '?' + params.urlencode()
+        return context
+
+    def render_to_response(self, context, **response_kwargs):
+        if self.request.GET.get('format') == 'json':
+            return JsonResponse({
+                'results': [self.serialize(obj) for obj in self.page.object_list],
+                'next': context['next_cursor'],
+            })
+        return super().render_to_response(context, **response_kwargs)
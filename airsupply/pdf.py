@@ -0,0 +1,26 @@
+import io
+import os
+
+from django.template.loader import get_template
+from xhtml2pdf import pisa
+
+
+# PDF rendering kept apart from the models, so label rendering processes can
+# import this module before Django is set up.
+
+LABEL_TEMPLATE = "warehouse-personnel/pdf.html"
+
+
+def init_worker(settings_module):
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', settings_module)
+    import django
+    django.setup()
+
+
+def render_label(context):
+    html = get_template(LABEL_TEMPLATE).render(context)
+    result = io.BytesIO()
+    pdf = pisa.pisaDocument(io.BytesIO(html.encode("ISO-8859-1")), result)
+    if pdf.err:
+        return None
+    return result.getvalue()
@@ -0,0 +1,83 @@
+from django.db import transaction
+
+from . import packing, push
+from .itineraries import schedule_itinerary
+from .models import Order, DroneLoad, InterPlaceDistance
+
+
+# Keeps the undispatched DroneLoads in step with the orders Queued for
+# Dispatch. Orders are placed into a load when they enter Order.QD and taken
+# out again when they leave it, so the dispatcher page only has to read.
+
+
+def load_weight(load):
+    return sum(packing.order_weight(order) for order in load.orders.all())
+
+
+def pending_loads():
+    return DroneLoad.objects.exclude(dispatched=DroneLoad.TRUE)
+
+
+def add_order(order):
+    with transaction.atomic():
+        if pending_loads().filter(orders=order).exists():
+            return None
+        weight = packing.order_weight(order)
+        loads = pending_loads().order_by('id').prefetch_related('orders__clinicManager')
+        candidates = [load for load in loads if packing.fits(load_weight(load) + weight)]
+        if candidates:
+            load = candidates[0]
+            if packing.default_strategy() == 'route-aware':
+                load = cheapest_load(candidates, order) or load
+            load.add_order(order)
+            schedule_itinerary(load.pk)
+            return load
+        load = DroneLoad.objects.create()
+        load.add_order(order)
+        schedule_itinerary(load.pk)
+        return load
+
+
+def cheapest_load(loads, order):
+    # the load whose flight grows the least by also visiting this clinic
+    try:
+        depot_id = packing.depot()
+        best = None
+        for load in loads:
+            orders = list(load.orders.all())
+            cost = packing.flight_distance(orders + [order], depot_id) - packing.flight_distance(orders, depot_id)
+            if best is None or cost < best[0]:
+                best = (cost, load)
+    except InterPlaceDistance.DoesNotExist:
+        return None
+    return best[1]
+
+
+def remove_order(order):
+    remove_orders([order.pk])
+
+
+def remove_orders(pks):
+    with transaction.atomic():
+        for load in pending_loads().filter(orders__in=pks).distinct():
+            load.orders.remove(*pks)
+            if load.orders.exists():
+                load.save(update_fields=['modified'])
+                schedule_itinerary(load.pk)
+            else:
+                load.delete()
+
+
+def rebuild(strategy=None):
+    # Repack every order Queued for Dispatch from scratch in one batch. Used
+    # to seed the loads for existing data; normal operation goes through
+    # add_order / remove_order.
+    with transaction.atomic():
+        pending_loads().delete()
+        orders = Order.objects.filter(statusCode=Order.code(Order.QD)).select_related('clinicManager')
+        loads, summary = packing.build_loads(orders, strategy)
+        for load in loads:
+            schedule_itinerary(load.pk)
+        # the new loads are bulk inserted, without signals
+        push.publish(push.DISPATCH_QUEUE, {'type': 'reset'})
+        return loads, summary
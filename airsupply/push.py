@@ -0,0 +1,204 @@
+import json
+import threading
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max, Min
+from django.db.models.signals import m2m_changed, post_save, post_delete
+from django.dispatch import receiver
+
+from .lifecycle import status_changed, load_dispatched
+from .models import Order, DroneLoad, PushEvent
+
+
+# Live updates for the work queues.
+#
+# Model and lifecycle signals publish small deltas, once the transaction
+# that caused them commits, into the PushEvent table, which keeps the newest
+# AIRSUPPLY_PUSH_BUFFER of them:
+#
+#   priority-queue  order_added, order_moved, order_removed
+#   dispatch-queue  load_added, load_changed, load_removed, reset
+#
+# The queue pages render the buffer's last event id and then poll
+# /push/<channel>/?after=<id> every few seconds; a poll answers straight away
+# unless AIRSUPPLY_PUSH_POLL_SECONDS allows it to wait, so no request holds a
+# worker. Other clients may ask for Server-Sent Events instead, but only
+# MAX_STREAMS streams are served at once, as each one holds a worker for up
+# to STREAM_SECONDS; beyond that they get a poll answer. The limit is per
+# process, as it guards that process's workers. A client that fell behind
+# the table gets a reset and reloads. Event ids are PushEvent ids, so a
+# client may poll or reconnect to any worker. A waiting request is woken
+# at once by events published in its own process and sees those of other
+# processes within AIRSUPPLY_PUSH_CHECK_SECONDS.
+
+PRIORITY_QUEUE = 'priority-queue'
+DISPATCH_QUEUE = 'dispatch-queue'
+CHANNELS = (PRIORITY_QUEUE, DISPATCH_QUEUE)
+
+HEARTBEAT = 15
+POLL_SECONDS = getattr(settings, 'AIRSUPPLY_PUSH_POLL_SECONDS', 0)
+STREAM_SECONDS = getattr(settings, 'AIRSUPPLY_PUSH_STREAM_SECONDS', 300)
+MAX_STREAMS = getattr(settings, 'AIRSUPPLY_PUSH_MAX_STREAMS', 2)
+CHECK_SECONDS = getattr(settings, 'AIRSUPPLY_PUSH_CHECK_SECONDS', 1)
+
+
+class EventBuffer:
+
+    def __init__(self, size=1000, interval=CHECK_SECONDS):
+        self.size = size
+        self.interval = interval
+        self._condition = threading.Condition()
+
+    @property
+    def last_id(self):
+        return PushEvent.objects.aggregate(last=Max('id'))['last'] or 0
+
+    def publish(self, channel, data):
+        pk = PushEvent.objects.create(channel=channel, data=json.dumps(data)).pk
+        PushEvent.objects.filter(id__lte=pk - self.size).delete()
+        with self._condition:
+            self._condition.notify_all()
+        return pk
+
+    def _since(self, after, channel):
+        # (events, reset) for the channel after the given id
+        bounds = PushEvent.objects.aggregate(first=Min('id'), last=Max('id'))
+        if after > (bounds['last'] or 0):
+            return [], True
+        if bounds['first'] is not None and after < bounds['first'] - 1:
+            return [], True
+        rows = PushEvent.objects.filter(channel=channel, id__gt=after).order_by('id').values_list('id', 'data')
+        return [(pk, json.loads(data)) for pk, data in rows], False
+
+    def wait(self, after, channel, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            events, reset = self._since(after, channel)
+            remaining = deadline - time.monotonic()
+            if events or reset or remaining <= 0:
+                return events, reset
+            with self._condition:
+                self._condition.wait(min(remaining, self.interval))
+
+
+buffer = EventBuffer(size=getattr(settings, 'AIRSUPPLY_PUSH_BUFFER', 1000))
+
+
+def publish(channel, data):
+    transaction.on_commit(lambda: buffer.publish(channel, data))
+
+
+def poll(channel, after, timeout=POLL_SECONDS):
+    events, reset = buffer.wait(after, channel, timeout)
+    if reset:
+        return {'reset': True, 'last': buffer.last_id, 'events': []}
+    return {
+        'reset': False,
+        'last': events[-1][0] if events else after,
+        'events': [dict(data, id=pk) for pk, data in events],
+    }
+
+
+class StreamSlots:
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.open = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self.open >= self.limit:
+                return False
+            self.open += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.open -= 1
+
+
+streams = StreamSlots(MAX_STREAMS)
+
+
+class Stream:
+    # SSE response body holding one of the stream slots until the response
+    # is closed, whether or not it was ever iterated
+
+    def __init__(self, channel, after):
+        self._events = stream(channel, after)
+        self._open = True
+
+    def __iter__(self):
+        return self._events
+
+    def close(self):
+        if self._open:
+            self._open = False
+            self._events.close()
+            streams.release()
+
+
+def open_stream(channel, after):
+    # a Stream, or None when MAX_STREAMS streams are open already
+    if not streams.acquire():
+        return None
+    return Stream(channel, after)
+
+
+def stream(channel, after, duration=STREAM_SECONDS):
+    # Server-Sent Events; the browser reconnects with Last-Event-ID when the
+    # stream ends
+    yield 'retry: 2000\n\n'
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        events, reset = buffer.wait(after, channel, min(HEARTBEAT, max(deadline - time.monotonic(), 0)))
+        if reset:
+            after = buffer.last_id
+            yield 'id: %d\nevent: reset\ndata: {}\n\n' % after
+        elif events:
+            for pk, data in events:
+                yield 'id: %d\nevent: %s\ndata: %s\n\n' % (pk, data['type'], json.dumps(data))
+            after = events[-1][0]
+        else:
+            yield ': ping\n\n'
+
+
+# Sources.
+
+@receiver(status_changed)
+def order_moved(sender, pks, source, target, **kwargs):
+    for pk in pks:
+        if target == Order.QP:
+            publish(PRIORITY_QUEUE, {'type': 'order_added', 'order': pk})
+        elif target == Order.PW:
+            publish(PRIORITY_QUEUE, {'type': 'order_moved', 'order': pk, 'status': target})
+        elif source == Order.PW:
+            publish(PRIORITY_QUEUE, {'type': 'order_removed', 'order': pk})
+
+
+@receiver(post_save, sender=DroneLoad)
+def load_saved(sender, instance, created, **kwargs):
+    if created:
+        publish(DISPATCH_QUEUE, {'type': 'load_added', 'load': instance.pk})
+
+
+@receiver(m2m_changed, sender=DroneLoad.orders.through)
+def load_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    loads = pk_set if reverse else [instance.pk]
+    for pk in loads or ():
+        publish(DISPATCH_QUEUE, {'type': 'load_changed', 'load': pk})
+
+
+@receiver(post_delete, sender=DroneLoad)
+def load_deleted(sender, instance, **kwargs):
+    publish(DISPATCH_QUEUE, {'type': 'load_removed', 'load': instance.pk})
+
+
+@receiver(load_dispatched)
+def load_gone(sender, load, **kwargs):
+    publish(DISPATCH_QUEUE, {'type': 'load_removed', 'load': load.pk})
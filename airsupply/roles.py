@@ -0,0 +1,115 @@
+from collections import OrderedDict
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User, Group
+from django.db.models.signals import m2m_changed, post_save, post_delete
+from django.dispatch import receiver
+from django.utils.functional import SimpleLazyObject
+
+
+# Role resolution.
+#
+# A user's role is the name of their group. The group names are looked up
+# once per user and kept in a bounded in-process LRU, which is cleared for a
+# user when their group membership changes through the ORM. Entries also
+# expire after AIRSUPPLY_ROLE_CACHE_TTL seconds, so a change made in another
+# process is seen within that time. A lookup that raced an invalidation is
+# returned but not stored, so it cannot outlive the change. RoleMiddleware exposes the role as
+# request.role.
+
+CLINIC_MANAGER = 'Clinic Manager'
+DISPATCHER = 'Dispatcher'
+WAREHOUSE_PERSONNEL = 'Warehouse Personnel'
+
+
+class RoleCache:
+
+    def __init__(self, size=1024, ttl=60):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # bumped by every invalidation
+        self._generation = 0
+
+    def groups(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and (not self.ttl or now - entry[0] < self.ttl):
+                self._entries.move_to_end(user_id)
+                return entry[1]
+            generation = self._generation
+        names = tuple(Group.objects.filter(user=user_id).order_by('id').values_list('name', flat=True))
+        with self._lock:
+            if self._generation != generation:
+                return names
+            self._entries[user_id] = (now, names)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        return names
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._generation += 1
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+
+role_cache = RoleCache(ttl=getattr(settings, 'AIRSUPPLY_ROLE_CACHE_TTL', 60))
+
+
+def _groups(user):
+    if not user.is_authenticated:
+        return ()
+    return role_cache.groups(user.pk)
+
+
+def get_role(user):
+    groups = _groups(user)
+    return groups[0] if groups else None
+
+
+def has_role(user, role):
+    return user.is_superuser or role in _groups(user)
+
+
+class RoleMiddleware:
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.role = SimpleLazyObject(lambda: get_role(request.user))
+        return self.get_response(request)
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+def groups_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear', 'pre_clear'):
+        return
+    if not reverse:
+        role_cache.invalidate(instance.pk)
+    elif pk_set:
+        for pk in pk_set:
+            role_cache.invalidate(pk)
+    else:
+        role_cache.clear()
+
+
+@receiver(post_save, sender=Group)
+@receiver(post_delete, sender=Group)
+def group_changed(sender, **kwargs):
+    role_cache.clear()
+
+
+@receiver(post_delete, sender=User)
+def user_deleted(sender, instance, **kwargs):
+    role_cache.invalidate(instance.pk)
@@ -0,0 +1,175 @@
+from itertools import combinations
+
+
+# Route solvers for drone itineraries.
+#
+# A route starts and ends at the depot and visits every stop exactly once.
+# Solvers are given a distance(a, b) callable and a weight(stop) callable.
+# The weight is the stop's priority score (High=3, Medium=2, Low=1); when two
+# routes are equally short, the one that visits higher-weighted stops earlier
+# wins. This is the same tie-break the old permutation search made with
+# scoreCalculate, whose base-10 score is a lexicographic comparison of the
+# weights in visiting order.
+
+EXACT_LIMIT = 10
+PRIORITY_WEIGHTS = {
+    "High": 3,
+    "Medium": 2,
+    "Low": 1,
+}
+
+
+def route_length(depot, route, distance):
+    total = 0
+    previous = depot
+    for stop in route:
+        total += distance(previous, stop)
+        previous = stop
+    if route:
+        total += distance(previous, depot)
+    return total
+
+
+class HeldKarpSolver:
+    # Exact dynamic programme over subsets, O(n^2 * 2^n).
+
+    def solve(self, depot, stops, distance, weight):
+        n = len(stops)
+        if n <= 1:
+            return list(stops)
+
+        start = [distance(depot, stop) for stop in stops]
+        dist = [[distance(a, b) for b in stops] for a in stops]
+        back = [distance(stop, depot) for stop in stops]
+        ranks = [-weight(stop) for stop in stops]
+
+        # best[(subset, last)] = (length, rank of the path, previous stop)
+        best = {}
+        for j in range(n):
+            best[(1 << j, j)] = (start[j], ((ranks[j],), (j,)), None)
+
+        for size in range(2, n + 1):
+            for subset in combinations(range(n), size):
+                bits = 0
+                for j in subset:
+                    bits |= 1 << j
+                for j in subset:
+                    rest = bits & ~(1 << j)
+                    candidate = None
+                    for k in subset:
+                        if k == j:
+                            continue
+                        length, rank, _ = best[(rest, k)]
+                        entry = (length + dist[k][j], (rank[0] + (ranks[j],), rank[1] + (j,)), k)
+                        if candidate is None or entry[:2] < candidate[:2]:
+                            candidate = entry
+                    best[(bits, j)] = candidate
+
+        full = (1 << n) - 1
+        last = None
+        closing = None
+        for j in range(n):
+            length, rank, _ = best[(full, j)]
+            entry = (length + back[j], rank)
+            if closing is None or entry < closing:
+                closing = entry
+                last = j
+
+        order = []
+        bits = full
+        while last is not None:
+            order.append(stops[last])
+            previous = best[(bits, last)][2]
+            bits &= ~(1 << last)
+            last = previous
+        order.reverse()
+        return order
+
+
+class HeuristicSolver:
+    # Nearest neighbour construction improved with 2-opt and Or-opt moves.
+    # Moves are scored by their change in length, so a pass costs O(n^2), and
+    # max_passes bounds the work for very large loads. Equal-length moves are
+    # not taken; the priority tie-break is applied when choosing neighbours.
+
+    def __init__(self, max_passes=50):
+        self.max_passes = max_passes
+
+    def solve(self, depot, stops, distance, weight):
+        nodes = [depot] + list(stops)
+        d = [[distance(a, b) if a is not b else 0 for b in nodes] for a in nodes]
+        weights = [0] + [weight(stop) for stop in stops]
+
+        symmetric = all(d[i][j] == d[j][i] for i in range(len(d)) for j in range(i))
+        tour = self.nearest_neighbour(d, weights)
+        for _ in range(self.max_passes):
+            if not (self.two_opt(tour, d, symmetric) or self.or_opt(tour, d)):
+                break
+        return [nodes[i] for i in tour[1:-1]]
+
+    def nearest_neighbour(self, d, weights):
+        remaining = list(range(1, len(d)))
+        tour = [0]
+        while remaining:
+            current = tour[-1]
+            nearest = min(remaining, key=lambda i: (d[current][i], -weights[i]))
+            remaining.remove(nearest)
+            tour.append(nearest)
+        tour.append(0)
+        return tour
+
+    def two_opt(self, tour, d, symmetric=True):
+        # reverse tour[i:j + 1]; the depot stays fixed at both ends
+        improved = False
+        for i in range(1, len(tour) - 2):
+            for j in range(i + 1, len(tour) - 1):
+                a, b, c, e = tour[i - 1], tour[i], tour[j], tour[j + 1]
+                inner = 0
+                if not symmetric:
+                    inner = sum(d[tour[k + 1]][tour[k]] - d[tour[k]][tour[k + 1]] for k in range(i, j))
+                if d[a][c] + d[b][e] + inner < d[a][b] + d[c][e]:
+                    tour[i:j + 1] = tour[i:j + 1][::-1]
+                    improved = True
+        return improved
+
+    def or_opt(self, tour, d):
+        # move a segment of one to three stops to a cheaper position
+        improved = False
+        for length in (1, 2, 3):
+            i = 1
+            while i + length < len(tour):
+                first, last = tour[i], tour[i + length - 1]
+                before, after = tour[i - 1], tour[i + length]
+                removed = d[before][first] + d[last][after] - d[before][after]
+                segment = tour[i:i + length]
+                rest = tour[:i] + tour[i + length:]
+                best, position = 0, None
+                for j in range(len(rest) - 1):
+                    gain = removed - (d[rest[j]][first] + d[last][rest[j + 1]] - d[rest[j]][rest[j + 1]])
+                    if gain > best:
+                        best, position = gain, j
+                if position is not None:
+                    tour[:] = rest[:position + 1] + segment + rest[position + 1:]
+                    improved = True
+                i += 1
+        return improved
+
+
+SOLVERS = {
+    'exact': HeldKarpSolver(),
+    'heuristic': HeuristicSolver(),
+}
+
+
+def get_solver(n):
+    if n <= EXACT_LIMIT:
+        return SOLVERS['exact']
+    return SOLVERS['heuristic']
+
+
+def solve_route(depot, stops, distance, weight, solver=None):
+    if solver is None:
+        solver = get_solver(len(stops))
+    elif isinstance(solver, str):
+        solver = SOLVERS[solver]
+    return solver.solve(depot, list(stops), distance, weight)
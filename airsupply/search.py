@@ -0,0 +1,184 @@
+from bisect import bisect_left, insort
+import math
+import re
+import threading
+import time
+
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from . import jobs
+from .models import Item, Category
+
+
+# In-process inverted index over Item.description and Category.name.
+#
+# Every word of a query is matched as a prefix of the indexed words, case
+# insensitively, and an item must match all of them. Results are ranked by
+# tf-idf, with words from the description counting more than the category
+# and whole-word matches more than prefixes. The index is built on first use
+# and kept current by the Item and Category signals. To pick up changes made
+# by other processes it is rebuilt every AIRSUPPLY_SEARCH_INDEX_TTL seconds
+# by a background job, while searches keep using the old index; changes
+# signalled during a rebuild are replayed onto the new index.
+
+WORD = re.compile(r'\w+')
+DESCRIPTION_WEIGHT = 2.0
+CATEGORY_WEIGHT = 1.0
+EXACT_BONUS = 1.5
+
+
+def tokenize(text):
+    return WORD.findall(text.casefold())
+
+
+class SearchIndex:
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._lock = threading.RLock()
+        self._built = None
+        self._postings = {}
+        self._words = []
+        self._documents = {}
+        # changes signalled while a rebuild is reading the items
+        self._changes = None
+
+    @property
+    def built(self):
+        return self._built is not None
+
+    def _ensure(self):
+        if self._built is None:
+            self.build()
+        elif self.ttl and time.monotonic() - self._built > self.ttl and self._changes is None:
+            # not already rebuilding
+            jobs.submit('search-index', self.build)
+
+    def build(self):
+        # fills a new index without holding the lock, then swaps it in
+        fresh = SearchIndex()
+        with self._lock:
+            self._changes = []
+        rows = Item.objects.values_list('id', 'description', 'category__name')
+        for pk, description, category in rows.iterator():
+            fresh._add(pk, description, category)
+        fresh._words = sorted(fresh._postings)
+        fresh._built = time.monotonic()
+        with self._lock:
+            for pk, description, category in self._changes:
+                fresh._remove(pk)
+                if description is not None:
+                    fresh._add(pk, description, category)
+            self._changes = None
+            self._postings, self._words, self._documents = fresh._postings, fresh._words, fresh._documents
+            self._built = fresh._built
+
+    def _add(self, pk, description, category):
+        weights = {}
+        for word in tokenize(description):
+            weights[word] = weights.get(word, 0) + DESCRIPTION_WEIGHT
+        for word in tokenize(category or ''):
+            weights[word] = weights.get(word, 0) + CATEGORY_WEIGHT
+        self._documents[pk] = (description, category, weights)
+        for word, weight in weights.items():
+            postings = self._postings.get(word)
+            if postings is None:
+                postings = self._postings[word] = {}
+                if self._built is not None:
+                    insort(self._words, word)
+            postings[pk] = weight
+
+    def _remove(self, pk):
+        document = self._documents.pop(pk, None)
+        if document is None:
+            return
+        for word in document[2]:
+            postings = self._postings[word]
+            postings.pop(pk, None)
+            if not postings:
+                del self._postings[word]
+                i = bisect_left(self._words, word)
+                if i < len(self._words) and self._words[i] == word:
+                    del self._words[i]
+
+    def update(self, pk, description, category):
+        with self._lock:
+            if self._changes is not None:
+                self._changes.append((pk, description, category))
+            if self._built is None:
+                return
+            self._remove(pk)
+            self._add(pk, description, category)
+
+    def remove(self, pk):
+        with self._lock:
+            if self._changes is not None:
+                self._changes.append((pk, None, None))
+            if self._built is not None:
+                self._remove(pk)
+
+    def _expand(self, prefix):
+        i = bisect_left(self._words, prefix)
+        while i < len(self._words) and self._words[i].startswith(prefix):
+            yield self._words[i]
+            i += 1
+
+    def search(self, query, limit=None):
+        # item ids, best match first
+        terms = tokenize(query)
+        if not terms:
+            return []
+        self._ensure()
+        with self._lock:
+            total = len(self._documents) or 1
+            scores = None
+            for term in terms:
+                matches = {}
+                for word in self._expand(term):
+                    postings = self._postings[word]
+                    idf = math.log(1 + total / len(postings))
+                    bonus = EXACT_BONUS if word == term else 1.0
+                    for pk, weight in postings.items():
+                        score = weight * idf * bonus
+                        if score > matches.get(pk, 0):
+                            matches[pk] = score
+                if scores is None:
+                    scores = matches
+                else:
+                    scores = {pk: scores[pk] + score for pk, score in matches.items() if pk in scores}
+                if not scores:
+                    return []
+        ranked = sorted(scores, key=lambda pk: (-scores[pk], pk))
+        return ranked[:limit] if limit else ranked
+
+    def suggest(self, query, limit=10):
+        ids = self.search(query, limit)
+        with self._lock:
+            return [
+                {'id': pk, 'description': self._documents[pk][0], 'category': self._documents[pk][1]}
+                for pk in ids if pk in self._documents
+            ]
+
+
+search_index = SearchIndex(ttl=getattr(settings, 'AIRSUPPLY_SEARCH_INDEX_TTL', 300))
+
+
+@receiver(post_save, sender=Item)
+def index_item(sender, instance, **kwargs):
+    if search_index.built:
+        search_index.update(instance.pk, instance.description, instance.category.name)
+
+
+@receiver(post_delete, sender=Item)
+def unindex_item(sender, instance, **kwargs):
+    search_index.remove(instance.pk)
+
+
+@receiver(post_save, sender=Category)
+def reindex_category(sender, instance, **kwargs):
+    if not search_index.built:
+        return
+    for pk, description in Item.objects.filter(category=instance).values_list('id', 'description'):
+        search_index.update(pk, description, instance.name)
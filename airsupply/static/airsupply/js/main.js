@@ -39,6 +39,18 @@ var BrowsePage = {
 			return false;
 		});
 
+		$('input[name="itemDesc"]').on('input', function() {
+			let query = $(this).val();
+			if (query.length < 2)
+				return;
+			$.getJSON($(this).data('autocomplete-url'), {q: query}, function(result) {
+				let $list = $('#item-suggestions').empty();
+				result.results.forEach(function(item) {
+					$list.append($('<option>').attr('value', item.description));
+				});
+			});
+		});
+
 		$('.cart_quantity_up').click((e)=>{
 			let $target = $(e.target);
             let input = $target.next("input");
@@ -86,12 +98,47 @@ let TogglePriorityQueue = {
     }
 }
 
+let LiveQueue = {
+    // polls /push/<channel>/ from the event id the page was rendered at and
+    // applies the deltas to the queue table
+    interval: 5000,
+    init: function() {
+        this.$table = $("table[data-push-url]");
+        if (!this.$table.length)
+            return;
+        this.url = this.$table.data("push-url");
+        this.poll(this.$table.data("push-after"));
+    },
+    poll: function(after) {
+        let self = this;
+        $.getJSON(this.url, {after: after}, function(result) {
+            if (result.reset)
+                self.apply({type: "reset"});
+            result.events.forEach(function(event) { self.apply(event); });
+            setTimeout(function() { self.poll(result.last); }, self.interval);
+        }).fail(function() {
+            setTimeout(function() { self.poll(after); }, self.interval);
+        });
+    },
+    apply: function(event) {
+        if (event.type === "order_removed")
+            this.$table.find("tr[data-order='" + event.order + "']").remove();
+        else if (event.type === "load_removed")
+            this.$table.find("tr[data-load='" + event.load + "']").remove();
+        else if (event.type === "order_moved")
+            this.$table.find("tr[data-order='" + event.order + "'] .process-order-btn").prop("disabled", true);
+        else
+            $(".live-notice").show();
+    }
+}
+
 /*scroll to top*/
 
 $(document).ready(function(){
 
 	BrowsePage.init();
 	TogglePriorityQueue.init();
+	LiveQueue.init();
 	$(function () {
 		$.scrollUp({
 	        scrollName: 'scrollUp', // Element ID
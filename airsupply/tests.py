@@ -1,3 +1,1184 @@
-from django.test import TestCase
+from datetime import timedelta
+from io import BytesIO, StringIO
+from itertools import permutations
+import json
+import random
+import threading
+import time
+import zipfile
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from django.core import mail as outbox
+from django.core.cache import caches
+from django.core.mail.backends.base import BaseEmailBackend
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import Min
+from django.db.migrations.executor import MigrationExecutor
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.contrib.auth.models import User, Group
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.http import http_date
+from pypdf import PdfReader, PdfWriter
+
+from . import (catalogue, events, itineraries, jobs, labels, lifecycle, mail, packing, pagination, planner, push,
+               routing, weights)
+from .distances import DistanceMatrix, distance_matrix
+from .lifecycle import InvalidTransition
+from .models import (Place, InterPlaceDistance, ClinicManager, Category, Item, Cart, LineItem, Order, DroneLoad,
+                     QueuedEmail, ShippingLabel)
+from .roles import role_cache
+from .search import SearchIndex, search_index
+
+
+def make_user(username, role, clinic=None):
+    user = User.objects.create_user(username, username + '@example.com', 'password')
+    group, _ = Group.objects.get_or_create(name=role)
+    user.groups.add(group)
+    if clinic is not None:
+        ClinicManager.objects.create(user=user, clinic=clinic)
+    return user
+
+
+class BrowseViewQueryTests(TestCase):
+    QUERY_BUDGET = 4
+
+    def setUp(self):
+        clinic = Place.objects.create(name='Mui Wo', latitude=22.26, longitude=114.0, altitude=10)
+        make_user('cm', 'Clinic Manager', clinic)
+        self.client.login(username='cm', password='password')
+        # resolve the role once, as any earlier request would have
+        self.client.get(reverse('airsupply:browse'))
+
+    def add_items(self, categories, per_category):
+        for c in range(categories):
+            category = Category.objects.create(name='Category %d' % c)
+            Item.objects.bulk_create([
+                Item(description='Item %d-%d' % (c, i), category=category, weight=1, imageUrl='')
+                for i in range(per_category)
+            ])
+
+    def test_query_count_does_not_grow_with_catalogue(self):
+        self.add_items(2, 2)
+        with self.assertNumQueries(self.QUERY_BUDGET):
+            response = self.client.get(reverse('airsupply:browse'))
+        self.assertEqual(len(response.context['all_items']), 4)
+
+        self.add_items(20, 25)
+        with self.assertNumQueries(self.QUERY_BUDGET):
+            response = self.client.get(reverse('airsupply:browse'))
+        self.assertEqual(len(response.context['all_items']), 50)
+
+    def test_cursor_walks_whole_catalogue(self):
+        self.add_items(3, 40)
+        seen = []
+        cursor = None
+        while True:
+            params = {'format': 'json'}
+            if cursor:
+                params['cursor'] = cursor
+            with self.assertNumQueries(self.QUERY_BUDGET - 1):
+                data = self.client.get(reverse('airsupply:browse'), params).json()
+            seen += [item['id'] for item in data['results']]
+            cursor = data['next']
+            if cursor is None:
+                break
+        self.assertEqual(seen, list(Item.objects.order_by('id').values_list('id', flat=True)))
+
+    def test_category_sizes(self):
+        self.add_items(3, 4)
+        category = Category.objects.first()
+        response = self.client.get(reverse('airsupply:browse_cat', args=[category.id]))
+        self.assertEqual([c.size for c in response.context['categories']], [4, 4, 4])
+        self.assertEqual(len(response.context['all_items']), 4)
+
+
+class KeysetPlanTests(TestCase):
+    # a deep page must be read off an index, not sorted from scratch
+
+    def plan(self, queryset, keyset, last):
+        page = queryset.filter(pagination.after(keyset, last)) \
+            .order_by(*pagination.order_by(queryset, keyset))[:51]
+        sql, params = page.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            return ' / '.join(row[-1] for row in cursor.fetchall())
+
+    def test_browse_and_order_list_use_the_index(self):
+        self.assertNotIn('TEMP B-TREE', self.plan(catalogue.items(), ('id',), [500]))
+        orders = Order.objects.exclude(statusCode=Order.code(Order.CART)).filter(clinicManager=1)
+        self.assertNotIn('TEMP B-TREE', self.plan(orders, ('-id',), [500]))
+
+    def test_nulls_are_only_ordered_on_nullable_fields(self):
+        queue = Order.objects.filter(statusCode=Order.code(Order.QP))
+        sql = str(queue.order_by(*pagination.order_by(queue, ('priorityRank', 'timeOrdered', 'id'))).query)
+        self.assertNotIn('"priorityRank" IS', sql)
+        self.assertNotIn('"id" IS', sql)
+        self.assertIn('"timeOrdered" IS', sql)
+        # one status is read off order_queue_idx by rank; only the orders of
+        # a rank are sorted by time, never the whole queue
+        self.assertNotIn('TEMP B-TREE FOR ORDER BY', self.plan(queue, ('priorityRank', 'timeOrdered', 'id'), [1, None, 500]))
+        loads = DroneLoad.objects.annotate(priority_rank=Min('orders__priorityRank'))
+        self.assertTrue(pagination.nullable(loads, 'priority_rank'))
+
+
+class CartTests(TestCase):
+
+    def setUp(self):
+        clinic = Place.objects.create(name='Mui Wo', latitude=22.26, longitude=114.0, altitude=10)
+        self.cm = make_user('cm', 'Clinic Manager', clinic).clinicmanager
+        self.cart = Cart.objects.create_cart(self.cm)
+        category = Category.objects.create(name='Fluids')
+        self.item = Item.objects.create(description='Saline', category=category, weight='2.50', imageUrl='')
+        self.client.login(username='cm', password='password')
+
+    def add(self, item, qty):
+        return self.client.get(reverse('airsupply:cart_add'), {'itemid': item.pk, 'qty': qty}).json()
+
+    def test_adding_an_item_again_merges_lines(self):
+        self.assertTrue(self.add(self.item, 2)['success'])
+        self.assertTrue(self.add(self.item, 3)['success'])
+        self.cart.refresh_from_db()
+        self.assertEqual([line.quantity for line in self.cart.items.all()], [5])
+        self.assertEqual(self.cart.totalWeight, Decimal('12.50'))
+        self.assertEqual(LineItem.objects.count(), 1)
+
+    def test_weight_limit(self):
+        gauze = Item.objects.create(description='Gauze', category=self.item.category, weight='0.10', imageUrl='')
+        self.assertTrue(self.add(self.item, 9)['success'])
+        self.assertFalse(self.add(self.item, 1)['success'])
+        # 22.6 kg plus packaging is a full load; 22.7 kg is not allowed
+        self.assertTrue(self.add(gauze, 1)['success'])
+        self.assertFalse(self.add(gauze, 1)['success'])
+        self.cart.refresh_from_db()
+        self.assertEqual(self.cart.totalWeight, Decimal('22.60'))
+        self.assertTrue(weights.fits(weights.order_grams(self.cart)))
+        self.assertEqual(LineItem.objects.count(), 2)
+
+    def test_removing_a_line_lowers_the_weight(self):
+        self.add(self.item, 4)
+        line = self.cart.items.get()
+        self.client.get(reverse('airsupply:remove_item', args=[self.cart.pk, line.pk]))
+        self.cart.refresh_from_db()
+        self.assertEqual(self.cart.totalWeight, 0)
+        self.assertFalse(self.cart.items.exists())
+
+    def test_import_merges_and_checks_weight_in_one_pass(self):
+        other = Item.objects.create(description='Gauze', category=self.item.category, weight='0.10', imageUrl='')
+        self.add(self.item, 1)
+        url = reverse('airsupply:cart_import')
+        lines = 'item,qty\n%s,2\n%s,5\n%s,1\n' % (self.item.pk, other.pk, self.item.pk)
+        self.assertTrue(self.client.post(url, {'lines': lines}).json()['success'])
+        self.cart.refresh_from_db()
+        self.assertEqual(sorted((line.item_id, line.quantity) for line in self.cart.items.all()),
+                         [(self.item.pk, 4), (other.pk, 5)])
+        self.assertEqual(self.cart.totalWeight, Decimal('10.50'))
+        too_heavy = json.dumps([{'item': other.pk, 'qty': 1}, {'item': self.item.pk, 'qty': 6}])
+        self.assertFalse(self.client.post(url, too_heavy, content_type='application/json').json()['success'])
+        self.assertFalse(self.client.post(url, {'lines': '%s,1\n999,1' % other.pk}).json()['success'])
+        self.cart.refresh_from_db()
+        self.assertEqual(self.cart.totalWeight, Decimal('10.50'))
+        self.assertEqual(LineItem.objects.count(), 2)
+
+    def test_copy_previous_order(self):
+        self.add(self.item, 3)
+        order_pk = self.cart.pk
+        self.cart.checkout(Order.HIGH)
+        cart = Cart.objects.create_cart(self.cm)
+        response = self.client.post(reverse('airsupply:cart_import'), {'order': order_pk})
+        self.assertEqual(response.json(), {'success': True, 'totalWeight': '7.50'})
+        self.assertEqual([line.quantity for line in cart.items.all()], [3])
+
+
+class RoleCacheTests(TestCase):
+
+    def setUp(self):
+        role_cache.clear()
+        make_user('wp', 'Warehouse Personnel')
+        self.client.login(username='wp', password='password')
+
+    def test_role_is_looked_up_once(self):
+        self.client.get(reverse('airsupply:priority_queue'))
+        with self.assertNumQueries(4):
+            # session, user, the last push event and the queue page; no
+            # groups query
+            response = self.client.get(reverse('airsupply:priority_queue'))
+        self.assertEqual(response.status_code, 200)
+
+    def test_group_change_takes_effect(self):
+        self.assertEqual(self.client.get(reverse('airsupply:priority_queue')).status_code, 200)
+        user = User.objects.get(username='wp')
+        user.groups.clear()
+        user.groups.add(Group.objects.get_or_create(name='Dispatcher')[0])
+        self.assertEqual(self.client.get(reverse('airsupply:priority_queue')).status_code, 403)
+        self.assertEqual(self.client.get(reverse('airsupply:dispatch_view')).status_code, 200)
+
+    def test_lookup_racing_an_invalidation_is_not_stored(self):
+        user = User.objects.get(username='wp')
+        filter = Group.objects.filter
+
+        def change_groups_meanwhile(*args, **kwargs):
+            # the groups are read, then changed before the result is stored
+            rows = list(filter(*args, **kwargs).order_by('id').values_list('name', flat=True))
+            user.groups.set([Group.objects.get_or_create(name='Dispatcher')[0]])
+            return mock.Mock(**{'order_by.return_value.values_list.return_value': rows})
+
+        with mock.patch.object(Group.objects, 'filter', side_effect=change_groups_meanwhile):
+            self.assertEqual(role_cache.groups(user.pk), ('Warehouse Personnel',))
+        self.assertEqual(role_cache.groups(user.pk), ('Dispatcher',))
+
+
+class DispatchViewQueryTests(TestCase):
+    # session, user, the last push event, loads with their totals, and the
+    # loads' orders
+    QUERY_BUDGET = 5
+
+    def setUp(self):
+        clinic = Place.objects.create(name='Mui Wo', latitude=22.26, longitude=114.0, altitude=10)
+        self.cm = make_user('cm', 'Clinic Manager', clinic).clinicmanager
+        make_user('disp', 'Dispatcher')
+        self.client.login(username='disp', password='password')
+        self.client.get(reverse('airsupply:dispatch_view'))
+
+    def add_loads(self, count):
+        for i in range(count):
+            load = DroneLoad.objects.create()
+            for priority in (Order.LOW, Order.HIGH):
+                load.orders.add(Order.objects.create(
+                    clinicManager=self.cm, priority=priority, status=Order.QD, totalWeight='2.25'))
+
+    def test_query_count_does_not_grow_with_loads(self):
+        self.add_loads(2)
+        with self.assertNumQueries(self.QUERY_BUDGET):
+            response = self.client.get(reverse('airsupply:dispatch_view'))
+        self.assertEqual(len(response.context['all_droneloads']), 2)
+        self.assertContains(response, '4.50 kg')
+
+        self.add_loads(198)
+        with self.assertNumQueries(self.QUERY_BUDGET):
+            response = self.client.get(reverse('airsupply:dispatch_view'))
+        self.assertEqual(len(response.context['all_droneloads']), 50)
+
+
+class LifecycleTests(TestCase):
+
+    def setUp(self):
+        clinic = Place.objects.create(name='Mui Wo', latitude=22.26, longitude=114.0, altitude=10)
+        self.cm = make_user('cm', 'Clinic Manager', clinic).clinicmanager
+
+    def test_steps_cannot_be_skipped(self):
+        order = Order.objects.create(clinicManager=self.cm, priority=Order.HIGH, status=Order.QP, totalWeight=1)
+        with self.assertRaises(InvalidTransition):
+            order.update_status(Order.DIS)
+        order.update_status(Order.PW)
+        order.refresh_from_db()
+        self.assertEqual(order.status, Order.PW)
+
+    def test_stale_order_is_not_moved_twice(self):
+        order = Order.objects.create(clinicManager=self.cm, priority=Order.HIGH, status=Order.QP, totalWeight=1)
+        stale = Order.objects.get(pk=order.pk)
+        order.update_status(Order.PW)
+        with self.assertRaises(InvalidTransition):
+            stale.update_status(Order.PW)
+
+    def test_load_is_dispatched_once(self):
+        load = DroneLoad.objects.create(dispatched=DroneLoad.FALSE)
+        for _ in range(3):
+            load.orders.add(Order.objects.create(
+                clinicManager=self.cm, priority=Order.LOW, status=Order.QD, totalWeight=1))
+        request = RequestFactory().get('/')
+        load.dispatch(request)
+        with self.assertRaises(InvalidTransition):
+            DroneLoad.objects.get(pk=load.pk).dispatch(request)
+        self.assertEqual(Order.objects.filter(status=Order.DIS, timeDispatched__isnull=False).count(), 3)
+        self.assertEqual(QueuedEmail.objects.count(), 3)
+
+    def test_preferred_order(self):
+        now = timezone.now()
+        created = [
+            (Order.NONE, now - timedelta(hours=3)),
+            (Order.LOW, now - timedelta(hours=2)),
+            (Order.HIGH, now),
+            (Order.MEDIUM, now - timedelta(hours=1)),
+            (Order.HIGH, now - timedelta(hours=1)),
+            (Order.HIGH, now),
+        ]
+        pks = [Order.objects.create(clinicManager=self.cm, priority=priority, status=Order.QP, totalWeight=1,
+                                    timeOrdered=time).pk
+               for priority, time in created]
+        # High, Medium, Low, then no priority; oldest first, then by id
+        self.assertEqual([order.pk for order in Order.objects.preferred_order(statusCode=Order.code(Order.QP))],
+                         [pks[4], pks[2], pks[5], pks[3], pks[1], pks[0]])
+        self.assertEqual(Order.objects.get(pk=pks[0]).priorityRank, Order.NO_RANK)
+        self.assertEqual(len(Order.objects.preferred_order(limit=2)), 2)
+
+    def test_unknown_status_is_not_stored(self):
+        with self.assertRaises(KeyError):
+            Order.objects.create(clinicManager=self.cm, priority=Order.HIGH, status='Lost', totalWeight=1)
+        self.assertFalse(Order.objects.exists())
+
+    def test_transitions_are_logged_and_rolled_up(self):
+        start = timezone.now()
+        order = Order.objects.create(clinicManager=self.cm, priority=Order.HIGH, status=Order.CART, totalWeight=1)
+        order.update_status(Order.QP)
+        lifecycle.advance([order.pk], Order.PW, now=start + timedelta(minutes=10))
+        lifecycle.advance([order.pk], Order.QD, now=start + timedelta(hours=3))
+        self.assertEqual(list(order.events.order_by('id').values_list('status', flat=True)),
+                         [Order.QP, Order.PW, Order.QD])
+        self.assertEqual(events.throughput(Order.QD, clinic=self.cm.clinic)[0][1], 1)
+        self.assertEqual(events.percentile(Order.QD, 0.95), 4 * 3600)
+        self.assertAlmostEqual(order.events.get(status=Order.QD).sincePrevious, 170 * 60, delta=1)
+
+
+class ApiTests(TestCase):
+
+    def setUp(self):
+        clinic = Place.objects.create(name='Mui Wo', latitude=22.26, longitude=114.0, altitude=10)
+        self.cm = make_user('cm', 'Clinic Manager', clinic).clinicmanager
+        self.cart = Cart.objects.create_cart(self.cm)
+        category = Category.objects.create(name='Fluids')
+        self.item = Item.objects.create(description='Saline', category=category, weight='2.50', imageUrl='')
+        self.client.login(username='cm', password='password')
+
+    def test_cart_is_revalidated_with_etag(self):
+        url = reverse('airsupply:api_cart')
+        response = self.client.get(url, {'fields': 'id,totalWeight'})
+        self.assertEqual(response.json(), {'id': self.cart.pk, 'totalWeight': '0.00'})
+        etag = response['ETag']
+        self.assertEqual(self.client.get(url, {'fields': 'id,totalWeight'}, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.client.get(reverse('airsupply:cart_add'), {'itemid': self.item.pk, 'qty': 2})
+        response = self.client.get(url, {'fields': 'id,totalWeight'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['totalWeight'], '5.00')
+
+    def test_queue_needs_warehouse_role(self):
+        self.assertEqual(self.client.get(reverse('airsupply:api_queue')).status_code, 403)
+
+    def test_cart_is_revalidated_when_an_item_changes(self):
+        self.client.get(reverse('airsupply:cart_add'), {'itemid': self.item.pk, 'qty': 2})
+        url = reverse('airsupply:api_cart')
+        etag = self.client.get(url)['ETag']
+        self.item.description = 'Saline 500ml'
+        self.item.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['items'][0]['description'], 'Saline 500ml')
+
+    def test_list_is_revalidated_when_a_row_leaves_it(self):
+        orders = [Order.objects.create(clinicManager=self.cm, priority=Order.HIGH, status=Order.QP, totalWeight=1)
+                  for _ in range(2)]
+        make_user('wp', 'Warehouse Personnel')
+        self.client.login(username='wp', password='password')
+        url = reverse('airsupply:api_queue')
+        response = self.client.get(url)
+        self.assertNotIn('Last-Modified', response)
+        etag = response['ETag']
+        # what the old Last-Modified of the list would have told the client
+        since = http_date(time.time())
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        # an order leaves the queue; no row left in it is any newer
+        lifecycle.advance([orders[1].pk], Order.PW)
+        lifecycle.advance([orders[1].pk], Order.QD)
+        for headers in ({'HTTP_IF_NONE_MATCH': etag}, {'HTTP_IF_MODIFIED_SINCE': since}):
+            response = self.client.get(url, **headers)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual([order['id'] for order in response.json()['results']], [orders[0].pk])
+
+    def test_itinerary_is_revalidated_when_a_distance_changes(self):
+        port = Place.objects.create(name=Place.DRONE_PORT, latitude=22.27, longitude=114.13, altitude=0)
+        clinic = self.cm.clinic
+        leg = InterPlaceDistance.objects.create(fromLocation=port, toLocation=clinic, distance=5)
+        load = DroneLoad.objects.create()
+        load.orders.add(Order.objects.create(clinicManager=self.cm, priority=Order.HIGH, status=Order.QD,
+                                             totalWeight=1))
+        make_user('dispatcher', 'Dispatcher')
+        self.client.login(username='dispatcher', password='password')
+        url = reverse('airsupply:api_itinerary', args=[load.pk])
+        response = self.client.get(url, {'fields': 'distance'})
+        self.assertNotIn('Last-Modified', response)
+        etag = response['ETag']
+        self.assertEqual(self.client.get(url, {'fields': 'distance'}, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        leg.distance = 7
+        leg.save()
+        response = self.client.get(url, {'fields': 'distance'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['waypoints'][-1], {'distance': '14'})
+
+
+class FailingBackend(BaseEmailBackend):
+
+    def send_messages(self, messages):
+        raise ConnectionError('SMTP server went away')
+
+
+class UnreachableBackend(BaseEmailBackend):
+
+    def open(self):
+        raise ConnectionRefusedError('SMTP server is down')
+
+    def send_messages(self, messages):
+        raise AssertionError('sent without a connection')
+
+
+@override_settings(AIRSUPPLY_JOBS_INLINE=True)
+class MailQueueTests(TestCase):
+
+    def queue(self, count=1):
+        return [QueuedEmail.objects.create(subject='Dispatched', body='On its way', to='cm@example.com')
+                for _ in range(count)]
+
+    def test_batch_is_sent(self):
+        self.queue(3)
+        self.assertEqual(mail.send_queued(), 3)
+        self.assertEqual(len(outbox.outbox), 3)
+        self.assertEqual(QueuedEmail.objects.filter(timeSent__isnull=False, attempts=1).count(), 3)
+        self.assertEqual(mail.send_queued(), 0)
+
+    @override_settings(EMAIL_BACKEND='airsupply.tests.FailingBackend')
+    def test_failure_is_retried_later(self):
+        queued, = self.queue()
+        before = timezone.now()
+        self.assertEqual(mail.send_queued(), 0)
+        queued.refresh_from_db()
+        self.assertEqual(queued.attempts, 1)
+        self.assertIsNone(queued.timeSent)
+        self.assertIn('went away', queued.lastError)
+        self.assertGreaterEqual(queued.nextAttempt, before + timedelta(seconds=mail.RETRY_DELAY))
+        self.assertFalse(mail.pending().exists())
+
+    @override_settings(EMAIL_BACKEND='airsupply.tests.UnreachableBackend')
+    def test_unreachable_server_is_recorded_and_retried(self):
+        self.queue(2)
+        before = timezone.now()
+        with mock.patch.object(mail, '_schedule_retry') as schedule_retry:
+            self.assertEqual(mail.send_queued(), 0)
+        self.assertTrue(schedule_retry.called)
+        for queued in QueuedEmail.objects.all():
+            self.assertEqual(queued.attempts, 1)
+            self.assertIsNone(queued.timeSent)
+            self.assertIn('is down', queued.lastError)
+            self.assertGreaterEqual(queued.nextAttempt, before + timedelta(seconds=mail.RETRY_DELAY))
+            self.assertLess(queued.nextAttempt, before + mail.LEASE)
+
+    def test_claimed_message_is_not_sent_twice(self):
+        queued, = self.queue()
+        self.assertTrue(mail._claim(queued, timezone.now()))
+        self.assertFalse(mail._claim(queued, timezone.now()))
+        self.assertEqual(mail.send_queued(), 0)
+        self.assertEqual(outbox.outbox, [])
+
+    @override_settings(AIRSUPPLY_JOBS_INLINE=False)
+    def test_one_retry_timer_per_process(self):
+        QueuedEmail.objects.create(subject='Dispatched', body='On its way', to='cm@example.com',
+                                   nextAttempt=timezone.now() + timedelta(hours=1))
+        mail._schedule_retry()
+        timer = mail._retry_timer[1]
+        try:
+            mail._schedule_retry()
+            self.assertIs(mail._retry_timer[1], timer)
+        finally:
+            timer.cancel()
+            mail._retry_timer = None
+
+
+class JobTests(TestCase):
+
+    def test_queued_key_is_not_queued_twice(self):
+        release = threading.Event()
+        blockers = [jobs.submit('block:%s' % i, release.wait, 5) for i in range(2)]
+        first = jobs.submit('count', len, 'abc')
+        self.assertIs(jobs.submit('count', len, 'abc'), first)
+        release.set()
+        self.assertEqual(first.result(timeout=5), 3)
+        for future in blockers:
+            future.result(timeout=5)
+        self.assertTrue(jobs.wait('count', 5))
+        self.assertEqual(jobs._running, {})
+
+
+class ItineraryCacheTests(TestCase):
+
+    def setUp(self):
+        self.port = Place.objects.create(name=Place.DRONE_PORT, latitude=22.27, longitude=114.13, altitude=0)
+        self.clinics = [Place.objects.create(name=name, latitude=22.26, longitude=114.0, altitude=10)
+                        for name in ('Mui Wo', 'Tai O')]
+        places = [self.port] + self.clinics
+        for a in places:
+            for b in places:
+                if a.pk < b.pk:
+                    InterPlaceDistance.objects.create(fromLocation=a, toLocation=b, distance=a.pk + b.pk)
+        self.load = DroneLoad.objects.create()
+        for clinic in self.clinics:
+            cm = make_user(clinic.name, 'Clinic Manager', clinic).clinicmanager
+            self.load.orders.add(Order.objects.create(clinicManager=cm, priority=Order.HIGH, status=Order.QD,
+                                                      totalWeight=1))
+        self.weights = itineraries.clinic_weights(self.load.orders.select_related('clinicManager'))
+        itineraries.itinerary_cache.clear()
+
+    def test_lru_hits_misses_and_eviction(self):
+        cache = itineraries.ItineraryCache(size=2)
+        self.assertIsNone(cache.get('a'))
+        cache.set('a', [1])
+        cache.set('b', [2])
+        self.assertEqual(cache.get('a'), [1])
+        cache.set('c', [3])
+        # b was the least recently used
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 2, 'size': 2})
+
+    def test_shared_backend_fills_the_lru(self):
+        self.addCleanup(caches['default'].clear)
+        shared = itineraries.ItineraryCache(backend='default')
+        shared.set('airsupply:itinerary:test', [1, 2])
+        other = itineraries.ItineraryCache(backend='default')
+        self.assertEqual(other.get('airsupply:itinerary:test'), [1, 2])
+        self.assertEqual(other.stats(), {'hits': 1, 'misses': 0, 'size': 1})
+
+    def test_plan_route_is_solved_once(self):
+        cache = itineraries.itinerary_cache
+        route = itineraries.plan_route(self.port.pk, self.weights)
+        self.assertEqual(sorted(route), sorted(clinic.pk for clinic in self.clinics))
+        before = cache.stats()
+        self.assertEqual(itineraries.plan_route(self.port.pk, self.weights), route)
+        after = cache.stats()
+        self.assertEqual((after['hits'] - before['hits'], after['misses'] - before['misses']), (1, 0))
+
+    def test_distance_change_invalidates(self):
+        cache = itineraries.itinerary_cache
+        itineraries.plan_route(self.port.pk, self.weights)
+        key = cache.key(self.port.pk, self.weights, distance_matrix.version)
+        leg = InterPlaceDistance.objects.filter(fromLocation=self.port).first()
+        leg.distance += 1
+        leg.save()
+        self.assertEqual(cache.stats()['size'], 0)
+        self.assertNotEqual(cache.key(self.port.pk, self.weights, distance_matrix.version), key)
+        misses = cache.stats()['misses']
+        itineraries.plan_route(self.port.pk, self.weights)
+        self.assertEqual(cache.stats()['misses'], misses + 1)
+
+    def test_stored_itinerary_is_used_while_current(self):
+        route = itineraries.store_itinerary(self.load.pk)
+        self.load.refresh_from_db()
+        self.assertEqual(self.load.itineraryKey,
+                         itineraries.itinerary_cache.key(self.port.pk, self.weights, distance_matrix.version))
+        self.assertEqual(itineraries.load_route(self.load, self.port.pk), route)
+        # the stored route is read back while its key matches, and worked out
+        # again once it does not
+        self.load.itinerary = ','.join(str(pk) for pk in reversed(route))
+        self.assertEqual(itineraries.load_route(self.load, self.port.pk), route[::-1])
+        self.load.itineraryKey = 'stale'
+        self.assertEqual(itineraries.load_route(self.load, self.port.pk), route)
+
+
+class ItineraryExportTests(TestCase):
+
+    def setUp(self):
+        self.port = Place.objects.create(name=Place.DRONE_PORT, latitude=22.27, longitude=114.13, altitude=0)
+        clinics = [Place.objects.create(name='Mui Wo', latitude=22.26, longitude=114.0, altitude=10),
+                   Place.objects.create(name='Tai O', latitude=22.25, longitude=113.86, altitude=5)]
+        self.load = DroneLoad.objects.create()
+        for clinic in clinics:
+            # the leg between the two clinics is missing from the distance table
+            InterPlaceDistance.objects.create(fromLocation=self.port, toLocation=clinic, distance='13.50')
+            cm = make_user(clinic.name, 'Clinic Manager', clinic).clinicmanager
+            self.load.orders.add(Order.objects.create(clinicManager=cm, priority=Order.HIGH, status=Order.QD,
+                                                      totalWeight=1))
+        make_user('dispatcher', 'Dispatcher')
+        self.client.login(username='dispatcher', password='password')
+
+    def export(self, fmt=None):
+        url = reverse('airsupply:export_itineraries')
+        response = self.client.get(url, {'format': fmt} if fmt else {})
+        return b''.join(response.streaming_content).decode()
+
+    def test_single_load_download_keeps_legacy_format(self):
+        response = self.client.get(reverse('airsupply:get_itinerary', args=[self.load.pk]))
+        self.assertEqual(b''.join(response.streaming_content).decode().splitlines(),
+                         ['22.260000,114.000000,10', '22.250000,113.860000,5', '22.270000,114.130000,0'])
+
+    def test_csv(self):
+        rows = self.export('csv').splitlines()
+        self.assertEqual(rows[0], 'load,waypoint,place,latitude,longitude,altitude,leg_km,distance_km,eta_min')
+        self.assertEqual(rows[2].split(',')[6:], ['13.5', '13.5', '13.5'])
+        leg, distance, eta = rows[3].split(',')[6:]
+        self.assertEqual(leg, '')
+        self.assertGreater(Decimal(distance), Decimal('13.5'))
+        self.assertGreater(Decimal(eta), Decimal('13.5'))
+        self.assertEqual(rows[4].split(',')[6], '13.5')
+
+    def test_geojson(self):
+        features = json.loads(self.export('geojson'))['features']
+        self.assertEqual([f['geometry']['type'] for f in features], ['LineString'] + ['Point'] * 4)
+        self.assertEqual(features[1]['geometry']['coordinates'], [114.13, 22.27, 0])
+        self.assertIsNone(features[3]['properties']['leg_km'])
+        self.assertEqual(features[4]['properties']['leg_km'], 13.5)
+        self.assertGreater(features[4]['properties']['eta_min'], features[3]['properties']['eta_min'])
+
+    def test_gpx(self):
+        from xml.etree import ElementTree
+        ns = {'gpx': 'http://www.topografix.com/GPX/1/1'}
+        root = ElementTree.fromstring(self.export('gpx'))
+        points = root.findall('gpx:rte/gpx:rtept', ns)
+        self.assertEqual([p.find('gpx:name', ns).text for p in points],
+                         [Place.DRONE_PORT, 'Mui Wo', 'Tai O', Place.DRONE_PORT])
+        self.assertEqual(points[1].get('lat'), '22.260000')
+
+    def test_export_covers_every_load(self):
+        # a load planned after one with a missing leg
+        clinic = Place.objects.get(name='Mui Wo')
+        load = DroneLoad.objects.create()
+        load.orders.add(Order.objects.create(clinicManager=clinic.clinicmanager_set.get(), priority=Order.LOW,
+                                             status=Order.QD, totalWeight=1))
+        response = self.client.get(reverse('airsupply:export_itineraries'), {'format': 'csv'})
+        self.assertEqual(response.status_code, 200)
+        rows = b''.join(response.streaming_content).decode().splitlines()[1:]
+        self.assertEqual(sorted({row.split(',')[0] for row in rows}), sorted([str(self.load.pk), str(load.pk)]))
+        self.assertEqual(len(rows), 4 + 3)
+
+
+class PushTests(TestCase):
+
+    def test_buffer_wait_and_reset(self):
+        buffer = push.EventBuffer(size=2)
+        for n in range(3):
+            buffer.publish(push.PRIORITY_QUEUE if n else push.DISPATCH_QUEUE, {'n': n})
+        self.assertEqual(buffer.wait(1, push.PRIORITY_QUEUE, 0), ([(2, {'n': 1}), (3, {'n': 2})], False))
+        self.assertEqual(buffer.wait(2, push.DISPATCH_QUEUE, 0), ([], False))
+        # fell behind the table, or ahead of it
+        self.assertEqual(buffer.wait(0, push.PRIORITY_QUEUE, 0), ([], True))
+        self.assertEqual(buffer.wait(9, push.PRIORITY_QUEUE, 0), ([], True))
+
+    def test_events_are_shared_between_processes(self):
+        # each worker process has its own EventBuffer over the same table
+        here, there = push.EventBuffer(), push.EventBuffer(interval=0.01)
+        after = there.last_id
+        pk = here.publish(push.DISPATCH_QUEUE, {'type': 'load_added', 'load': 3})
+        self.assertEqual(there.last_id, pk)
+        self.assertEqual(there.wait(after, push.DISPATCH_QUEUE, 1), ([(pk, {'type': 'load_added', 'load': 3})], False))
+        self.assertEqual(there.wait(pk, push.DISPATCH_QUEUE, 0.05), ([], False))
+
+    def test_page_polls_from_where_it_was_rendered(self):
+        make_user('wp', 'Warehouse Personnel')
+        self.client.login(username='wp', password='password')
+        after = self.client.get(reverse('airsupply:priority_queue')).context['push_after']
+        pk = push.buffer.publish(push.PRIORITY_QUEUE, {'type': 'order_added', 'order': 7})
+        url = reverse('airsupply:push', args=[push.PRIORITY_QUEUE])
+        self.assertEqual(self.client.get(url, {'after': after}).json(),
+                         {'reset': False, 'last': pk, 'events': [{'type': 'order_added', 'order': 7, 'id': pk}]})
+        # no stream slots left: answered as a poll instead of holding a worker
+        limit, push.streams.limit = push.streams.limit, 0
+        try:
+            response = self.client.get(url, {'after': pk}, HTTP_ACCEPT='text/event-stream')
+        finally:
+            push.streams.limit = limit
+        self.assertEqual(response.json()['events'], [])
+        response = self.client.get(url, {'after': pk}, HTTP_ACCEPT='text/event-stream')
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertEqual(push.streams.open, 1)
+        response.close()
+        self.assertEqual(push.streams.open, 0)
+
+
+class RoutingTests(SimpleTestCase):
+
+    @staticmethod
+    def matrix(seed, n, symmetric=True):
+        rng = random.Random(seed)
+        d = {}
+        for a in range(n + 1):
+            for b in range(a + 1, n + 1):
+                d[a, b] = rng.randint(1, 9)
+                d[b, a] = d[a, b] if symmetric else rng.randint(1, 9)
+        return lambda a, b: 0 if a == b else d[a, b]
+
+    @staticmethod
+    def permutation_search(stops, distance, weight):
+        # the original get_itinerary: shortest permutation, ties to the
+        # higher scoreCalculate score, then to the first one found
+        best = None
+        for perm in permutations(stops):
+            length = routing.route_length(0, perm, distance)
+            score = sum(weight(stop) * 10 ** (len(perm) - 1 - i) for i, stop in enumerate(perm))
+            if best is None or (length, -score) < best[:2]:
+                best = (length, -score, list(perm))
+        return best[2]
+
+    def test_exact_solver_matches_permutation_search(self):
+        for seed in range(20):
+            distance = self.matrix(seed, 6, symmetric=seed % 2 == 0)
+            weight = {stop: 1 + stop % 3 for stop in range(1, 7)}.get
+            stops = list(range(1, 7))
+            self.assertEqual(routing.solve_route(0, stops, distance, weight, 'exact'),
+                             self.permutation_search(stops, distance, weight))
+
+    def test_optimal_tour_on_fixed_matrix(self):
+        # only the ring 0-2-4-1-3-0 is cheap; it is flown in the direction that
+        # reaches the high priority clinic 2 first
+        ring = {frozenset(pair) for pair in [(0, 2), (2, 4), (4, 1), (1, 3), (3, 0)]}
+        distance = lambda a, b: 0 if a == b else 1 if frozenset((a, b)) in ring else 5
+        weight = {1: 1, 2: 3, 3: 2, 4: 1}.get
+        route = routing.solve_route(0, [1, 2, 3, 4], distance, weight, 'exact')
+        self.assertEqual(route, [2, 4, 1, 3])
+        self.assertEqual(routing.route_length(0, route, distance), 5)
+
+    def test_heuristic_is_no_worse_than_priority_order(self):
+        for seed in range(20):
+            distance = self.matrix(seed, 9)
+            weight = {stop: 1 + stop % 3 for stop in range(1, 10)}.get
+            stops = list(range(1, 10))
+            by_priority = sorted(stops, key=lambda stop: -weight(stop))
+            route = routing.solve_route(0, stops, distance, weight, 'heuristic')
+            self.assertEqual(sorted(route), stops)
+            self.assertLessEqual(routing.route_length(0, route, distance),
+                                 routing.route_length(0, by_priority, distance))
+
+    def test_ties_break_by_priority_then_input_order(self):
+        distance = lambda a, b: 0 if a == b else 1
+        weight = {1: 1, 2: 3, 3: 1, 4: 3}.get
+        for solver in ('exact', 'heuristic'):
+            first = routing.solve_route(0, [1, 2, 3, 4], distance, weight, solver)
+            self.assertEqual(first, [2, 4, 1, 3])
+            self.assertEqual(routing.solve_route(0, [1, 2, 3, 4], distance, weight, solver), first)
+
+
+class PackingTests(TestCase):
+
+    def setUp(self):
+        places = [Place.objects.create(name=Place.DRONE_PORT, latitude=22.27, longitude=114.13, altitude=0)]
+        for i, name in enumerate(['Mui Wo', 'Tai O', 'Sai Kung']):
+            places.append(Place.objects.create(name=name, latitude=22.2 + i / 10, longitude=114.0, altitude=10))
+        for a in places:
+            for b in places:
+                if a.pk < b.pk:
+                    InterPlaceDistance.objects.create(fromLocation=a, toLocation=b, distance=a.pk + b.pk)
+        managers = [make_user(place.name, 'Clinic Manager', place).clinicmanager for place in places[1:]]
+        start = timezone.now()
+        priorities = [Order.LOW, Order.HIGH, Order.MEDIUM]
+        self.orders = [
+            Order.objects.create(clinicManager=managers[i % 3], priority=priorities[i % 3], status=Order.QD,
+                                 totalWeight=[4, 9, 15, 2, 11, 6, 20, 3, 7, 5][i],
+                                 timeOrdered=start + timedelta(minutes=i))
+            for i in range(10)
+        ]
+
+    def check_bins(self, bins):
+        self.assertEqual(sorted(order.pk for b in bins for order in b), sorted(order.pk for order in self.orders))
+        for b in bins:
+            self.assertTrue(weights.fits(sum(weights.order_grams(order) for order in b)))
+            ranks = [order.priorityRank for order in b]
+            self.assertEqual(ranks, sorted(ranks))
+        # loads fly in queue order: the load holding the most urgent order first
+        firsts = [min((order.priorityRank, order.timeOrdered) for order in b) for b in bins]
+        self.assertEqual(firsts, sorted(firsts))
+        self.assertIn(self.orders[1], bins[0])
+
+    def test_every_strategy_fits_and_keeps_priority_order(self):
+        for strategy in packing.STRATEGIES:
+            with self.subTest(strategy=strategy):
+                self.check_bins(packing.pack(Order.objects.all(), strategy))
+
+    def test_exact_uses_fewest_loads(self):
+        exact = packing.pack(Order.objects.all(), 'exact')
+        for strategy in packing.STRATEGIES:
+            self.assertLessEqual(len(exact), len(packing.pack(Order.objects.all(), strategy)))
+
+    def test_rebuild_droneloads(self):
+        call_command('rebuild_droneloads', strategy='best-fit', stdout=StringIO())
+        loads = DroneLoad.objects.order_by('id')
+        self.check_bins([list(load.orders.order_by('priorityRank', 'timeOrdered')) for load in loads])
+        self.assertEqual(loads.count(), len(packing.pack(Order.objects.all(), 'best-fit')))
+
+
+class PlannerTests(TestCase):
+
+    def setUp(self):
+        places = [Place.objects.create(name=Place.DRONE_PORT, latitude=22.27, longitude=114.13, altitude=0)]
+        for name in ('Mui Wo', 'Tai O'):
+            places.append(Place.objects.create(name=name, latitude=22.26, longitude=114.0, altitude=10))
+        for a in places:
+            for b in places:
+                if a.pk < b.pk:
+                    InterPlaceDistance.objects.create(fromLocation=a, toLocation=b, distance=10)
+        self.managers = [make_user(place.name, 'Clinic Manager', place).clinicmanager for place in places[1:]]
+
+    def queue(self, weight, clinic=0, priority=Order.MEDIUM):
+        # an order that has been packed and enters Queued for Dispatch
+        order = Order.objects.create(clinicManager=self.managers[clinic], priority=priority, status=Order.PW,
+                                     totalWeight=weight, timeOrdered=timezone.now())
+        lifecycle.advance([order.pk], Order.QD)
+        return order
+
+    def loads(self):
+        return sorted(sorted(load.orders.values_list('pk', flat=True)) for load in planner.pending_loads())
+
+    def test_orders_join_a_load_on_entering_qd(self):
+        first = self.queue(5)
+        second = self.queue(5, clinic=1)
+        self.assertEqual(self.loads(), [[first.pk, second.pk]])
+        # too heavy for the first load
+        third = self.queue(15)
+        self.assertEqual(self.loads(), [[first.pk, second.pk], [third.pk]])
+        # adding again changes nothing
+        self.assertIsNone(planner.add_order(third))
+        self.assertEqual(self.loads(), [[first.pk, second.pk], [third.pk]])
+
+    def test_cancelled_order_leaves_its_load(self):
+        first = self.queue(5)
+        second = self.queue(5)
+        Order.objects.get(pk=first.pk).delete_order()
+        self.assertEqual(self.loads(), [[second.pk]])
+        Order.objects.get(pk=second.pk).delete_order()
+        self.assertFalse(DroneLoad.objects.exists())
+
+    def test_order_leaving_qd_leaves_its_load(self):
+        first = self.queue(5)
+        second = self.queue(5)
+        lifecycle.advance([first.pk], Order.DIS)
+        self.assertEqual(self.loads(), [[second.pk]])
+        lifecycle.advance([second.pk], Order.DIS)
+        self.assertEqual(self.loads(), [])
+
+    def test_dispatched_load_takes_no_more_orders(self):
+        first = self.queue(5)
+        load = planner.pending_loads().get()
+        load.dispatch(RequestFactory().get('/'))
+        self.assertEqual(self.loads(), [])
+        self.assertEqual(list(load.orders.values_list('pk', flat=True)), [first.pk])
+        second = self.queue(5)
+        self.assertEqual(self.loads(), [[second.pk]])
+        self.assertNotIn(second, load.orders.all())
+
+    def test_rebuild_matches_packing_from_scratch(self):
+        for i, weight in enumerate([4, 9, 15, 2, 11, 6, 20, 3]):
+            self.queue(weight, clinic=i % 2, priority=[Order.HIGH, Order.LOW][i % 2])
+        loads, summary = planner.rebuild('ffd')
+        expected = packing.pack(Order.objects.filter(statusCode=Order.code(Order.QD)), 'ffd')
+        self.assertEqual(self.loads(), sorted(sorted(order.pk for order in b) for b in expected))
+        self.assertEqual(summary['flights'], len(expected))
+        self.assertEqual(planner.pending_loads().count(), len(loads))
+
+    def test_dispatch_page_only_reads(self):
+        self.queue(5)
+        self.queue(17, clinic=1)
+        make_user('disp', 'Dispatcher')
+        self.client.login(username='disp', password='password')
+        self.client.get(reverse('airsupply:dispatch_view'))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('airsupply:dispatch_view'))
+        self.assertEqual(len(response.context['all_droneloads']), 2)
+        self.assertEqual([query['sql'] for query in queries if not query['sql'].startswith('SELECT')], [])
+
+
+class RouteAwarePackingTests(TestCase):
+    # two pairs of neighbouring clinics on opposite sides of the port
+
+    def setUp(self):
+        port = Place.objects.create(name=Place.DRONE_PORT, latitude=22.27, longitude=114.13, altitude=0)
+        self.west = [Place.objects.create(name=name, latitude=22.27, longitude=113.9, altitude=0)
+                     for name in ('Tai O', 'Mui Wo')]
+        self.east = [Place.objects.create(name=name, latitude=22.27, longitude=114.3, altitude=0)
+                     for name in ('Sai Kung', 'Clear Water Bay')]
+        legs = {(port, self.west[0]): 10, (port, self.west[1]): 10, (port, self.east[0]): 10,
+                (port, self.east[1]): 10, (self.west[0], self.west[1]): 1, (self.east[0], self.east[1]): 1}
+        for west in self.west:
+            for east in self.east:
+                legs[west, east] = 20
+        for (a, b), distance in legs.items():
+            InterPlaceDistance.objects.create(fromLocation=a, toLocation=b, distance=distance)
+        start = timezone.now()
+        # queued west, east, west, east; any two orders fit a load, three do not
+        self.orders = [
+            Order.objects.create(clinicManager=make_user(place.name, 'Clinic Manager', place).clinicmanager,
+                                 priority=Order.MEDIUM, status=Order.QD, totalWeight=8,
+                                 timeOrdered=start + timedelta(minutes=i))
+            for i, place in enumerate([self.west[0], self.east[0], self.west[1], self.east[1]])
+        ]
+
+    def test_neighbouring_clinics_share_a_load(self):
+        bins = packing.pack(Order.objects.all(), 'route-aware')
+        self.assertEqual([[order.pk for order in b] for b in bins],
+                         [[self.orders[0].pk, self.orders[2].pk], [self.orders[1].pk, self.orders[3].pk]])
+        first_fit = packing.report(packing.pack(Order.objects.all(), 'first-fit'))
+        route_aware = packing.report(bins)
+        self.assertEqual(route_aware['flights'], first_fit['flights'])
+        self.assertEqual(route_aware['distance'], Decimal(42))
+        self.assertLess(route_aware['distance'], first_fit['distance'])
+
+    def test_an_urgent_load_takes_on_a_neighbouring_order(self):
+        self.orders[3].priority = Order.HIGH
+        self.orders[3].save()
+        bins = packing.pack(Order.objects.all(), 'route-aware')
+        self.assertEqual([[order.pk for order in b] for b in bins],
+                         [[self.orders[3].pk, self.orders[1].pk], [self.orders[0].pk, self.orders[2].pk]])
+
+    def test_incomplete_distance_table_falls_back_to_ffd(self):
+        InterPlaceDistance.objects.filter(fromLocation=self.west[0], toLocation=self.east[0]).delete()
+        self.assertEqual(packing.pack(Order.objects.all(), 'route-aware'),
+                         packing.pack(Order.objects.all(), 'ffd'))
+
+
+class SearchTests(TestCase):
+
+    def setUp(self):
+        fluids = Category.objects.create(name='IV Fluids')
+        dressings = Category.objects.create(name='Dressings')
+        self.items = {
+            description: Item.objects.create(description=description, category=category, weight=1, imageUrl='')
+            for description, category in [
+                ('Sodium Chloride 500ml', fluids),
+                ('Dextrose Sodium Chloride 1000ml', fluids),
+                ('Lactated Ringers 250ml', fluids),
+                ('Sterile Gauze Swabs', dressings),
+                ('Fluid Resistant Gown', dressings),
+            ]
+        }
+        self.index = SearchIndex(ttl=0)
+        self.index.build()
+
+    def ids(self, *descriptions):
+        return [self.items[description].pk for description in descriptions]
+
+    def test_words_match_as_case_insensitive_prefixes(self):
+        self.assertEqual(sorted(self.index.search('CHLOR sod')),
+                         sorted(self.ids('Sodium Chloride 500ml', 'Dextrose Sodium Chloride 1000ml')))
+        self.assertEqual(self.index.search('ster gau'), self.ids('Sterile Gauze Swabs'))
+        self.assertEqual(self.index.search('sodium gauze'), [])
+
+    def test_ranking(self):
+        # a description word beats a category word, and a whole word a prefix
+        self.assertEqual(self.index.search('fluid'),
+                         self.ids('Fluid Resistant Gown', 'Sodium Chloride 500ml', 'Dextrose Sodium Chloride 1000ml',
+                                  'Lactated Ringers 250ml'))
+        # the rarer word counts for more
+        self.assertEqual(self.index.search('dextrose chloride')[0], self.ids('Dextrose Sodium Chloride 1000ml')[0])
+
+    def test_index_follows_item_changes(self):
+        search_index.build()
+        item = self.items['Sterile Gauze Swabs']
+        item.description = 'Sterile Cotton Swabs'
+        item.save()
+        self.assertEqual(search_index.search('cotton'), [item.pk])
+        self.assertEqual(search_index.search('gauze'), [])
+
+    def test_browse_pages_through_every_match(self):
+        category = Category.objects.get(name='IV Fluids')
+        Item.objects.bulk_create([Item(description='Saline %d' % i, category=category, weight=1, imageUrl='')
+                                  for i in range(230)])
+        search_index.build()
+        clinic = Place.objects.create(name='Mui Wo', latitude=22.26, longitude=114.0, altitude=10)
+        make_user('cm', 'Clinic Manager', clinic)
+        self.client.login(username='cm', password='password')
+        seen = []
+        params = {'itemDesc': 'saline', 'format': 'json', 'limit': 100}
+        while True:
+            data = self.client.get(reverse('airsupply:browse'), params).json()
+            seen += [item['id'] for item in data['results']]
+            if data['next'] is None:
+                break
+            params['cursor'] = data['next']
+        self.assertEqual(seen, search_index.search('saline'))
+        self.assertEqual(len(seen), 230)
+
+    def test_autocomplete(self):
+        search_index.build()
+        clinic = Place.objects.create(name='Mui Wo', latitude=22.26, longitude=114.0, altitude=10)
+        make_user('cm', 'Clinic Manager', clinic)
+        self.client.login(username='cm', password='password')
+        results = self.client.get(reverse('airsupply:autocomplete'), {'q': 'lact'}).json()['results']
+        self.assertEqual(results, [{'id': self.items['Lactated Ringers 250ml'].pk,
+                                    'description': 'Lactated Ringers 250ml', 'category': 'IV Fluids'}])
+
+
+class DistanceMatrixTests(TestCase):
+
+    def setUp(self):
+        self.a, self.b, self.c = [Place.objects.create(name=name, latitude=22.3, longitude=114.1, altitude=0)
+                                  for name in ('A', 'B', 'C')]
+        InterPlaceDistance.objects.create(fromLocation=self.a, toLocation=self.b, distance='4.25')
+        InterPlaceDistance.objects.create(fromLocation=self.b, toLocation=self.c, distance='3.00')
+        InterPlaceDistance.objects.create(fromLocation=self.c, toLocation=self.b, distance='3.50')
+
+    def test_one_way_distances_are_filled_in_both_ways(self):
+        matrix = DistanceMatrix(ttl=0)
+        self.assertEqual(matrix.get(self.a.pk, self.b.pk), Decimal('4.25'))
+        self.assertEqual(matrix.get(self.b.pk, self.a.pk), Decimal('4.25'))
+        # a stored reverse distance is kept
+        self.assertEqual(matrix.raw(self.b.pk, self.c.pk), 300)
+        self.assertEqual(matrix.raw(self.c.pk, self.b.pk), 350)
+        self.assertEqual(matrix.raw(self.a.pk, self.a.pk), 0)
+        with self.assertRaises(InterPlaceDistance.DoesNotExist):
+            matrix.raw(self.a.pk, self.c.pk)
+
+    def test_saving_a_distance_invalidates(self):
+        cleared = []
+        distance_matrix.on_invalidate(lambda: cleared.append(True))
+        self.addCleanup(distance_matrix._listeners.pop)
+        version = distance_matrix.version
+        self.assertEqual(distance_matrix.raw(self.a.pk, self.b.pk), 425)
+        leg = InterPlaceDistance.objects.get(fromLocation=self.a, toLocation=self.b)
+        leg.distance = '5.00'
+        leg.save()
+        self.assertTrue(cleared)
+        self.assertEqual(distance_matrix.raw(self.a.pk, self.b.pk), 500)
+        self.assertNotEqual(distance_matrix.version, version)
+
+    def test_changes_without_signals_show_up_after_the_ttl(self):
+        # as when another process saves: no signal reaches this matrix
+        matrix = DistanceMatrix(ttl=60)
+        cleared = []
+        matrix.on_invalidate(lambda: cleared.append(True))
+        version = matrix.version
+        InterPlaceDistance.objects.filter(fromLocation=self.a, toLocation=self.b).update(distance='6.00')
+        self.assertEqual(matrix.raw(self.a.pk, self.b.pk), 425)
+        matrix._loaded -= 60
+        self.assertEqual(matrix.raw(self.a.pk, self.b.pk), 600)
+        self.assertNotEqual(matrix.version, version)
+        self.assertEqual(cleared, [True])
+
+
+class ShippingLabelTests(TestCase):
+
+    def setUp(self):
+        clinic = Place.objects.create(name='Mui Wo', latitude=22.26, longitude=114.0, altitude=10)
+        cm = make_user('cm', 'Clinic Manager', clinic).clinicmanager
+        category = Category.objects.create(name='IV Fluids')
+        item = Item.objects.create(description='Saline 500ml', category=category, weight='0.5', imageUrl='')
+        self.order = Order.objects.create(clinicManager=cm, priority=Order.HIGH, status=Order.QD, totalWeight='0.5')
+        self.order.items.add(LineItem.objects.create(item=item, quantity=1))
+        # stands in for xhtml2pdf, one distinct document per label content
+        render = mock.patch.object(labels, 'render_label',
+                                   side_effect=lambda context: b'%PDF-' + labels.content_hash(context).encode())
+        self.render = render.start()
+        self.addCleanup(render.stop)
+
+    def test_stored_label_is_reused_while_its_content_is_unchanged(self):
+        pdf = labels.get_label(self.order)
+        stored = ShippingLabel.objects.get(order=self.order)
+        self.assertEqual(stored.contentHash, labels.content_hash(labels.label_context(self.order)))
+        self.assertEqual(bytes(stored.pdf), pdf)
+        self.assertEqual(labels.get_label(self.order), pdf)
+        self.assertEqual(self.render.call_count, 1)
+
+    def test_label_is_rendered_again_when_its_content_changes(self):
+        pdf = labels.get_label(self.order)
+        self.order.priority = Order.LOW
+        self.order.save()
+        self.assertNotEqual(labels.get_label(self.order), pdf)
+        self.assertEqual(self.render.call_count, 2)
+        stored = ShippingLabel.objects.get(order=self.order)
+        self.assertEqual(stored.contentHash, labels.content_hash(labels.label_context(self.order)))
+
+
+def blank_pdf(context):
+    # a one page document, standing in for a rendered label
+    writer = PdfWriter()
+    writer.add_blank_page(width=200, height=100)
+    result = BytesIO()
+    writer.write(result)
+    return result.getvalue()
+
+
+@override_settings(AIRSUPPLY_LABEL_WORKERS=1)
+class BulkLabelTests(TestCase):
+
+    def setUp(self):
+        clinic = Place.objects.create(name='Mui Wo', latitude=22.26, longitude=114.0, altitude=10)
+        cm = make_user('cm', 'Clinic Manager', clinic).clinicmanager
+        # more orders than one chunk
+        self.orders = [Order.objects.create(clinicManager=cm, priority=Order.HIGH, status=Order.QD, totalWeight=1)
+                       for _ in range(labels.CHUNK + 2)]
+        self.load = DroneLoad.objects.create()
+        self.load.orders.add(*self.orders[:3])
+        render = mock.patch.object(labels, 'render_label', side_effect=blank_pdf)
+        self.render = render.start()
+        self.addCleanup(render.stop)
+
+    def download(self, url, **params):
+        response = self.client.get(url, params)
+        return response, b''.join(response.streaming_content)
+
+    def test_queue_zip_has_one_label_per_order(self):
+        make_user('wp', 'Warehouse Personnel')
+        self.client.login(username='wp', password='password')
+        response, body = self.download(reverse('airsupply:download_shipping_bulk'))
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        self.assertIn('shipping_labels.zip', response['Content-Disposition'])
+        with zipfile.ZipFile(BytesIO(body)) as archive:
+            self.assertEqual(sorted(archive.namelist()),
+                             sorted('shipping_label_%s.pdf' % order.pk for order in self.orders))
+            self.assertEqual(archive.read('shipping_label_%s.pdf' % self.orders[0].pk), blank_pdf(None))
+        self.assertEqual(ShippingLabel.objects.count(), len(self.orders))
+        # a second export only reads the stored labels
+        self.download(reverse('airsupply:download_shipping_bulk'))
+        self.assertEqual(self.render.call_count, len(self.orders))
+
+    def test_load_pdf_merges_its_labels(self):
+        make_user('dispatcher', 'Dispatcher')
+        self.client.login(username='dispatcher', password='password')
+        url = reverse('airsupply:droneload_labels', args=[self.load.pk])
+        response, body = self.download(url)
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        self.assertIn('shipping_labels_%s.pdf' % self.load.pk, response['Content-Disposition'])
+        self.assertEqual(len(PdfReader(BytesIO(body)).pages), 3)
+        response, body = self.download(url, format='zip')
+        with zipfile.ZipFile(BytesIO(body)) as archive:
+            self.assertEqual(len(archive.namelist()), 3)
+
+
+class WeightTests(SimpleTestCase):
+
+    def test_kilograms_round_trip_through_grams(self):
+        for cents in range(0, 3000, 7):
+            weight = Decimal(cents) / 100
+            self.assertEqual(weights.grams(weight), cents * 10)
+            self.assertEqual(weights.kilograms(weights.grams(weight)), weight)
+            # the model field's string and float forms give the same grams
+            self.assertEqual(weights.grams(str(weight)), cents * 10)
+            self.assertEqual(weights.grams(float(weight)), cents * 10)
+
+    def test_grams_are_exact_where_floats_are_not(self):
+        self.assertNotEqual(0.1 + 0.2, 0.3)
+        self.assertEqual(weights.grams(0.1) + weights.grams(0.2), weights.grams('0.3'))
+        self.assertEqual(weights.kilograms(weights.grams(0.1 + 0.2)), Decimal('0.30'))
+        self.assertEqual(weights.grams('0.0005'), 1)
+        self.assertEqual(weights.kilograms(1234), Decimal('1.23'))
+
+    def test_line_and_order_grams(self):
+        line = LineItem(item=Item(weight=Decimal('0.35')), quantity=3)
+        self.assertEqual(weights.line_grams(line), 1050)
+        order = Order(totalWeight=Decimal('1.05'))
+        self.assertEqual(weights.order_grams(order), 1050 + weights.PACKAGING_WEIGHT)
+
+
+class CodeBackfillMigrationTests(TransactionTestCase):
+    # orders saved before 0005/0006 get their priorityRank and statusCode
+
+    def migrate(self, target):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate([('airsupply', target)])
+        return executor.loader.project_state([('airsupply', target)]).apps
+
+    def test_existing_orders_are_backfilled(self):
+        latest, = MigrationExecutor(connection).loader.graph.leaf_nodes('airsupply')
+        self.addCleanup(self.migrate, latest[1])
+        apps = self.migrate('0004_shippinglabel')
+        User = apps.get_model('auth', 'User')
+        Place = apps.get_model('airsupply', 'Place')
+        ClinicManager = apps.get_model('airsupply', 'ClinicManager')
+        Order = apps.get_model('airsupply', 'Order')
+        clinic = Place.objects.create(name='Mui Wo', latitude=22.26, longitude=114.0, altitude=10)
+        cm = ClinicManager.objects.create(user=User.objects.create(username='cm'), clinic=clinic)
+        rows = [('High', 'Queued for Dispatch'), ('Medium', 'Dispatched'), ('Low', 'Queued for Processing'),
+                ('None', 'Cart'), ('Low', 'Delivered'), ('High', 'Processing by Warehouse')]
+        pks = [Order.objects.create(clinicManager=cm, priority=priority, status=status, totalWeight=1).pk
+               for priority, status in rows]
+
+        Order = self.migrate('0006_order_status_code').get_model('airsupply', 'Order')
+        codes = dict(Order.objects.values_list('pk', 'priorityRank'))
+        self.assertEqual([codes[pk] for pk in pks], [0, 1, 2, 3, 2, 0])
+        codes = dict(Order.objects.values_list('pk', 'statusCode'))
+        self.assertEqual([codes[pk] for pk in pks], [3, 4, 1, 0, 5, 2])
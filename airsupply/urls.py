@@ -1,5 +1,5 @@
 from django.urls import path, re_path
-from . import views
+from . import api, views
 
 app_name = 'airsupply'
 
@@ -16,11 +16,13 @@ urlpatterns = [
     #clinic manager
     path('browse/', views.BrowseView.as_view(), name='browse'),
     re_path(r'browse/(?P<catID>[0-9]+)/$', views.BrowseView.as_view(), name='browse_cat'),
+    path('browse/autocomplete/', views.autocomplete, name='autocomplete'),
     path('cart/', views.CartView.as_view(),  name='cart'),
     path('my_orders/', views.OrderView.as_view(), name='my_orders'),
     re_path(r'my_orders/cancel/(?P<pk>[0-9]+)/$', views.cancelOrder, name='cancel_order'),
     re_path(r'my_orders/receive/(?P<pk>[0-9]+)/$', views.receiveOrder, name='receive_order'),
     path('cart/add/', views.cart_add, name='cart_add'),  # Change main.js too if URL is changed
+    path('cart/import/', views.cart_import, name='cart_import'),
     path('cart/checkout/', views.cart_checkout, name='cart_checkout'),
     re_path(r'order/(?P<pk>[0-9]+)/$', views.OrderDetailView.as_view(), name='view_order_details'),
     re_path(r'remove_item/(?P<order_pk>[0-9]+)/(?P<item_pk>[0-9]+)/$', views.delete_item, name='remove_item'),
@@ -28,6 +30,9 @@ urlpatterns = [
     #dispatcher
     path('dispatch/', views.DispatchView.as_view(), name='dispatch_view'),
     re_path(r'dispatch/itinerary/(?P<pk>[0-9]+)/$', views.get_itinerary, name='get_itinerary'),
+    path('dispatch/itineraries/', views.export_itineraries, name='export_itineraries'),
+    path('push/<slug:channel>/', views.push_updates, name='push'),
+    re_path(r'dispatch/labels/(?P<pk>[0-9]+)/$', views.droneload_labels, name='droneload_labels'),
     re_path(r'dispatch/(?P<pk>[0-9]+)/$', views.dispatch, name='dispatch_drone'),
 
     #warehouse personnel
@@ -35,5 +40,17 @@ urlpatterns = [
     re_path(r'priority_queue/1/(?P<pk>[0-9]+)/$', views.processing_order, name='order_processing'),
     re_path(r'priority_queue/2/(?P<pk>[0-9]+)/$', views.order_processed, name='order_processed'),
     re_path(r'priority_queue/3/(?P<pk>[0-9]+)/$', views.download_shipping, name='download_shipping'),
+    re_path(r'priority_queue/labels/$', views.download_shipping_bulk, name='download_shipping_bulk'),
+
+    #json api
+    path('api/v1/items/', api.items, name='api_items'),
+    path('api/v1/items/<int:pk>/', api.item, name='api_item'),
+    path('api/v1/cart/', api.cart, name='api_cart'),
+    path('api/v1/orders/', api.orders, name='api_orders'),
+    path('api/v1/orders/<int:pk>/', api.order, name='api_order'),
+    path('api/v1/queue/', api.queue, name='api_queue'),
+    path('api/v1/loads/', api.loads, name='api_loads'),
+    path('api/v1/loads/<int:pk>/', api.load, name='api_load'),
+    path('api/v1/loads/<int:pk>/itinerary/', api.itinerary, name='api_itinerary'),
 
 ]
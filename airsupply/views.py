@@ -1,21 +1,26 @@
+import json
+
 from django.views import generic
 from django.shortcuts import render, redirect
 from django.template.defaulttags import register
 from .models import Item, Category, Order, LineItem, Cart, DroneLoad, Place, ClinicManager
 from django.http import JsonResponse
-import csv
 from django.contrib.auth import authenticate, login, logout
 from django.views.generic import View
 from .forms import UserForm, ClinicManagerForm, AccountForm
 from django.utils.encoding import force_text
 from django.utils.http import urlsafe_base64_decode
 from .tokens import account_activation_token
+from . import carts, catalogue, flightplans, labels, lifecycle, push, roles, weights
+from .pagination import KeysetPaginationMixin, rank_after
 from django.contrib.auth.models import User
 from .tokens import send_new_password
 from django.contrib.auth.decorators import user_passes_test
 from django.contrib.auth.mixins import UserPassesTestMixin
-from django.http import HttpResponse
+from django.http import HttpResponse, Http404, StreamingHttpResponse
 from django.dispatch import receiver
+from django.views.decorators.http import require_POST
+from django.db.models import Min, Prefetch, Sum
 
 
 #debugging:
@@ -29,82 +34,82 @@ def get_item(dictionary, key):
 
 # group checkers
 def cm_checker(user):
-    return user.groups.filter(name='Clinic Manager').count() != 0 | user.is_superuser
+    return roles.has_role(user, roles.CLINIC_MANAGER)
 
 
 class CMCheck(UserPassesTestMixin):
     def test_func(self):
-        u = self.request.user
-        return u.groups.filter(name='Clinic Manager').count() != 0 | u.is_superuser
+        return cm_checker(self.request.user)
 
 
 def disp_checker(user):
-    return user.groups.filter(name='Dispatcher').count() != 0 | user.is_superuser
+    return roles.has_role(user, roles.DISPATCHER)
 
 
 class DispCheck(UserPassesTestMixin):
     def test_func(self):
-        u = self.request.user
-        return u.groups.filter(name='Dispatcher').count() != 0 | u.is_superuser
+        return disp_checker(self.request.user)
 
 
 def wp_checker(user):
-    return user.groups.filter(name='Warehouse Personnel').count() != 0 | user.is_superuser
+    return roles.has_role(user, roles.WAREHOUSE_PERSONNEL)
 
 
 class WPCheck(UserPassesTestMixin):
     def test_func(self):
-        u = self.request.user
-        return u.groups.filter(name='Warehouse Personnel').count() != 0 | u.is_superuser
+        return wp_checker(self.request.user)
 
 
 # Clinic Manager
-class BrowseView(CMCheck, generic.ListView):
+class BrowseView(CMCheck, KeysetPaginationMixin, generic.ListView):
     template_name = 'clinic-manager/browse.html'
     context_object_name = 'all_items'
 
     def get_queryset(self):
         if self.kwargs.get('catID'):
-            all_items = Item.objects.filter(category=Category.objects.get(id=self.kwargs.get('catID')))
-            all_items.categorized = True
-            return all_items
+            return catalogue.items(category_id=self.kwargs.get('catID'))
         elif self.request.GET.get('itemDesc'):
-            all_items = Item.objects.filter(description__contains=self.request.GET.get('itemDesc'))
-            all_items.categorized = True
-            return all_items
+            # only the ranks this page can show, plus one to tell if there are more
+            return catalogue.search(self.request.GET.get('itemDesc'), rank_after(self.request.GET.get('cursor')),
+                                    self.get_page_size() + 1)
         else:
-            return Item.objects.all()
+            return catalogue.items()
+
+    def get_keyset(self):
+        if self.request.GET.get('itemDesc') and not self.kwargs.get('catID'):
+            return ('search_rank',)
+        return ('id',)
+
+    def serialize(self, item):
+        return {'id': item.id, 'description': item.description, 'category': item.category.name,
+                'weight': str(item.weight), 'imageUrl': item.imageUrl}
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        cats = Category.objects.all()
-        context['categories'] = cats
-        catSizes = {}
-        for cat in cats:
-            catSizes[cat] = Item.objects.filter(category=cat).count()
-        context['catSizes'] = catSizes
+        context['categorized'] = bool(self.kwargs.get('catID') or self.request.GET.get('itemDesc'))
+        context['categories'] = catalogue.categories()
         return context
 
 
+@user_passes_test(cm_checker)
+def autocomplete(request):
+    return JsonResponse({'results': catalogue.suggest(request.GET.get('q', ''))})
+
+
 class CartView(CMCheck, generic.ListView):
     template_name = 'clinic-manager/cart.html'
     context_object_name = 'all_items'
 
     def get_queryset(self):
-        return Cart.objects.get(clinicManager=self.request.user.clinicmanager, status=Order.CART).items.all()
+        self.cart = carts.get_cart(self.request.user.clinicmanager)
+        return self.cart.items.select_related('item')
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        items = Cart.objects.get(clinicManager=self.request.user.clinicmanager, status=Order.CART).items.all()
-        itemWeights = {}
-        sum = 0
-        for item in items:
-            itemWeights[item] = item.item.weight * item.quantity
-            sum += itemWeights[item]
-        context['weights'] = itemWeights
-        context['totalWeight'] = sum
+        context['weights'] = {line: weights.kilograms(weights.line_grams(line)) for line in context['all_items']}
+        context['totalWeight'] = self.cart.totalWeight
         context['ordered'] = "FALSE"
-        context['order_id'] = Cart.objects.get(clinicManager=self.request.user.clinicmanager, status=Order.CART).pk
+        context['order_id'] = self.cart.pk
         return context
 
 
@@ -115,41 +120,77 @@ def cart_add(request):
         itemID = request.GET.get('itemid', 0)
 
         item = Item.objects.get(pk=itemID)
-        quantity = request.GET.get('qty', 0)
+        quantity = int(request.GET.get('qty', 0))
 
-    except(KeyError, Item.DoesNotExist):
+    except(KeyError, ValueError, Item.DoesNotExist):
         return JsonResponse({'success': False, 'error_message': 'Item does not exist'})
     else:
-        cart = Cart.objects.get(clinicManager=request.user.clinicmanager, status=Order.CART)
-
-        newItem = LineItem()
-        newItem.item = item
-        newItem.quantity = quantity
-        if cart.checkTotalWeight(newItem):
-            newItem.save()
-            cart.addLineItem(newItem)
+        if quantity <= 0:
+            return JsonResponse({'success': False, 'error_message': 'Quantity must be at least 1'})
+        cart = carts.get_cart(request.user.clinicmanager)
+        if carts.add_item(cart, item, quantity):
             return JsonResponse({'success': True})
         else:
             return JsonResponse({'success': False, 'error_message': 'Cart weight limit exceeded'})
 
 
+def _import_quantities(request):
+    # (item id, quantity) pairs from a JSON body, an uploaded CSV 'file' or
+    # CSV 'lines'
+    if request.content_type == 'application/json':
+        return carts.read_json(json.loads(request.body.decode()))
+    if 'file' in request.FILES:
+        return carts.read_csv(request.FILES['file'].read().decode('utf-8-sig'))
+    if request.content_type == 'text/csv':
+        return carts.read_csv(request.body.decode('utf-8-sig'))
+    return carts.read_csv(request.POST.get('lines', ''))
+
+
+@require_POST
+@user_passes_test(cm_checker)
+def cart_import(request):
+    # many items at once: 'order' copies an earlier order, otherwise the
+    # items are read from the request
+    cm = request.user.clinicmanager
+    try:
+        cart = carts.get_cart(cm)
+        if request.POST.get('order'):
+            order = Order.objects.exclude(statusCode=Order.code(Order.CART)).get(
+                pk=request.POST['order'], clinicManager=cm)
+            added = carts.copy_order(cart, order)
+        else:
+            added = carts.add_items(cart, _import_quantities(request))
+    except Order.DoesNotExist:
+        return JsonResponse({'success': False, 'error_message': 'Order does not exist'})
+    except (ValueError, UnicodeDecodeError) as e:
+        return JsonResponse({'success': False, 'error_message': str(e)})
+    if not added:
+        return JsonResponse({'success': False, 'error_message': 'Cart weight limit exceeded'})
+    return JsonResponse({'success': True, 'totalWeight': str(cart.totalWeight)})
+
+
 def delete_item(request, order_pk, item_pk):
-    Cart.objects.get(id=order_pk).items.get(id=item_pk).delete()
+    carts.remove_item(Cart.objects.get(id=order_pk), item_pk)
     return redirect('airsupply:cart');
 
 
-class OrderView(CMCheck, generic.ListView):
+class OrderView(CMCheck, KeysetPaginationMixin, generic.ListView):
     template_name = 'clinic-manager/view-orders.html'
     context_object_name = 'all_orders'
+    keyset = ('-id',)
 
     def get_queryset(self):
-        return Order.objects.exclude(status=Order.CART).filter(clinicManager=self.request.user.clinicmanager)
+        return Order.objects.exclude(statusCode=Order.code(Order.CART)).filter(clinicManager=self.request.user.clinicmanager)
+
+    def serialize(self, order):
+        return {'id': order.id, 'priority': order.priority, 'status': order.status,
+                'totalWeight': str(order.totalWeight), 'timeOrdered': order.timeOrdered}
 
 
 @user_passes_test(cm_checker)
 def cart_checkout(request):
     priority = request.POST['priority']
-    cart = Cart.objects.get(clinicManager=request.user.clinicmanager, status=Order.CART)
+    cart = Cart.objects.get(clinicManager=request.user.clinicmanager, statusCode=Order.code(Order.CART))
     if cart.checkout(priority):
         Cart.objects.create_cart(request.user.clinicmanager)
         return redirect('airsupply:my_orders')
@@ -162,19 +203,14 @@ class OrderDetailView(CMCheck, generic.ListView):
     context_object_name = 'all_items'
 
     def get_queryset(self):
-        return Order.objects.get(id=self.kwargs.get('pk')).items.all()
+        self.order = Order.objects.get(id=self.kwargs.get('pk'))
+        return self.order.items.select_related('item')
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        order = Order.objects.get(id=self.kwargs.get('pk'))
-        items = order.items.all()
-        itemWeights = {}
-        sum = 0
-        for item in items:
-            itemWeights[item] = item.item.weight * item.quantity
-            sum += itemWeights[item]
-        context['weights'] = itemWeights
-        context['totalWeight'] = sum
+        order = self.order
+        context['weights'] = {line: weights.kilograms(weights.line_grams(line)) for line in context['all_items']}
+        context['totalWeight'] = order.totalWeight
         context['ordered'] = "TRUE"
         context['priority'] = order.priority
         context['date'] = order.timeOrdered
@@ -189,42 +225,46 @@ def cancelOrder(request, pk):
 
 
 def receiveOrder(request, pk):
-    receivingOrder = Order.objects.get(id=pk)
-    receivingOrder.update_status("Delivered")
+    lifecycle.advance([pk], Order.DEL)
     return redirect("airsupply:my_orders")
 
 
+class LiveQueueMixin:
+    # the push event id the page is current with; it is read before the rows,
+    # so a change can be applied twice but never missed
+
+    def get_context_data(self, **kwargs):
+        push_after = push.buffer.last_id
+        context = super().get_context_data(**kwargs)
+        context['push_after'] = push_after
+        return context
+
+
 # Warehouse Personnel
-class PriorityQueueView(WPCheck, generic.ListView):
+class PriorityQueueView(WPCheck, LiveQueueMixin, KeysetPaginationMixin, generic.ListView):
     template_name = 'warehouse-personnel/priority-queue.html'
     context_object_name = 'all_orders'
+    keyset = ('priorityRank', 'timeOrdered', 'id')
 
     def get_queryset(self):
-        order = {
-            "High": 1,
-            "Medium": 2,
-            "Low": 3
-        }
-        orderedList = sorted(Order.objects.filter(status__in=[Order.QP, Order.PW]), key=lambda n: (order[n.priority], n.timeOrdered))
-        return orderedList
+        return Order.objects.preferred_order(statusCode__in=[Order.code(Order.QP), Order.code(Order.PW)])
+
+    def serialize(self, order):
+        return {'id': order.id, 'clinic': order.clinicManager.clinic.name, 'priority': order.priority,
+                'status': order.status, 'totalWeight': str(order.totalWeight), 'timeOrdered': order.timeOrdered}
 
 
 @user_passes_test(wp_checker)
 def order_processed(request, pk):
-    order = Order.objects.get(pk=pk)
-    order.update_status(Order.QD)
+    lifecycle.advance([pk], Order.QD)
     return redirect('airsupply:priority_queue')
 
 @user_passes_test(wp_checker)
 def processing_order(request, pk):
-    try:
-        order = Order.objects.get(pk=pk)
-        order.update_status("Processing by Warehouse")
-
-    except(KeyError, Item.DoesNotExist):
-        return JsonResponse({'success': False, 'error_message': 'Order does not exist'})
-    else:
+    if lifecycle.advance([pk], Order.PW):
         return JsonResponse({'success': True})
+    else:
+        return JsonResponse({'success': False, 'error_message': 'Order is not waiting to be processed'})
 
 
 def download_shipping(request, pk):
@@ -236,68 +276,85 @@ def download_shipping(request, pk):
         return order.download_shipping()
 
 
+@user_passes_test(wp_checker)
+def download_shipping_bulk(request):
+    orders = Order.objects.filter(statusCode=Order.code(Order.QD)).order_by('timeOrdered', 'id')
+    return labels.bulk_response(orders, request.GET.get('format', 'zip'), 'shipping_labels')
+
+
 # Dispatcher
-class DispatchView(DispCheck, generic.ListView):
+class DispatchView(DispCheck, LiveQueueMixin, KeysetPaginationMixin, generic.ListView):
     template_name = 'dispatcher/dispatch-queue.html'
     context_object_name = 'all_droneloads'
+    keyset = ('priority_rank', 'id')
 
     def get_queryset(self):
-        self.makeDroneLoads()
-        return DroneLoad.objects.exclude(dispatched='TRUE')
-
-    def makeDroneLoads(self):
-        DroneLoad.objects.exclude(dispatched='TRUE').delete()
-
-        order_priority = {
-            "High": 1,
-            "Medium": 2,
-            "Low": 3
-        }
-        ordered_list = sorted(Order.objects.filter(status=Order.QD),
-                              key=lambda n: (order_priority[n.priority], n.timeOrdered))
-
-        while len(ordered_list) > 0:
-            dlWeight = 0.0
-            newDL = DroneLoad()
-            newDL.save()
-            for order in list(ordered_list):
-                if dlWeight + float(order.totalWeight) + 1.2 < DroneLoad.DRONE_LIMIT:
-                    newDL.add_order(order)
-                    dlWeight += float(order.totalWeight) + 1.2
-                    ordered_list.remove(order)
-            if newDL.orders.count():
-                newDL.save()
+        # loads are kept up to date by the planner as orders change status
+        orders = Order.objects.select_related('clinicManager__clinic').order_by('priorityRank', 'timeOrdered', 'id')
+        return DroneLoad.objects.exclude(dispatched='TRUE').annotate(
+            priority_rank=Min('orders__priorityRank'),
+            total_weight=Sum('orders__totalWeight'),
+        ).prefetch_related(Prefetch('orders', queryset=orders)).order_by('priority_rank', 'id')
 
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
-        dLs = DroneLoad.objects.exclude(dispatched=DroneLoad.TRUE)
-        dlWeights = {}
-        for dl in dLs:
-            sum = 0.0
-            for orders in dl.orders.all():
-                sum += float(orders.totalWeight)
-            dlWeights[dl] = round(sum, 2)
-        context['dlWeights'] = dlWeights
-        return context
+    def serialize(self, dl):
+        return {'id': dl.id, 'orders': [order.id for order in dl.orders.all()],
+                'totalWeight': str(dl.total_weight)}
 
 
 @user_passes_test(disp_checker)
 def get_itinerary(request, pk):
-    # Create the HttpResponse object with the appropriate CSV header.
     dl = DroneLoad.objects.get(pk=pk)
-    places = dl.get_itinerary()
-    response = HttpResponse(content_type='text/csv')
-    response['Content-Disposition'] = 'attachment; filename="itinerary_005.csv"'
-    writer = csv.writer(response)
-    for place in places:
-        writer.writerow([place.latitude, place.longitude, place.altitude])
-    return response
+    # without ?format= this is the original headerless CSV the drone port reads
+    return flightplans.export_response([dl], request.GET.get('format'), 'itinerary_%s' % dl.pk, default='legacy')
+
+
+@user_passes_test(disp_checker)
+def export_itineraries(request):
+    # every load waiting for dispatch, in the order of the dispatch queue
+    loads = DroneLoad.objects.exclude(dispatched='TRUE') \
+        .annotate(priority_rank=Min('orders__priorityRank')).order_by('priority_rank', 'id')
+    return flightplans.export_response(loads, request.GET.get('format', 'csv'), 'itineraries')
+
+
+PUSH_CHECKERS = {
+    push.PRIORITY_QUEUE: wp_checker,
+    push.DISPATCH_QUEUE: disp_checker,
+}
+
+
+def push_updates(request, channel):
+    if channel not in PUSH_CHECKERS:
+        raise Http404
+    if not PUSH_CHECKERS[channel](request.user):
+        return HttpResponse(status=403)
+    try:
+        after = int(request.GET.get('after') or request.META.get('HTTP_LAST_EVENT_ID') or push.buffer.last_id)
+    except ValueError:
+        after = push.buffer.last_id
+    if 'text/event-stream' in request.META.get('HTTP_ACCEPT', ''):
+        events = push.open_stream(channel, after)
+        if events is not None:
+            response = StreamingHttpResponse(events, content_type='text/event-stream')
+            response['Cache-Control'] = 'no-cache'
+            response['X-Accel-Buffering'] = 'no'
+            return response
+    return JsonResponse(push.poll(channel, after))
+
+
+@user_passes_test(disp_checker)
+def droneload_labels(request, pk):
+    dl = DroneLoad.objects.get(pk=pk)
+    return labels.bulk_response(dl.orders.order_by('id'), request.GET.get('format', 'pdf'),
+                                'shipping_labels_%s' % dl.pk)
 
 
 @user_passes_test(disp_checker)
 def dispatch(request, pk):
     dl = DroneLoad.objects.get(pk=pk)
-    dl.dispatch(request)
+    try:
+        dl.dispatch(request)
+    except lifecycle.InvalidTransition:
+        pass  # someone else dispatched it first
     return redirect('airsupply:dispatch_view')
 
 
@@ -309,8 +366,8 @@ class UserRegisterView(View):
     def get(self, request, usernameb64, token):
         form = self.form_class(None)
         if self.processToken(request, usernameb64, token):
-            role = request.user.groups.all()[0].name
-            if role == "Clinic Manager":
+            role = roles.get_role(request.user)
+            if role == roles.CLINIC_MANAGER:
                 form = ClinicManagerForm
             return render(request, self.template_name,
                           {'form': form, 'email': request.user.email, 'role': role})
@@ -319,9 +376,9 @@ class UserRegisterView(View):
 
     def post(self, request):
         user = request.user
-        role = user.groups.all()[0].name
+        role = request.role
         form = self.form_class(request.POST)
-        if role == "Clinic Manager":
+        if role == roles.CLINIC_MANAGER:
             form = ClinicManagerForm(request.POST)
 
         if form.is_valid():
@@ -339,7 +396,7 @@ class UserRegisterView(View):
             user.last_name = lname
             user.save()
 
-            if role == "Clinic Manager":
+            if role == roles.CLINIC_MANAGER:
                 clinic = form.cleaned_data['clinicName']
                 cm = ClinicManager()
                 cm.user = user
@@ -402,7 +459,7 @@ class UserAccount(View):
 
     def get(self, request):
         form = self.form_class(instance=request.user)
-        return render(request, self.template_name, {'form': form, 'role': request.user.groups.all()[0].name})
+        return render(request, self.template_name, {'form': form, 'role': request.role})
 
     def post(self, request):
         form = self.form_class(request.POST, instance=request.user)
@@ -418,8 +475,8 @@ class UserAccount(View):
                         login(request, user)
                 elif changedData != "confirm_password":
                     user.save(update_fields=[changedData])
-            return render(request, self.template_name, {'form': form, 'role': request.user.groups.all()[0].name})
-        return render(request, self.template_name, {'form': form, 'role': request.user.groups.all()[0].name})
+            return render(request, self.template_name, {'form': form, 'role': request.role})
+        return render(request, self.template_name, {'form': form, 'role': request.role})
 
 
 def authUser(request, username, password, temp_name, data={}):
@@ -427,13 +484,13 @@ def authUser(request, username, password, temp_name, data={}):
     if user is not None:
         if user.is_active:
             login(request, user)
-            role = user.groups.all()[0].name
-            if role == "Clinic Manager":
+            role = roles.get_role(user)
+            if role == roles.CLINIC_MANAGER:
                 Cart.objects.create_cart(user.clinicmanager)
                 return redirect('airsupply:browse')
-            elif role == "Dispatcher":
+            elif role == roles.DISPATCHER:
                 return redirect('airsupply:dispatch_view')
-            elif role == "Warehouse Personnel":
+            elif role == roles.WAREHOUSE_PERSONNEL:
                 return redirect('airsupply:priority_queue')
         else:
             data['error_message'] = 'Your account has been disabled'